@@ -11,6 +11,7 @@ import time   # for sleep
 import argparse # for argument parsing
 import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
+import signal # for a clean shutdown on SIGTERM
 import random # needed in the topic selection using random numbers
 from topic_selector import TopicSelector
 from CS6381_MW.BrokerMW import BrokerMW
@@ -40,7 +41,6 @@ class BrokerAppln ():
         self.frequency = None # rate at which dissemination takes place
         self.mw_obj = None # handle to the underlying Middleware object
         self.logger = logger  # internal logger for print statements
-        self.msg_list = [] # Initalise to empty list
         self.lookup = None # one of the diff ways we do lookup
         self.dissemination = None # direct or via broker
         self.is_ready = None
@@ -74,6 +74,8 @@ class BrokerAppln ():
             self.logger.info("BrokerAppln::driver completed")
         except Exception as e:
             raise e
+        finally:
+            self.mw_obj.disable_event_loop() # also stops the forwarding thread or shard processes
     
     def invoke_operation(self):
         try:
@@ -91,13 +93,13 @@ class BrokerAppln ():
                 self.mw_obj.receiveAllPublishers()
                 return None
             elif (self.state == self.State.RECEIVEANDDISSEMINATE):
-                while True:
-                    self.logger.info("BrokerAppln::invoke_operation - RECEIVING AND SENDING SIMULATANEOUSLY:")
-                    msg = self.mw_obj.receive_msg_sub()
-                    self.mw_obj.send_msg_pub(msg + ":(from broker)")
-                    self.msg_list.append(msg)
-                    self.logger.info("BrokerAppln::invoke_operation - msg: " + str(msg))
-                    return None
+                # messages are delivered by the event loop through message_received,
+                # so just wait for the next event. A sharded broker wakes up
+                # periodically to report the throughput of each shard
+                if self.mw_obj.shards > 1 and self.mw_obj.telemetry.report_interval:
+                    self.mw_obj.report_shards()
+                    return self.mw_obj.telemetry.report_interval * 1000
+                return None
                 """
             elif (self.state == self.State.RECEIVEFROMPUB):
                 self.logger.info("BrokerAppln::invoke_operation - RECEIVING Messages as shown below:")
@@ -123,6 +125,15 @@ class BrokerAppln ():
         except Exception as e:
             raise e
 
+    # upcall made by the middleware for every message drained from the SUB socket
+    # (Inline engine only; the Forwarder engine relays on its own thread)
+    def message_received(self, msg):
+        try:
+            self.mw_obj.send_msg_pub(msg) # the middleware marks the message as relayed
+            return None
+        except Exception as e:
+            raise e
+
     def register_response(self, reg_resp):
         try:
             self.logger.info ("BrokerAppln::register_response")
@@ -143,7 +154,10 @@ class BrokerAppln ():
             self.logger.info("BrokerAppln::isready_response")
             if not isready_resp.status:
                 self.logger.info("BrokerAppln::driver - Not ready yet; check again")
-                time.sleep(10)  # sleep between calls so that we don't make excessive calls
+                # the discovery service holds our request until everyone has registered
+                # (Server=ROUTER), so this only happens when its ready timeout expires or
+                # it cannot hold requests. Ask again shortly, without blocking the event loop
+                return self.mw_obj.ready_retry()
             else:
                 # we got the go ahead + set the state to CHECKMSG
                 self.state = self.State.CHECKMSG
@@ -154,13 +168,42 @@ class BrokerAppln ():
     def allPublishersResponse(self, check_response):
         try:
             self.logger.info("BrokerAppln::allPublishersResponse")
+            # this may be a resync, so drop the publishers that are no longer listed
+            listed = set(pub.id for pub in check_response.publist)
+            for id in list(self.mw_obj.publishers):
+                if id not in listed:
+                    self.mw_obj.dropPublisher(id)
             for pub in check_response.publist:
+                if pub.id == self.name:
+                    continue # the discovery service lists the broker as a publisher too
                 self.logger.info("tcp://{}:{}".format(pub.addr, pub.port))
-                self.mw_obj.connect2pubs(pub.addr, pub.port)
+                self.mw_obj.connectPublisher(pub)
             self.state = self.State.RECEIVEANDDISSEMINATE #RECEIVEFROMPUB
             return 0
         except Exception as e:
             raise e
+
+    # upcall made by the middleware for each registry change, in sequence order
+    def registry_changed(self, delta):
+        try:
+            if delta.info.id == self.name:
+                return None
+            if delta.change == discovery_pb2.CHANGE_PUB_REMOVED:
+                self.mw_obj.dropPublisher(delta.info.id)
+            else: # we relay every topic, so a topic change only matters to a new publisher
+                self.mw_obj.connectPublisher(delta.info)
+            return None
+        except Exception as e:
+            raise e
+
+    # upcall made by the middleware when it missed registry changes: look up a
+    # fresh list of publishers (the request socket is idle once we relay)
+    def registry_resync(self):
+        try:
+            self.mw_obj.receiveAllPublishers()
+            return None
+        except Exception as e:
+            raise e
     
     def dump(self):
         try:
@@ -169,6 +212,7 @@ class BrokerAppln ():
             self.logger.info("     Name: {}".format (self.name))
             self.logger.info("     Lookup: {}".format (self.lookup))
             self.logger.info("     Num Topics: {}".format (len(self.topiclist)))
+            self.logger.info("     Shards: {}".format (self.mw_obj.shards))
             self.logger.info("     TopicList: {}".format (self.topiclist))
             self.logger.info("     Iterations: {}".format (self.iters))
             self.logger.info("     Frequency: {}".format (self.frequency))
@@ -205,6 +249,8 @@ def main():
         logger.debug("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
         # Obtain a Broker application
         logger.debug("Main: obtain the Broker appln object")
+        # turn SIGTERM into SystemExit so the forwarding engine is shut down on the way out
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
         broker_app = BrokerAppln (logger)
         # configure the object
         logger.debug("Main: configure the Broker appln object")
@@ -0,0 +1,140 @@
+# asyncio event loop for the middleware objects, selected by [Middleware]
+# EventLoop=Asyncio in config.ini (the default, Poller, is PinguMW.event_loop).
+#
+# - Every socket the middleware polls gets its own reader coroutine, which
+#   awaits it through a zmq.asyncio shadow of the socket and then calls its
+#   handler. The handlers keep using the original sockets. Doing so may
+#   consume the edge of another socket's file descriptor that its reader is
+#   waiting for, so after every handler the readers of the sockets with input
+#   pending (ZMQ_EVENTS) are kicked.
+# - Handlers come from a table built once per middleware role, not from
+#   comparing name_of_MW on every wakeup. Sockets the middleware registers
+#   with its poller later on (notifications, DHT peers) get readers as soon
+#   as they appear. Plain sockets the poller reports by file descriptor (the
+#   UDP socket of Strategy=Multicast) are watched by the asyncio loop itself.
+# - The application's invoke_operation upcall is a timer task. As in the
+#   poller loop, the timeout a handler returns is the time after which
+#   invoke_operation is due, and None keeps the pending one; None from
+#   invoke_operation itself means not until a handler asks. An idle process
+#   sleeps in the asyncio selector and uses no CPU.
+#
+# The upcalls themselves are unchanged and run on the loop, so one that blocks
+# holds up the other sockets just as it does with the poller loop.
+
+import asyncio # for the event loop, reader and timer tasks
+import time   # for the clock
+import zmq  # ZMQ sockets
+import zmq.asyncio # awaitable shadows of the middleware's sockets
+
+class AsyncCore():
+    def __init__(self, mw, name_of_MW, zmq_socket):
+        self.mw = mw # the middleware object whose sockets we serve
+        self.name = name_of_MW # e.g. SubscriberMW, for the handler table and logs
+        self.main_socket = zmq_socket # its request (or reply) socket
+        self.table = {} # socket -> its handler, a callable returning the next timeout
+        self.readers = {} # socket -> its reader task
+        self.descriptors = set() # file descriptors watched with add_reader
+        self.kicks = {} # socket -> asyncio.Event waking its reader
+        self.deadline = None # monotonic time invoke_operation is due; None: not scheduled
+        self.armed = None # deadline the timer task is currently waiting for
+        self.rearmed = None # asyncio.Event waking the timer task for an earlier deadline
+        self.done = None # asyncio.Event set once the middleware disables its event loop
+        self.error = None # exception raised by a handler, re-raised by run
+
+    def run(self, timeout=None):
+        self.mw.logger.info("{}::event_loop - run the asyncio event loop".format(self.name))
+        asyncio.run(self.main(timeout))
+        self.mw.logger.info("{}::event_loop - out of the event loop".format(self.name))
+        if self.error is not None:
+            raise self.error
+
+    async def main(self, timeout):
+        self.rearmed = asyncio.Event()
+        self.done = asyncio.Event()
+        self.set_timeout(timeout)
+        self.watch_sockets()
+        timer = asyncio.create_task(self.timer())
+        await self.done.wait()
+        for fd in self.descriptors:
+            asyncio.get_running_loop().remove_reader(fd)
+        tasks = [timer] + list(self.readers.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # start a reader for every socket registered with the middleware's poller
+    # that does not have one yet
+    def watch_sockets(self):
+        polled = [socket for socket, flags in self.mw.poller.sockets]
+        if all(socket in self.readers or socket in self.descriptors for socket in polled):
+            return
+        self.table = self.mw.handlers(self.name, self.main_socket)
+        for socket in polled:
+            if isinstance(socket, int) and socket not in self.descriptors and socket in self.table:
+                # level triggered: the handler runs for as long as there is input
+                asyncio.get_running_loop().add_reader(socket, self.dispatch, self.table[socket])
+                self.descriptors.add(socket)
+            elif not isinstance(socket, int) and socket not in self.readers and socket in self.table:
+                self.kicks[socket] = asyncio.Event()
+                self.readers[socket] = asyncio.create_task(self.reader(socket))
+
+    async def reader(self, socket):
+        shadow = zmq.asyncio.Socket.from_socket(socket)
+        kick = self.kicks[socket]
+        while True:
+            if not socket.get(zmq.EVENTS) & zmq.POLLIN:
+                kick.clear()
+                waiters = [asyncio.ensure_future(shadow.poll(flags=zmq.POLLIN)), asyncio.ensure_future(kick.wait())]
+                await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+                for waiter in waiters:
+                    waiter.cancel()
+                if not socket.get(zmq.EVENTS) & zmq.POLLIN:
+                    continue # spurious wakeup; the handler would block
+            self.dispatch(self.table[socket])
+            await asyncio.sleep(0) # give the other sockets a turn
+
+    # the invoke_operation upcall, once its deadline has passed without being
+    # pushed back by a handler
+    async def timer(self):
+        while True:
+            self.rearmed.clear()
+            self.armed = self.deadline
+            delay = None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+            if delay == 0:
+                # due now: let the readers with pending messages run first, as
+                # the poller loop does (wait_for would not even yield)
+                await asyncio.sleep(0)
+            else:
+                try:
+                    await asyncio.wait_for(self.rearmed.wait(), delay)
+                    continue # an earlier deadline was set
+                except asyncio.TimeoutError:
+                    pass
+            if self.deadline is None or self.deadline > time.monotonic():
+                continue # pushed back (or cancelled) meanwhile
+            self.deadline = None
+            self.dispatch(self.mw.upcall_obj.invoke_operation)
+
+    # run a handler or upcall and apply the timeout it returns, if any
+    def dispatch(self, handler):
+        if self.done.is_set():
+            return
+        try:
+            timeout = handler()
+            if timeout is not None:
+                self.set_timeout(timeout)
+            self.watch_sockets()
+            for socket, kick in self.kicks.items():
+                if socket.get(zmq.EVENTS) & zmq.POLLIN:
+                    kick.set()
+        except Exception as e:
+            self.error = e
+            self.done.set()
+            return
+        if not self.mw.handle_events:
+            self.done.set()
+
+    def set_timeout(self, timeout):
+        self.deadline = None if timeout is None else time.monotonic() + timeout / 1000
+        if self.deadline is not None and (self.armed is None or self.deadline < self.armed):
+            self.rearmed.set()
@@ -14,14 +14,18 @@ import logging # for logging. Use it in place of print statements.
 import zmq  # ZMQ sockets
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
-from CS6381_MW.Common import PinguMW
+from CS6381_MW.Common import PinguMW, FORMAT_BINARY, BROKER_FRAME
+from CS6381_MW.Forwarder import Forwarder, ShardPool
+from CS6381_MW.Telemetry import Telemetry
 
 class BrokerMW(PinguMW):
     def __init__ (self, logger):
         super().__init__(logger)
         self.req = None # will be a ZMQ REQ socket to talk to Discovery service
-        self.pub = None # will be a ZMQ XPUB socket for representing publisher
-        self.sub = None # will be a ZMQ XSUB socket for representing publisher
+        self.pub = None # will be a ZMQ PUB socket for representing publisher (Inline engine)
+        self.sub = None # will be a ZMQ SUB socket for representing subscriber (Inline engine)
+        self.forwarder = None # XSUB/XPUB forwarding thread (Forwarder engine)
+        self.publishers = {} # publisher id -> the connect string we use for it
         
     # configure/initialize
     def configure (self, args):
@@ -30,17 +34,49 @@ class BrokerMW(PinguMW):
             self.logger.info("BrokerMW::configure")
             self.port = args.port
             self.addr = args.addr
-            context = zmq.Context()  # returns a singleton object
+            config = self.read_config("BrokerMW", args)
+            broker = config["Broker"] if config.has_section("Broker") else {}
+            engine = broker.get("Engine", "Inline")
+            self.shards = int(broker.get("Shards", 1))
+            context = zmq.Context(io_threads=self.io_threads)
+            self.context = context
             self.poller = zmq.Poller()
-            self.req = context.socket(zmq.REQ)
-            self.pub = context.socket(zmq.PUB)
-            self.sub = context.socket(zmq.SUB)
+            self.req = self.socket(zmq.REQ)
             self.poller.register(self.req, zmq.POLLIN)
-            self.poller.register(self.sub, zmq.POLLIN)
-            connect_str = "tcp://" + args.discovery
+            connect_str = self.discovery_endpoint(args.discovery)
+            self.discovery = connect_str
             self.req.connect(connect_str)
-            bind_string = "tcp://*:" + str(self.port)
-            self.pub.bind(bind_string)
+            self.connect_replicas("BrokerMW")
+            if engine == "Forwarder" and self.shards > 1:
+                # topics are partitioned across worker processes; shard i binds port+i
+                # (and no inproc endpoint, which would only be reachable from its process)
+                bindings = [self.transport_endpoints(self.port + shard, inproc=False) for shard in range(self.shards)]
+                self.endpoints = [endpoint for bind_strings, endpoints in bindings for endpoint in endpoints]
+                self.forwarder = ShardPool(self.logger, context, self.port, self.shards, self.format, self.telemetry, self.recv_budget,
+                                           bind_strings=[bind_strings for bind_strings, endpoints in bindings],
+                                           socket_options=self.socket_options)
+                self.forwarder.start()
+            elif engine == "Forwarder":
+                # publications are moved by a dedicated thread, never by our event loop
+                bind_strings, self.endpoints = self.transport_endpoints(self.port)
+                # counters of their own: the forwarding thread must not add to ours while we report them
+                telemetry = Telemetry(self.logger, "Forwarder",
+                                      sample_rate=1 / self.telemetry.sample_every if self.telemetry.sample_every else 0.0,
+                                      report_interval=self.telemetry.report_interval)
+                self.forwarder = Forwarder(self.logger, context, bind_strings, self.format, telemetry, self.recv_budget,
+                                           socket_options=self.socket_options)
+                self.forwarder.start()
+            elif engine == "Inline":
+                self.pub = self.socket(zmq.PUB)
+                self.sub = self.socket(zmq.SUB)
+                self.sub.setsockopt_string(zmq.SUBSCRIBE, "") # we relay every topic
+                self.poller.register(self.sub, zmq.POLLIN)
+                self.data_socket = self.sub
+                self.endpoints = self.bind_endpoints(self.pub, self.port)
+            else:
+                raise ValueError("Unknown broker engine: {}".format(engine))
+            if self.shards > 1 and self.forwarder is None:
+                raise ValueError("Broker shards require the Forwarder engine")
             self.logger.info("BrokerMW::configure completed")
         except Exception as e:
             raise e
@@ -49,17 +85,23 @@ class BrokerMW(PinguMW):
     def event_loop(self, timeout=None):
         super().event_loop("BrokerMW", self.req, timeout)
     
-    def handle_reply(self):
+    # replies on the discovery socket, or on the socket of the read replicas
+    def handle_reply(self, socket=None):
         try:
             self.logger.info("BrokerMW::handle_reply")
-            bytesRcvd = self.req.recv()
+            bytesRcvd = (socket or self.req).recv()
             discovery_response = discovery_pb2.DiscoveryResp()
             discovery_response.ParseFromString(bytesRcvd)
+            if discovery_response.redirect:
+                return self.redirect("BrokerMW", discovery_response.redirect)
             if (discovery_response.msg_type == discovery_pb2.TYPE_REGISTER):
+                self.registered("BrokerMW", [discovery_response.register_resp])
+                self.connect_notifications("BrokerMW", discovery_response.register_resp.notify_port)
                 timeout = self.upcall_obj.register_response(discovery_response.register_resp)
             elif (discovery_response.msg_type == discovery_pb2.TYPE_ISREADY):
                 timeout = self.upcall_obj.isready_response(discovery_response.isready_resp)
             elif (discovery_response.msg_type == discovery_pb2.TYPE_LOOKUP_ALL_PUBS):
+                self.registry_version = discovery_response.allpubs_resp.version
                 timeout = self.upcall_obj.allPublishersResponse(discovery_response.allpubs_resp)
             else: 
                 raise ValueError ("Unrecognized response message")
@@ -79,24 +121,63 @@ class BrokerMW(PinguMW):
         
     def disable_event_loop(self):
         super().disable_event_loop()
+        if self.forwarder is not None:
+            self.forwarder.stop()
         
-    def receive_msg_sub(self):
+    # the data socket is readable: relay up to recv_budget messages without
+    # blocking, then return to the event loop. A message is the list of frames
+    # as received; the payload is never decoded here, so batches are relayed
+    # as they are and unpacked by the subscribers
+    def handle_data(self):
         try:
-            self.logger.info("BrokerMW::recv_msg_sub - receive messages")
-            msg = self.sub.recv_string()
-            self.logger.info("BrokerMW::recv_msg_sub - received message = {}".format (msg))   
-            return msg 
+            timeout = None
+            for _ in range(self.recv_budget):
+                try:
+                    msg = self.receive_msg_sub(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                timeout = self.upcall_obj.message_received(msg)
+            return timeout
+        except Exception as e:
+            raise e
+
+    def receive_msg_sub(self, flags=0):
+        try:
+            self.telemetry.maybe_report()
+            msg = self.sub.recv_multipart(flags, copy=False)
+            if self.format == FORMAT_BINARY:
+                self.gaps.track_frame(msg[1].bytes)
+            else:
+                self.gaps.track_string(msg[0].bytes.decode("utf-8"))
+            self.telemetry.count("messages_received")
+            if self.telemetry.sample():
+                self.logger.info("BrokerMW::recv_msg_sub - received message = {}".format (msg))
+            return msg
         except Exception as e:
             raise e
     
-    def send_msg_pub(self, send_str):
+    # relay a message received by receive_msg_sub, marking that it came from the broker:
+    # its frames (topic and PublicationBatch, or the string) are forwarded untouched
+    def send_msg_pub(self, msg):
         try:
-            self.logger.info("BrokerMW::send_msg_pub - disseminate messages to subscribers from broker")
-            self.logger.info("BrokerMW::send_msg_pub - {}".format (send_str))
-            self.pub.send(bytes(send_str, "utf-8"))
+            if self.format == FORMAT_BINARY:
+                self.pub.send_multipart(msg[:2] + [BROKER_FRAME], copy=False)
+            else:
+                self.pub.send_multipart(msg[:1] + [BROKER_FRAME], copy=False)
+            self.telemetry.count("messages_relayed")
         except Exception as e:
             raise e
     
+    # per-shard counters (sharded Forwarder engine only), logged and returned
+    def report_shards(self):
+        try:
+            stats = self.forwarder.stats()
+            for shard, counters in enumerate(stats):
+                self.logger.info("BrokerMW::report_shards - shard {} (port {}): {}".format(shard, self.port + shard, counters))
+            return stats
+        except Exception as e:
+            raise e
+
     def receiveAllPublishers(self):
         try:
             self.logger.info("BrokerMW::receiveAllPublishers - start")
@@ -105,12 +186,35 @@ class BrokerMW(PinguMW):
             discovery_request.msg_type = discovery_pb2.TYPE_LOOKUP_ALL_PUBS
             discovery_request.allpubs_req.CopyFrom(allpubs_request)
             buf2send = discovery_request.SerializeToString()
-            self.req.send(buf2send) 
+            self.send_request(buf2send, lookup=True)
             self.logger.info("BrokerMW::receiveAllPublishers - end")
         except Exception as e:
             raise e
     
-    def connect2pubs(self, IP, port):
-        connect_str = "tcp://" + IP + ":" + str(port)
+    # connect to a publisher, once
+    # over the cheapest transport we share
+    def connectPublisher(self, pub):
+        connect_str = self.endpoints_of(pub)[0]
+        if self.publishers.get(pub.id) == connect_str:
+            return
+        self.dropPublisher(pub.id) # it moved, if we knew it already
+        self.connect2pubs(connect_str)
+        self.publishers[pub.id] = connect_str
+
+    # disconnect from a publisher that is gone
+    def dropPublisher(self, id):
+        connect_str = self.publishers.pop(id, None)
+        if connect_str is None:
+            return
+        self.logger.info("BrokerMW::dropPublisher - disconnect from {}".format(connect_str))
+        if self.forwarder is not None:
+            self.forwarder.disconnect(connect_str)
+        else:
+            self.sub.disconnect(connect_str)
+
+    def connect2pubs(self, connect_str):
         self.logger.info("BrokerMW:: connect2pubs method. connect_str = {}".format(connect_str))
-        self.sub.connect(connect_str)
\ No newline at end of file
+        if self.forwarder is not None:
+            self.forwarder.connect(connect_str)
+        else:
+            self.sub.connect(connect_str)
\ No newline at end of file
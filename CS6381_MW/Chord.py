@@ -0,0 +1,69 @@
+# Consistent hashing ring used by the DHT discovery strategy ([Discovery]
+# Strategy=DHT). Every discovery node and every key (a topic, or the id of a
+# registrant) is hashed onto a ring of 2^bits positions; a key is owned by its
+# successor, the first node at or after it on the ring.
+#
+# As in Chord, a node only talks to the nodes of its finger table: finger i is
+# the successor of (node + 2^i). A request for a key that another node owns is
+# forwarded to the closest finger preceding the key, which halves the distance
+# left, so any key is reached in O(log N) hops.
+#
+# The membership is static: the nodes are listed in config.ini ([DHT] Nodes),
+# and each node derives its predecessor, successor and fingers from that list
+# rather than through Chord's join and stabilization protocol.
+
+import bisect # for the successor of a position on the ring
+import hashlib # for a hash that is stable across processes
+
+# position of a key (or of a node, by its "host:port") on a ring of 2^bits positions
+def ring_hash(key, bits):
+    return int.from_bytes(hashlib.sha256(key.encode("utf-8")).digest()[:8], "big") % (1 << bits)
+
+# is x in the ring interval (start, end]? The interval may wrap around zero
+def in_interval(x, start, end):
+    if start < end:
+        return start < x <= end
+    return x > start or x <= end # wraps (start == end: the whole ring)
+
+class ChordRing():
+    def __init__(self, nodes, me, bits=32):
+        self.bits = bits # the ring has 2^bits positions
+        self.me = me # our "host:port"
+        self.my_id = ring_hash(me, bits) # our position on the ring
+        positions = sorted((ring_hash(node, bits), node) for node in nodes)
+        if len(set(position for position, node in positions)) != len(positions):
+            raise ValueError("Two DHT nodes hash to the same ring position; use more bits")
+        if (self.my_id, me) not in positions:
+            raise ValueError("This node ({}) is not one of the DHT nodes".format(me))
+        self.ids = [position for position, node in positions]
+        self.nodes = [node for position, node in positions]
+        index = self.ids.index(self.my_id)
+        self.predecessor_id = self.ids[index - 1]
+        self.successor = self.nodes[(index + 1) % len(self.nodes)]
+        self.successor_id = self.ids[(index + 1) % len(self.ids)]
+        # finger i: (position, node) of the successor of my_id + 2^i
+        self.fingers = [self.successor_of((self.my_id + (1 << i)) % (1 << bits)) for i in range(bits)]
+
+    # (position, node) of the node owning a ring position
+    def successor_of(self, key):
+        index = bisect.bisect_left(self.ids, key) % len(self.ids)
+        return self.ids[index], self.nodes[index]
+
+    def key(self, name):
+        return ring_hash(name, self.bits)
+
+    def owns(self, key):
+        return len(self.ids) == 1 or in_interval(key, self.predecessor_id, self.my_id)
+
+    # node to send a request for key to, when we do not own it
+    def next_hop(self, key):
+        if in_interval(key, self.my_id, self.successor_id):
+            return self.successor # our successor owns it
+        for position, node in reversed(self.fingers):
+            if position != key and in_interval(position, self.my_id, key):
+                return node # closest finger preceding the key
+        return self.successor
+
+    # one key owned by each node, to visit every node (e.g. to add up counts)
+    def node_keys(self):
+        return list(self.ids)
@@ -10,9 +10,56 @@ import time   # for sleep
 import argparse # for argument parsing
 import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
+import math   # for rounding up the poll timeout
+import platform # for our host name, in our inproc endpoints
+import random # for the order in which we connect to the read replicas, and the isready retries
+import signal # to keep termination signals on the main thread
+import socket # to probe ipc endpoints
+import tempfile # for the default directory of the ipc endpoints
+import threading # for the heartbeat thread
 import zmq  # ZMQ sockets
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
+from CS6381_MW.Telemetry import Telemetry, SequenceGaps
+from CS6381_MW.AsyncCore import AsyncCore
+
+# Wire formats for the data plane, selected by [Dissemination] Format in config.ini
+FORMAT_STRING = "String" # topic:id:data:time strings (the original format)
+FORMAT_BINARY = "Binary" # multipart [topic frame, serialized PublicationBatch]
+
+# Extra frame the broker appends to binary messages to mark provenance
+BROKER_FRAME = b"(from broker)"
+
+# Dissemination strategies, selected by [Dissemination] Strategy
+STRATEGIES = ["Direct", "Broker", "Multicast"]
+
+# Mean msecs before an isready answered false is sent again. A REP discovery
+# server answers false right away rather than holding the request, so the
+# clients ask again soon, each after a random share of twice this so that
+# they do not all come back at once
+READY_RETRY = 50
+
+# Largest UDP payload over IPv4: the bound of a message with Strategy=Multicast
+MAX_DATAGRAM = 65507
+
+# Transports of the data plane, cheapest first, selected by [Transport] Offer
+TRANSPORTS = ["inproc", "ipc", "tcp"]
+
+# Addresses meaning "this host"
+LOCAL_ADDRS = ("localhost", "127.0.0.1")
+
+# Socket options of the transport profiles ([Transport] and [Transport.<Role>])
+SOCKET_OPTIONS = {
+    "SndHwm": zmq.SNDHWM,
+    "RcvHwm": zmq.RCVHWM,
+    "SndBuf": zmq.SNDBUF,
+    "RcvBuf": zmq.RCVBUF,
+    "Linger": zmq.LINGER,
+    "TcpKeepalive": zmq.TCP_KEEPALIVE,
+    "TcpKeepaliveIdle": zmq.TCP_KEEPALIVE_IDLE,
+    "TcpKeepaliveIntvl": zmq.TCP_KEEPALIVE_INTVL,
+    "TcpKeepaliveCnt": zmq.TCP_KEEPALIVE_CNT,
+}
 
 class PinguMW():
     def __init__(self, logger):
@@ -22,57 +69,347 @@ class PinguMW():
         self.port = None # port num where we are going to publish our topics
         self.upcall_obj = None # handle to appln obj to handle appln-specific data
         self.handle_events = True # in general we keep going thru the event loop
+        self.format = FORMAT_STRING # wire format used on the data plane
+        self.batch_size = 1 # max publications per message; 1 disables batching
+        self.batch_linger = 0.0 # max secs a publication may wait in a batch
+        self.telemetry = None # counters and sampled logging for the data plane
+        self.gaps = None # counts the publications dropped before reaching us (hwm_drops)
+        self.data_socket = None # secondary socket (publications, worker replies), serviced by handle_data
+        self.recv_budget = 100 # max messages drained per readable event on the data socket
+        self.shards = 1 # number of consecutive ports we publish on (sharded broker)
+        self.context = None # our ZMQ context
+        self.discovery_host = None # host of the discovery service
+        self.notify_socket = None # SUB socket for the registry changes, serviced by handle_notification
+        self.registry_version = None # registry version our view reflects; None until we have a snapshot
+        self.discovery = None # connect string of the discovery service
+        self.registrations = {} # id -> RegisterReq of the entities we registered, to renew or redo them
+        self.pending = [] # (middleware object, id) of our outstanding register (or register batch) request
+        self.heartbeat = None # thread renewing the leases of our registrations (of the host agent's, if hosted)
+        self.peer_sockets = {} # node -> DEALER socket to another discovery node (DHT strategy)
+        self.replicas = [] # host:port of the read replicas of the discovery service
+        self.lookup_socket = None # REQ socket spreading our lookups over the replicas, serviced by handle_reply
+        self.last_request = None # our outstanding request to the discovery service, to redirect it
+        self.loop_engine = "Poller" # Poller: event_loop below; Asyncio: see AsyncCore.py
+        self.transports = TRANSPORTS # transports we offer and use, cheapest first
+        self.ipc_dir = os.path.join(tempfile.gettempdir(), "cs6381") # where our ipc endpoints live
+        self.endpoints = [] # every endpoint we are bound to, cheapest first, as we advertise them
+        self.socket_options = {} # ZMQ option -> value, from the transport profile of our role
+        self.io_threads = 1 # I/O threads of our ZMQ context, from the same profile
+        self.strategy = "Direct" # how publications reach the subscribers, one of STRATEGIES
+        self.group_interface = "127.0.0.1" # address of the interface we send and join multicast groups on
+        self.group_ttl = 1 # hops our multicast datagrams may travel
+        self.groups = {} # topic -> (multicast group, port), as assigned by the discovery service
+        self.group_socket = None # UDP socket of the multicast groups (Strategy=Multicast)
+        self.groups_joined = set() # groups group_socket is a member of
+        self.host = None # HostMW of the host agent that adopted us, if any
+
+    # read the system wide configuration file and pick the data-plane settings
+    def read_config(self, name_of_MW, args):
+        try:
+            config = configparser.ConfigParser()
+            config.read(args.config)
+            telemetry = config["Telemetry"] if config.has_section("Telemetry") else {}
+            self.telemetry = Telemetry(self.logger, name_of_MW,
+                                       sample_rate=float(telemetry.get("SampleRate", 0.0)),
+                                       report_interval=float(telemetry.get("ReportInterval", 10.0)))
+            self.gaps = SequenceGaps(self.telemetry)
+            if config.has_section("Dissemination"):
+                self.format = config["Dissemination"].get("Format", FORMAT_STRING)
+                self.batch_size = config["Dissemination"].getint("BatchSize", 1)
+                self.batch_linger = config["Dissemination"].getfloat("BatchLinger", 0.0) / 1000
+                self.recv_budget = config["Dissemination"].getint("ReceiveBudget", 100)
+                self.strategy = config["Dissemination"].get("Strategy", "Direct")
+            if self.strategy not in STRATEGIES:
+                raise ValueError("Unknown dissemination strategy: {}".format(self.strategy))
+            if config.has_section("Multicast"):
+                self.group_interface = config["Multicast"].get("Interface", "") or self.group_interface
+                self.group_ttl = config["Multicast"].getint("Ttl", 1)
+            if self.format not in (FORMAT_STRING, FORMAT_BINARY):
+                raise ValueError("Unknown dissemination format: {}".format(self.format))
+            if self.batch_size > 1 and self.format != FORMAT_BINARY:
+                raise ValueError("Batching requires the Binary dissemination format")
+            if config.has_section("Middleware"):
+                self.loop_engine = config["Middleware"].get("EventLoop", "Poller")
+            if self.loop_engine not in ("Poller", "Asyncio"):
+                raise ValueError("Unknown event loop: {}".format(self.loop_engine))
+            if config.has_section("Transport"):
+                offer = [transport.strip() for transport in config["Transport"].get("Offer", ",".join(TRANSPORTS)).split(",") if transport.strip()]
+                unknown = set(offer) - set(TRANSPORTS)
+                if unknown:
+                    raise ValueError("Unknown transport(s): {}".format(", ".join(sorted(unknown))))
+                # tcp is always on: it is the only one reaching other hosts
+                self.transports = [transport for transport in TRANSPORTS if transport in offer or transport == "tcp"]
+                self.ipc_dir = config["Transport"].get("IpcDir", "") or self.ipc_dir
+            self.read_profile(config, "Transport." + name_of_MW[:-len("MW")])
+            if config.has_section("Replication"):
+                self.replicas = [replica.strip() for replica in config["Replication"].get("Replicas", "").split(",") if replica.strip()]
+            return config
+        except Exception as e:
+            raise e
         
-    # run the event loop where we expect to receive sth
+    # The transport profile of our role: the settings of [Transport] overridden
+    # by those of its own section, e.g. [Transport.Publisher]. An empty or
+    # missing setting keeps the ZMQ default
+    def read_profile(self, config, section):
+        profile = {}
+        for name in (["Transport"] if config.has_section("Transport") else []) + ([section] if config.has_section(section) else []):
+            profile.update((key, value) for key, value in config[name].items() if value.strip())
+        self.socket_options = {}
+        for key, option in SOCKET_OPTIONS.items():
+            if key.lower() in profile:
+                self.socket_options[option] = int(profile[key.lower()])
+        self.io_threads = int(profile.get("iothreads", 1))
+
+    # a socket of our context, tuned with the options of our transport profile
+    def socket(self, socket_type):
+        socket = self.context.socket(socket_type)
+        for option, value in self.socket_options.items():
+            socket.setsockopt(option, value)
+        return socket
+
+    # run the event loop where we expect to receive sth. timeout (msecs) is when
+    # the application's invoke_operation upcall is due. A handler or upcall
+    # returning a timeout sets a new due time and one returning None keeps the
+    # pending one; invoke_operation runs once it is due whether or not the poll
+    # returned events, so a steady flow of messages cannot hold it off
     def event_loop(self, name_of_MW, zmq_socket, timeout=None):
         try:
+            if self.loop_engine == "Asyncio":
+                return AsyncCore(self, name_of_MW, zmq_socket).run(timeout)
             logmsg = str(name_of_MW) + "::event_loop - run the event loop"
             self.logger.info(logmsg)
+            deadline = None if timeout is None else time.monotonic() + timeout / 1000
             while self.handle_events:  
-                events = dict(self.poller.poll (timeout=timeout))
+                if deadline is None:
+                    events = dict(self.poller.poll())
+                else: # rounded up so that we do not wake up just before it
+                    events = dict(self.poller.poll(timeout=max(0, math.ceil((deadline - time.monotonic()) * 1000))))
+                timeouts = [] # returned by the handlers of the sockets with input
                 if name_of_MW == "PublisherMW" or name_of_MW == "SubscriberMW" or name_of_MW == "BrokerMW":
-                    if not events:  # it starts with a True value
-                        timeout = self.upcall_obj.invoke_operation()
-                    elif zmq_socket in events: 
-                        timeout = self.handle_reply()
+                    # drain a bounded batch of publications and come back here, so
+                    # replies on the request socket are never starved
+                    if self.data_socket is not None and self.data_socket in events:
+                        timeouts.append(self.handle_data())
+                    if self.notify_socket is not None and self.notify_socket in events:
+                        timeouts.append(self.handle_notification())
+                    if zmq_socket in events:
+                        timeouts.append(self.handle_reply())
+                    if self.lookup_socket is not None and self.lookup_socket in events:
+                        timeouts.append(self.handle_reply(self.lookup_socket))
                 elif name_of_MW == "DiscoveryMW":
+                    if self.data_socket is not None and self.data_socket in events:
+                        timeouts.append(self.handle_data())
+                    if self.peer_sockets and not events.keys().isdisjoint(self.peer_sockets.values()):
+                        timeouts.append(self.handle_peers(events))
+                    if self.notify_socket is not None and self.notify_socket in events:
+                        timeouts.append(self.handle_notification()) # replication log (read replica)
                     if zmq_socket in events:
-                        timeout = self.handle_request()
+                        timeouts.append(self.handle_request())
                 else:
                     raise Exception("Unknown event after poll")
+                for timeout in timeouts:
+                    if timeout is not None:
+                        deadline = time.monotonic() + timeout / 1000
+                # the timers of the application, e.g. held requests and leases
+                if self.handle_events and deadline is not None and time.monotonic() >= deadline:
+                    timeout = self.upcall_obj.invoke_operation()
+                    deadline = None if timeout is None else time.monotonic() + timeout / 1000
             logmsg = str(name_of_MW) + "::event_loop - out of the event loop"
             self.logger.info(logmsg)
         except Exception as e:
             raise e
     
+    # The handlers of the sockets we currently have, as socket -> a callable
+    # returning the next timeout (None keeps the pending one). For the event
+    # loops serving sockets one by one (AsyncCore, HostMW) rather than with the
+    # name_of_MW dispatch above
+    def handlers(self, name_of_MW, zmq_socket):
+        table = {}
+        if name_of_MW == "DiscoveryMW":
+            table[zmq_socket] = self.handle_request
+        else:
+            table[zmq_socket] = self.handle_reply
+        if self.data_socket is not None:
+            table[self.data_socket] = self.handle_data
+        if self.notify_socket is not None:
+            table[self.notify_socket] = self.handle_notification
+        if self.lookup_socket is not None:
+            table[self.lookup_socket] = lambda: self.handle_reply(self.lookup_socket)
+        for socket in self.peer_sockets.values():
+            table[socket] = lambda socket=socket: self.handle_peers({socket: zmq.POLLIN})
+        return table
+
     def register(self, name_of_MW, name, topiclist):
         try:
             self.logger.info(str(name_of_MW) + "::register - start")
-            reg_info = discovery_pb2.RegistrantInfo()
-            reg_info.id = name  # ID
-            reg_info.addr = self.addr  # IP 
-            reg_info.port = self.port # PORT
-            register_req = discovery_pb2.RegisterReq()  
-            
-            if name_of_MW == "SubscriberMW":
-                register_req.role = discovery_pb2.ROLE_SUBSCRIBER  # we are a subscriber
-            elif name_of_MW == "PublisherMW": 
-                register_req.role = discovery_pb2.ROLE_PUBLISHER  # we are a publisher
-            elif name_of_MW == "BrokerMW":
-                register_req.role = discovery_pb2.ROLE_BOTH # we are a broker
-                
-            register_req.info.CopyFrom(reg_info)  
-            register_req.topiclist[:] = topiclist  
+            register_req = self.register_req(name_of_MW, name, self.addr, self.port, topiclist)
+            self.registrations[name] = register_req
+            self.pending = [(self, name)]
             disc_req = discovery_pb2.DiscoveryReq() 
             disc_req.msg_type = discovery_pb2.TYPE_REGISTER  
             disc_req.register_req.CopyFrom(register_req)
             self.logger.info(str(name_of_MW) + "::register - done building the outer message")
             buf2send = disc_req.SerializeToString()
-            self.req.send(buf2send) 
+            self.send_request(buf2send)
             self.logger.info(str(name_of_MW) + "::register - sent register message and now wait for reply")
         except Exception as e:
             raise e
+
+    # register many entities hosted by this process in one round trip, on
+    # behalf of the middleware objects of a host agent (HostMW). registrants is
+    # a list of (middleware object, name, topiclist); each object has its own
+    # registration, result and upcall, see registered_batch
+    def register_batch(self, name_of_MW, registrants):
+        try:
+            self.logger.info(str(name_of_MW) + "::register_batch - {} entities".format(len(registrants)))
+            disc_req = discovery_pb2.DiscoveryReq()
+            disc_req.msg_type = discovery_pb2.TYPE_REGISTER_BATCH
+            self.pending = []
+            for mw, name, topiclist in registrants:
+                if mw is not self and (self.host is None or mw.host is not self.host):
+                    raise ValueError("{} is not hosted by our host agent".format(name))
+                mw.registrations[name] = mw.register_req(name_of_MW, name, mw.addr, mw.port, topiclist)
+                self.pending.append((mw, name))
+                disc_req.register_batch_req.entries.append(mw.registrations[name])
+            buf2send = disc_req.SerializeToString()
+            self.send_request(buf2send)
+            self.logger.info(str(name_of_MW) + "::register_batch - sent register message and now wait for reply")
+        except Exception as e:
+            raise e
+
+    # build the RegisterReq of one entity
+    def register_req(self, name_of_MW, name, addr, port, topiclist):
+        reg_info = discovery_pb2.RegistrantInfo()
+        reg_info.id = name  # ID
+        reg_info.addr = addr  # IP 
+        reg_info.port = port # PORT
+        if self.shards > 1:
+            reg_info.shards = self.shards # PORTs port .. port+shards-1
+        if (addr, port) == (self.addr, self.port):
+            reg_info.endpoints[:] = self.endpoints # the same, over every transport we offer
+        register_req = discovery_pb2.RegisterReq()  
+        
+        if name_of_MW == "SubscriberMW":
+            register_req.role = discovery_pb2.ROLE_SUBSCRIBER  # we are a subscriber
+        elif name_of_MW == "PublisherMW": 
+            register_req.role = discovery_pb2.ROLE_PUBLISHER  # we are a publisher
+        elif name_of_MW == "BrokerMW":
+            register_req.role = discovery_pb2.ROLE_BOTH # we are a broker
+            
+        register_req.info.CopyFrom(reg_info)  
+        register_req.topiclist[:] = topiclist  
+        return register_req
     
+    # Called with the RegisterResp(s) answering our outstanding register request.
+    # Failed registrations are forgotten; once a registration has succeeded under
+    # a lease its leases are renewed, by a heartbeat thread of its middleware
+    # object or, for the objects of a host agent, by one thread for all of them
+    def registered(self, name_of_MW, results):
+        for (mw, name), result in zip(self.pending, results):
+            owner = mw.host if mw.host is not None else mw
+            if result.status != discovery_pb2.STATUS_SUCCESS:
+                mw.registrations.pop(name, None)
+            elif result.lease_ms and owner.heartbeat is None:
+                owner.heartbeat = threading.Thread(target=mw.heartbeat_loop, args=(name_of_MW, result.lease_ms), name="Heartbeat", daemon=True)
+                owner.heartbeat.start()
+            for group in result.groups:
+                mw.groups[group.topic] = (group.group, group.port)
+        self.pending = []
+
+    # Called with the RegisterBatchResp answering our register_batch. Every
+    # registrant gets its own result through its register_result; the timeout
+    # its upcall returns schedules its invoke_operation. Ours is returned to
+    # the event loop, those of the others go to the host agent's loop
+    def registered_batch(self, name_of_MW, batch_resp):
+        try:
+            registrants = [mw for mw, name in self.pending]
+            self.registered(name_of_MW, batch_resp.results)
+            timeout = None
+            for mw, result in zip(registrants, batch_resp.results):
+                if mw is self:
+                    timeout = self.register_result(result)
+                else:
+                    mw_timeout = mw.register_result(result)
+                    if mw_timeout is not None: # else the pending one is kept
+                        self.host.set_timeout(mw, mw_timeout)
+            return timeout
+        except Exception as e:
+            raise e
+
+    # hand the result of our registration to the application
+    def register_result(self, result):
+        return self.upcall_obj.register_response(result)
+
+    # Body of the heartbeat thread. Our own REQ socket keeps the heartbeats out
+    # of the application's request/reply sequence and off its event loop, which
+    # may be busy (a publisher disseminates from within an upcall). Leases are
+    # renewed three times per lease time, with one heartbeat per role for the
+    # registrations of every middleware object we serve: ours, or those of all
+    # the objects of our host agent that are still running. Registrations the
+    # discovery service reports expired are redone in one batch per role. With
+    # no reply within a lease time the socket is replaced (a REQ socket cannot
+    # send again before it has a reply).
+    def heartbeat_loop(self, name_of_MW, lease_ms):
+        try:
+            signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM, signal.SIGINT})
+            mws = [self] if self.host is None else None
+            socket = None
+            while True:
+                served = mws or [mw for mw, _ in self.host.hosted]
+                if not any(mw.handle_events for mw in served):
+                    break
+                time.sleep(lease_ms / 3000)
+                if socket is None:
+                    socket = self.socket(zmq.REQ)
+                    socket.connect(self.discovery)
+                roles = {} # role -> id -> RegisterReq
+                for mw in served:
+                    if mw.handle_events:
+                        for id, register_req in dict(mw.registrations).items():
+                            roles.setdefault(register_req.role, {})[id] = register_req
+                for role, registrations in roles.items():
+                    disc_req = discovery_pb2.DiscoveryReq()
+                    disc_req.msg_type = discovery_pb2.TYPE_HEARTBEAT
+                    disc_req.heartbeat_req.role = role
+                    disc_req.heartbeat_req.ids[:] = list(registrations)
+                    discovery_response = self.heartbeat_request(name_of_MW, socket, disc_req, lease_ms)
+                    if discovery_response is None:
+                        socket.close(linger=0)
+                        socket = None
+                        break
+                    lease_ms = discovery_response.heartbeat_resp.lease_ms or lease_ms
+                    expired = [registrations[id] for id in discovery_response.heartbeat_resp.expired if id in registrations]
+                    if not expired:
+                        continue
+                    self.logger.warning(str(name_of_MW) + "::heartbeat_loop - {} lease(s) expired, registering again".format(len(expired)))
+                    disc_req = discovery_pb2.DiscoveryReq()
+                    disc_req.msg_type = discovery_pb2.TYPE_REGISTER_BATCH
+                    disc_req.register_batch_req.entries.extend(expired)
+                    if self.heartbeat_request(name_of_MW, socket, disc_req, lease_ms) is None:
+                        socket.close(linger=0)
+                        socket = None
+                        break
+            if socket is not None:
+                socket.close(linger=0)
+        except Exception as e:
+            self.logger.error(str(name_of_MW) + "::heartbeat_loop - stopped: {}".format(e))
+            raise e
+
+    # send a request of the heartbeat thread and wait up to a lease time for
+    # the reply; None if it did not come
+    def heartbeat_request(self, name_of_MW, socket, disc_req, lease_ms):
+        socket.send(disc_req.SerializeToString())
+        if not socket.poll(lease_ms):
+            self.logger.warning(str(name_of_MW) + "::heartbeat_loop - no reply from the discovery service")
+            return None
+        discovery_response = discovery_pb2.DiscoveryResp()
+        discovery_response.ParseFromString(socket.recv())
+        return discovery_response
+
+    # msecs to wait before asking again after an isready answered false
+    def ready_retry(self):
+        return int(random.uniform(0.5, 1.5) * READY_RETRY)
+
     def is_ready(self, name_of_MW):
         ''' register the appln with the discovery service '''
         try:
@@ -83,11 +420,222 @@ class PinguMW():
             disc_req.isready_req.CopyFrom(isready_req)
             buf2send = disc_req.SerializeToString()
             self.logger.info("Stringified serialized buf = {}".format (buf2send))
-            self.req.send(buf2send)  # we use the "send" method of ZMQ that sends the bytes
+            self.send_request(buf2send)  # we use the "send" method of ZMQ that sends the bytes
             self.logger.info(str(name_of_MW) + "::is_ready - request sent and now wait for reply")
         except Exception as e:
             raise e
     
+    # The bind strings for a port over every transport we offer, and the
+    # endpoints to advertise for them, cheapest first. Our ipc and inproc
+    # endpoints are named after our advertised address and the port, like the
+    # tcp one; inproc=False leaves out the inproc one (e.g. for a socket bound
+    # by another process)
+    def transport_endpoints(self, port, inproc=True):
+        bind_strings = ["tcp://*:{}".format(port)]
+        endpoints = ["tcp://{}:{}".format(self.addr, port)]
+        if "ipc" in self.transports:
+            os.makedirs(self.ipc_dir, exist_ok=True)
+            endpoint = "ipc://{}/{}-{}".format(self.ipc_dir, self.addr, port)
+            bind_strings.append(endpoint)
+            endpoints.insert(0, endpoint)
+        if inproc and "inproc" in self.transports:
+            endpoint = "inproc://{}/{}-{}".format(self.process_tag(), self.addr, port)
+            bind_strings.append(endpoint)
+            endpoints.insert(0, endpoint)
+        return bind_strings, endpoints
+
+    # bind a socket on a port over every transport we offer; returns the endpoints
+    def bind_endpoints(self, socket, port):
+        bind_strings, endpoints = self.transport_endpoints(port)
+        for bind_string in bind_strings:
+            socket.bind(bind_string)
+        return endpoints
+
+    # prefix of our inproc endpoints: only the sockets of our ZMQ context (so
+    # of our process) can connect to them
+    def process_tag(self):
+        return "{}-{}-{}".format(platform.node(), os.getpid(), id(self.context))
+
+    # The endpoints to reach a registrant by, over the cheapest transport both
+    # of us offer: inproc within our ZMQ context, ipc on our host (we advertise
+    # the same address and something listens on its socket files), tcp
+    # otherwise. There is one endpoint per port of a sharded broker.
+    # Registrants advertising no endpoints are reached over tcp
+    def endpoints_of(self, info):
+        offered = {}
+        for endpoint in info.endpoints:
+            offered.setdefault(endpoint.split("://")[0], []).append(endpoint)
+        inproc = offered.get("inproc", [])
+        if "inproc" in self.transports and inproc and all(endpoint.startswith("inproc://{}/".format(self.process_tag())) for endpoint in inproc):
+            return inproc
+        ipc = offered.get("ipc", [])
+        if "ipc" in self.transports and ipc and self.same_host(info.addr) and all(self.listening(endpoint[len("ipc://"):]) for endpoint in ipc):
+            return ipc
+        return offered.get("tcp") or ["tcp://{}:{}".format(info.addr, port) for port in range(info.port, info.port + max(1, info.shards))]
+
+    # does an advertised address designate our host?
+    def same_host(self, addr):
+        return addr == self.addr or (addr in LOCAL_ADDRS and self.addr in LOCAL_ADDRS)
+
+    # Connect string of the discovery service, given as host:port or as a ZMQ
+    # endpoint. A discovery service on our host is reached over ipc when it
+    # offers it
+    def discovery_endpoint(self, discovery):
+        if "://" in discovery:
+            self.discovery_host = discovery[len("tcp://"):].split(":")[0] if discovery.startswith("tcp://") else "localhost"
+            return discovery
+        host, port = discovery.split(":")
+        self.discovery_host = host
+        path = os.path.join(self.ipc_dir, "{}-{}".format(host, port))
+        if "ipc" in self.transports and self.same_host(host) and self.listening(path):
+            return "ipc://" + path
+        return "tcp://" + discovery
+
+    # Does a process listen on the socket file of an ipc endpoint? The file of
+    # one that died is left behind, and ZMQ would keep retrying to connect to it
+    def listening(self, path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(path)
+            return True
+        except OSError:
+            return False
+        finally:
+            probe.close()
+
+    # UDP socket a publisher sends its datagrams to the multicast groups on
+    # (Strategy=Multicast), through our interface. Datagrams are looped back to
+    # the members of the groups on our own host too
+    def multicast_sender(self):
+        sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.tune_datagrams(sender)
+        sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.group_interface))
+        sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, self.group_ttl)
+        sender.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        sender.setblocking(False)
+        return sender
+
+    # Join the multicast group of a topic (once). The first group creates our
+    # UDP socket, bound to the port of the groups and polled as our data socket;
+    # the subscribers on a host all bind that port and each gets a copy of the
+    # datagrams of the groups it joined
+    def join_group(self, name_of_MW, topic):
+        if topic not in self.groups:
+            raise ValueError("No multicast group assigned to topic {}".format(topic))
+        group, port = self.groups[topic]
+        if self.group_socket is None:
+            self.group_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.group_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if sys.platform.startswith("linux"):
+                # only the groups this socket joined, not every group joined on the host
+                self.group_socket.setsockopt(socket.IPPROTO_IP, getattr(socket, "IP_MULTICAST_ALL", 49), 0)
+            self.tune_datagrams(self.group_socket)
+            self.group_socket.bind(("", port))
+            self.group_socket.setblocking(False)
+            self.data_socket = self.group_socket.fileno() # the poller reports plain sockets by descriptor
+            self.poller.register(self.data_socket, zmq.POLLIN)
+        elif self.group_socket.getsockname()[1] != port:
+            raise ValueError("Multicast group {} is on port {}, ours are on {}".format(group, port, self.group_socket.getsockname()[1]))
+        if group not in self.groups_joined:
+            self.logger.info("{}::join_group - join {}:{} for {}".format(name_of_MW, group, port, topic))
+            self.group_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                         socket.inet_aton(group) + socket.inet_aton(self.group_interface))
+            self.groups_joined.add(group)
+
+    # kernel buffers of a UDP socket, from SndBuf and RcvBuf of our transport
+    # profile; a datagram that does not fit the receiver's buffer is lost
+    def tune_datagrams(self, udp_socket):
+        for option, name in ((zmq.SNDBUF, socket.SO_SNDBUF), (zmq.RCVBUF, socket.SO_RCVBUF)):
+            if self.socket_options.get(option, -1) > 0:
+                udp_socket.setsockopt(socket.SOL_SOCKET, name, self.socket_options[option])
+
+    # send a request to the discovery service; lookups go to its read replicas
+    # when there are some
+    def send_request(self, buf2send, lookup=False):
+        if lookup and self.lookup_socket is not None:
+            self.lookup_socket.send(buf2send)
+            return
+        self.last_request = buf2send
+        self.req.send(buf2send)
+
+    # a REQ socket connected to every read replica: ZMQ hands each request to
+    # the next replica in turn, starting from the first one connected, which
+    # differs from client to client
+    def connect_replicas(self, name_of_MW):
+        try:
+            if not self.replicas:
+                return
+            self.logger.info(str(name_of_MW) + "::connect_replicas - lookups go to {}".format(", ".join(self.replicas)))
+            self.lookup_socket = self.socket(zmq.REQ)
+            for replica in random.sample(self.replicas, len(self.replicas)):
+                self.lookup_socket.connect("tcp://" + replica)
+            self.poller.register(self.lookup_socket, zmq.POLLIN)
+        except Exception as e:
+            raise e
+
+    # A read replica answered our request with the address of its primary
+    # (e.g. we were pointed at a replica): take this and all our further
+    # requests, heartbeats included, to the primary
+    def redirect(self, name_of_MW, primary):
+        try:
+            self.logger.info(str(name_of_MW) + "::redirect - the discovery service is at {}".format(primary))
+            self.req.disconnect(self.discovery)
+            self.discovery = "tcp://" + primary
+            self.discovery_host = primary.split(":")[0]
+            self.req.connect(self.discovery)
+            self.req.send(self.last_request)
+            return None
+        except Exception as e:
+            raise e
+
+    # follow the registry change notifications of the discovery service, if it
+    # offers them (it tells us the port in its reply to our registration)
+    def connect_notifications(self, name_of_MW, notify_port):
+        try:
+            if not notify_port or self.notify_socket is not None:
+                return
+            connect_str = "tcp://{}:{}".format(self.discovery_host, notify_port)
+            self.logger.info(str(name_of_MW) + "::connect_notifications - connect to {}".format(connect_str))
+            self.notify_socket = self.socket(zmq.SUB)
+            self.notify_socket.setsockopt(zmq.SUBSCRIBE, b"")
+            self.notify_socket.connect(connect_str)
+            self.poller.register(self.notify_socket, zmq.POLLIN)
+        except Exception as e:
+            raise e
+
+    # Apply the registry deltas that follow the snapshot we got from our last
+    # lookup (registry_version). Older deltas are already part of the snapshot.
+    # A gap in the sequence means we missed a change (e.g. one published before
+    # our SUB socket was connected): the application is asked to look up a fresh
+    # snapshot, and deltas are ignored until it arrives. The current event loop
+    # timeout is kept unless an upcall returns a new one.
+    def handle_notification(self):
+        try:
+            timeout = None
+            for _ in range(self.recv_budget):
+                try:
+                    bytesRcvd = self.notify_socket.recv(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                delta = discovery_pb2.RegistryDelta()
+                delta.ParseFromString(bytesRcvd)
+                if self.registry_version is None or delta.seq <= self.registry_version:
+                    continue
+                if delta.seq > self.registry_version + 1:
+                    self.telemetry.count("registry_gaps", delta.seq - self.registry_version - 1)
+                    self.logger.warning("{}::handle_notification - missed registry changes {}..{}, resync".format(
+                        self.telemetry.name, self.registry_version + 1, delta.seq - 1))
+                    self.registry_version = None
+                    timeout = self.upcall_obj.registry_resync()
+                    continue
+                self.registry_version = delta.seq
+                self.logger.info("{}::handle_notification - seq {}: {} {}".format(
+                    self.telemetry.name, delta.seq, discovery_pb2.ChangeType.Name(delta.change), delta.info.id))
+                timeout = self.upcall_obj.registry_changed(delta)
+            return timeout
+        except Exception as e:
+            raise e
+
     # here we save a pointer (handle) to the application object
     def set_upcall_handle(self, upcall_obj):
         ''' set upcall handle '''
@@ -95,4 +643,6 @@ class PinguMW():
         
     def disable_event_loop (self):
         ''' disable event loop '''
-        self.handle_events = False
\ No newline at end of file
+        self.handle_events = False
+        if self.telemetry is not None:
+            self.telemetry.report()
\ No newline at end of file
@@ -3,6 +3,35 @@
 # There will be a forever event loop waiting for requests. Each request will be parsed
 # and the application logic asked to handle the request. To that end, an upcall will need
 # to be made to the application logic.
+#
+# With [Discovery] Server=ROUTER the socket is a ROUTER instead. Requests from many
+# clients are then drained in one go, each reply is routed back by the envelope of
+# its request, and a handler may defer its reply (defer_reply) while the others keep
+# being served. REQ clients work unchanged; DEALER clients may pipeline requests.
+# LookupWorkers=N additionally hands the read-only lookups to N worker threads.
+#
+# With Notifications=True every change to the set of publishers is also streamed
+# on a PUB socket as a RegistryDelta, so clients can follow the registry without
+# polling it. Lookup replies carry the registry version they reflect.
+#
+# With [Dissemination] Strategy=Multicast the register replies also assign every
+# topic registered to a multicast group ([Multicast] in config.ini). A topic is
+# hashed onto the groups, so every discovery node (primary, read replica or DHT
+# node) assigns it to the same group without sharing any state.
+#
+# With [Discovery] Strategy=DHT the discovery service is a set of nodes forming a
+# Chord ring ([DHT] Nodes, see Chord.py). Clients talk to any node, as before. The
+# application splits their requests into DHT requests for the keys involved (the
+# id of a registrant, a topic) and route() delivers each to the node owning its
+# key: locally, or over DEALER sockets to the closest preceding finger, which in
+# turn forwards it from its ROUTER socket. Responses travel back the same way.
+#
+# With [Replication] Replicas set, the discovery service started normally is the
+# primary: every change to its registry is streamed as a JournalRecord on a PUB
+# socket (the replication log). A discovery service started with -R host:port is
+# a read replica of that primary. It loads the primary's registry (TYPE_REPLICATE),
+# follows the log, answers the lookups and redirects every other request to the
+# primary. Subscribers and brokers send their lookups to the replicas.
 
 # import the needed packages
 import os     # for OS functions
@@ -11,15 +40,41 @@ import time   # for sleep
 import argparse # for argument parsing
 import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
+import signal # to keep termination signals on the main thread
+import threading # for the lookup workers
+import ipaddress # for the multicast group addresses
+import zlib   # for a topic hash that is stable across processes
 import zmq  # ZMQ sockets
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
 from CS6381_MW.Common import PinguMW
+from CS6381_MW.Chord import ChordRing
 
 class DiscoveryMW(PinguMW):
     def __init__ (self, logger):
         super().__init__(logger)
-        self.rep = None # will be a ZMQ REP socket for reply
+        self.rep = None # will be a ZMQ REP (or ROUTER) socket for reply
+        self.server = "REP" # REP: strict lockstep; ROUTER: interleaved requests, deferrable replies
+        self.context = None # our ZMQ context, shared with the lookup workers
+        self.num_workers = 0 # threads serving read-only lookups (ROUTER only)
+        self.lookups = None # PUSH socket handing lookup requests to the workers
+        self.local = threading.local() # envelope and reply socket of the request being handled
+        self.reply_cache = {} # (msg_type, key) -> (registry version, serialized lookup reply)
+        self.cache_version = None # newest registry version seen by the cache
+        self.cache_lock = threading.Lock() # the lookup workers share the cache and the telemetry counters with the event loop
+        self.notify = None # PUB socket streaming registry changes to the clients
+        self.notify_port = 0 # its port, advertised in the register replies (0 if disabled)
+        self.lease_ms = 0 # lease time granted to the registrations (0: they never expire)
+        self.ring = None # our view of the Chord ring (DHT strategy only)
+        self.dht_tag = 0 # last tag given to a DHT request we sent
+        self.dht_pending = {} # tag -> callback of the DHT requests awaiting a response
+        self.log = None # PUB socket streaming the replication log (primary with replicas)
+        self.log_port = 0 # its port
+        self.log_seq = 0 # last log record published (primary) or applied (replica)
+        self.primary = None # host:port of our primary when we are a read replica
+        self.group_base = None # first multicast group address (Strategy=Multicast only)
+        self.num_groups = 0 # consecutive group addresses the topics are hashed onto
+        self.group_port = 0 # UDP port of the groups
         
     # configure/initialize
     def configure (self, args):
@@ -28,30 +83,181 @@ class DiscoveryMW(PinguMW):
             self.logger.info("DiscoveryMW::configure")
             self.port = args.port
             self.addr = args.addr
-            context = zmq.Context()  # returns a singleton object
+            config = self.read_config("DiscoveryMW", args)
+            discovery = config["Discovery"] if config.has_section("Discovery") else {}
+            self.server = discovery.get("Server", "REP")
+            self.num_workers = int(discovery.get("LookupWorkers", 0))
+            notifications = str(discovery.get("Notifications", "False")).lower() == "true"
+            self.lease_ms = int(float(discovery.get("LeaseTime", 0)) * 1000)
+            if self.strategy == "Multicast":
+                multicast = config["Multicast"] if config.has_section("Multicast") else {}
+                self.group_base = ipaddress.IPv4Address(multicast.get("GroupBase", "239.192.0.1"))
+                self.num_groups = int(multicast.get("Groups", 16))
+                self.group_port = int(multicast.get("Port", 7700))
+                if self.num_groups < 1 or not self.group_base.is_multicast or not (self.group_base + self.num_groups - 1).is_multicast:
+                    raise ValueError("Multicast groups {} + {} are not all multicast addresses".format(self.group_base, self.num_groups))
+            replication = config["Replication"] if config.has_section("Replication") else {}
+            replicas = [replica.strip() for replica in replication.get("Replicas", "").split(",") if replica.strip()]
+            if getattr(args, "replica_of", None):
+                # the primary streams the changes and leases the registrations
+                self.primary = args.replica_of
+                notifications = False
+                self.lease_ms = 0
+            if discovery.get("Strategy") == "DHT":
+                if replicas:
+                    raise ValueError("Read replicas are not supported with the DHT strategy")
+                if self.server != "ROUTER" or self.num_workers > 0:
+                    raise ValueError("The DHT strategy requires the ROUTER discovery server and no lookup workers")
+                dht = config["DHT"]
+                nodes = [node.strip() for node in dht["Nodes"].split(",") if node.strip()]
+                self.ring = ChordRing(nodes, "{}:{}".format(self.addr, self.port), bits=int(dht.get("Bits", 32)))
+                self.logger.info("DiscoveryMW::configure - DHT node {} at ring position {} of {} nodes".format(
+                    self.ring.me, self.ring.my_id, len(nodes)))
+                # the registry is spread over the nodes: no node can stream its
+                # changes or lease its registrations on its own
+                notifications = False
+                self.lease_ms = 0
+            context = zmq.Context(io_threads=self.io_threads)
+            self.context = context
             self.poller = zmq.Poller()
-            self.rep = context.socket(zmq.REP)
+            if self.server == "ROUTER":
+                self.rep = self.socket(zmq.ROUTER)
+            elif self.server == "REP":
+                self.rep = self.socket(zmq.REP)
+            else:
+                raise ValueError("Unknown discovery server type: {}".format(self.server))
             self.poller.register(self.rep, zmq.POLLIN)
-            bind_string = "tcp://*:" + str(self.port)
-            self.rep.bind(bind_string)
+            # clients on our host reach us over ipc
+            self.endpoints = self.bind_endpoints(self.rep, self.port)
+            if notifications:
+                # any free port will do; the clients learn it when they register
+                self.notify = self.socket(zmq.PUB)
+                self.notify_port = self.notify.bind_to_random_port("tcp://*")
+                self.logger.info("DiscoveryMW::configure - registry changes published on port {}".format(self.notify_port))
+            if replicas and self.primary is None:
+                self.log = self.socket(zmq.PUB)
+                self.log_port = self.log.bind_to_random_port("tcp://*")
+                self.logger.info("DiscoveryMW::configure - replication log published on port {}".format(self.log_port))
+            if self.num_workers > 0:
+                if self.server != "ROUTER":
+                    raise ValueError("Lookup workers require the ROUTER discovery server")
+                # lookups go out on a PUSH socket; the workers' replies come back on
+                # a PULL socket and are sent out by us, as only we may use the ROUTER
+                self.lookups = context.socket(zmq.PUSH)
+                self.lookups.bind("inproc://discovery-lookups-{}".format(id(self)))
+                self.data_socket = context.socket(zmq.PULL)
+                self.data_socket.bind("inproc://discovery-replies-{}".format(id(self)))
+                self.poller.register(self.data_socket, zmq.POLLIN)
             self.logger.info("DiscoveryMW::configure completed")
         except Exception as e:
             raise e
         
     # run the event loop where we expect to receive sth
     def event_loop(self, timeout=None):
+        for index in range(self.num_workers):
+            threading.Thread(target=self.lookup_worker, name="LookupWorker{}".format(index), daemon=True).start()
+        if self.primary is not None:
+            self.resync()
         super().event_loop("DiscoveryMW", self.rep, timeout)
         
     def handle_request(self):
         try:
             self.logger.info("DiscoveryMW::handle_request")
-            bytesRcvd = self.rep.recv()
+            if self.server == "REP":
+                return self.dispatch(self.rep.recv())
+            # ROUTER: serve every queued request, up to our budget, before going
+            # back to the event loop. REQ clients put an empty delimiter after
+            # their identity; DEALER clients must do the same.
+            timeout = 0
+            for _ in range(self.recv_budget):
+                try:
+                    frames = self.rep.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                if self.lookups is not None and self.is_lookup(frames[-1]):
+                    self.lookups.send_multipart(frames)
+                    continue
+                timeout = self.dispatch(frames[-1], frames[:-1])
+            return timeout
+        except Exception as e:
+            raise e
+
+    # does this serialized DiscoveryReq only read the registry?
+    def is_lookup(self, bytesRcvd):
+        disc_req = discovery_pb2.DiscoveryReq()
+        disc_req.ParseFromString(bytesRcvd)
+        return disc_req.msg_type in (discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC, discovery_pb2.TYPE_LOOKUP_ALL_PUBS)
+
+    # replies from the lookup workers, to be sent out on the ROUTER socket
+    def handle_data(self):
+        try:
+            for _ in range(self.recv_budget):
+                try:
+                    self.rep.send_multipart(self.data_socket.recv_multipart(zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+            return 0
+        except Exception as e:
+            raise e
+
+    # body of a lookup worker thread. The application's lookup handlers must
+    # only read the registry under its lock, as registrations keep being
+    # applied by the event loop thread
+    def lookup_worker(self):
+        try:
+            signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM, signal.SIGINT})
+            requests = self.context.socket(zmq.PULL)
+            requests.connect("inproc://discovery-lookups-{}".format(id(self)))
+            self.local.socket = self.context.socket(zmq.PUSH)
+            self.local.socket.connect("inproc://discovery-replies-{}".format(id(self)))
+            while True:
+                frames = requests.recv_multipart()
+                self.dispatch(frames[-1], frames[:-1])
+        except Exception as e:
+            self.logger.error("DiscoveryMW::lookup_worker - stopped: {}".format(e))
+            raise e
+
+    # A handler that cannot answer right away (ROUTER only) calls this and keeps
+    # the returned envelope; it later passes it as the envelope argument of the
+    # reply method, and meanwhile other requests keep being served
+    def can_defer(self):
+        return self.server == "ROUTER"
+
+    def defer_reply(self):
+        if self.server != "ROUTER":
+            raise ValueError("Deferred replies require the ROUTER discovery server")
+        envelope = self.local.envelope
+        self.local.envelope = None
+        return envelope
+
+    # send a serialized reply to the request being handled, or to a deferred one
+    def send_reply(self, buf2send, envelope=None):
+        if envelope is None:
+            envelope = getattr(self.local, "envelope", None)
+        if envelope is None:
+            self.rep.send(buf2send) # REP socket
+        else:
+            (getattr(self.local, "socket", None) or self.rep).send_multipart(envelope + [buf2send])
+
+    # parse a request and make the upcall for it. The envelope routes the reply
+    # back to its client in ROUTER mode
+    def dispatch(self, bytesRcvd, envelope=None):
+        try:
+            self.local.envelope = envelope
             disc_req = discovery_pb2.DiscoveryReq()
             disc_req.ParseFromString(bytesRcvd)
             self.logger.info("DiscoveryMW::handle_request - bytes received")
-            if (disc_req.msg_type == discovery_pb2.TYPE_REGISTER):
+            if self.primary is not None and disc_req.msg_type not in (discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC, discovery_pb2.TYPE_LOOKUP_ALL_PUBS):
+                self.send_redirect(disc_req.msg_type)
+                timeout = 0
+            elif (disc_req.msg_type == discovery_pb2.TYPE_REGISTER):
                 self.logger.info("DiscoveryMW::handle_request - register")
                 timeout = self.upcall_obj.register_request(disc_req.register_req)
+            elif (disc_req.msg_type == discovery_pb2.TYPE_REGISTER_BATCH):
+                self.logger.info("DiscoveryMW::handle_request - register batch")
+                timeout = self.upcall_obj.register_batch_request(disc_req.register_batch_req)
+            elif (disc_req.msg_type == discovery_pb2.TYPE_HEARTBEAT):
+                timeout = self.upcall_obj.heartbeat_request(disc_req.heartbeat_req)
             elif (disc_req.msg_type == discovery_pb2.TYPE_ISREADY):
                 self.logger.info("DiscoveryMW::handle_request - is ready")
                 timeout = self.upcall_obj.isready_request()
@@ -61,13 +267,29 @@ class DiscoveryMW(PinguMW):
             elif (disc_req.msg_type == discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC):
                 self.logger.info("DiscoveryMW::handle_request - pub by topic")
                 timeout = self.upcall_obj.handle_topic_request(disc_req.lookup_req)
+            elif (disc_req.msg_type == discovery_pb2.TYPE_DHT):
+                timeout = self.handle_dht(disc_req.dht_req)
+            elif (disc_req.msg_type == discovery_pb2.TYPE_REPLICATE):
+                self.logger.info("DiscoveryMW::handle_request - replicate")
+                timeout = self.upcall_obj.replicate_request()
             else: 
                 raise ValueError("Unrecognized response message")
             return timeout
         except Exception as e:
             raise e
     
-    def handle_register(self, status, reason):
+    # the multicast group of each topic, filled into a register reply
+    def assign_groups(self, register_response, topics):
+        if self.group_base is None:
+            return
+        for topic in topics:
+            group = register_response.groups.add()
+            group.topic = topic
+            group.group = str(self.group_base + zlib.crc32(topic.encode("utf-8")) % self.num_groups)
+            group.port = self.group_port
+
+    # topics: of the registration, for their multicast groups
+    def handle_register(self, status, reason, envelope=None, topics=()):
         try:
             self.logger.info("DiscoveryMW::handle_register:: check whether the registration has been successful")
             register_response = discovery_pb2.RegisterResp() 
@@ -76,17 +298,52 @@ class DiscoveryMW(PinguMW):
             else: # otherwise failure
                 register_response.status = discovery_pb2.Status.STATUS_FAILURE
             register_response.reason = reason
+            register_response.notify_port = self.notify_port
+            register_response.lease_ms = self.lease_ms
+            if status:
+                self.assign_groups(register_response, topics)
             discovery_response = discovery_pb2.DiscoveryResp()
             discovery_response.msg_type = discovery_pb2.TYPE_REGISTER
             discovery_response.register_resp.CopyFrom(register_response)
             buf2send = discovery_response.SerializeToString()
-            self.rep.send(buf2send)
+            self.send_reply(buf2send, envelope)
             self.logger.info("DiscoveryMW::handle_register:: registration status has been checked. plz check the message")
             return 0
         except Exception as e:
             raise e
         
-    def update_is_ready_status(self, is_ready):
+    # results holds one (status, reason) per entry of the batch, in order, and
+    # topiclists the topics of each entry
+    def handle_register_batch(self, results, envelope=None, topiclists=None):
+        try:
+            self.logger.info("DiscoveryMW::handle_register_batch:: {} results".format(len(results)))
+            discovery_response = discovery_pb2.DiscoveryResp()
+            discovery_response.msg_type = discovery_pb2.TYPE_REGISTER_BATCH
+            for index, (status, reason) in enumerate(results):
+                register_response = discovery_response.register_batch_resp.results.add()
+                register_response.status = discovery_pb2.Status.STATUS_SUCCESS if status else discovery_pb2.Status.STATUS_FAILURE
+                register_response.reason = reason
+                register_response.notify_port = self.notify_port
+                register_response.lease_ms = self.lease_ms
+                if status and topiclists is not None:
+                    self.assign_groups(register_response, topiclists[index])
+            buf2send = discovery_response.SerializeToString()
+            self.send_reply(buf2send, envelope)
+            return 0
+        except Exception as e:
+            raise e
+
+    def send_heartbeat_response(self, expired, envelope=None):
+        try:
+            discovery_response = discovery_pb2.DiscoveryResp()
+            discovery_response.msg_type = discovery_pb2.TYPE_HEARTBEAT
+            discovery_response.heartbeat_resp.expired[:] = expired
+            discovery_response.heartbeat_resp.lease_ms = self.lease_ms
+            self.send_reply(discovery_response.SerializeToString(), envelope)
+        except Exception as e:
+            raise e
+
+    def update_is_ready_status(self, is_ready, envelope=None):
         try:
             self.logger.info("DiscoveryMW::update_is_ready_status:: Start this method")
             ready_response = discovery_pb2.IsReadyResp() 
@@ -95,12 +352,54 @@ class DiscoveryMW(PinguMW):
             discovery_response.msg_type = discovery_pb2.TYPE_ISREADY
             discovery_response.isready_resp.CopyFrom(ready_response)
             buf2send = discovery_response.SerializeToString()
-            self.rep.send(buf2send)
+            self.send_reply(buf2send, envelope)
             self.logger.info("DiscoveryMW::update_is_ready_status:: is_ready status sent.")
         except Exception as e:
             raise e
 
-    def send_pubinfo_for_topic(self, pub_in_topic):
+    # Lookup replies are cached as serialized bytes, keyed by the lookup and the
+    # registry version they were built from, so identical lookups from a fleet of
+    # clients cost a single send. The application bumps its registry version on
+    # every change; replies built from an older version are dropped. With
+    # lookup workers these run on their threads, hence the lock.
+    def send_cached_reply(self, msg_type, key, version, envelope=None):
+        with self.cache_lock:
+            entry = self.reply_cache.get((msg_type, key))
+            if entry is None or entry[0] != version:
+                self.telemetry.count("lookup_cache_misses")
+                return False
+            self.telemetry.count("lookup_cache_hits")
+        self.send_reply(entry[1], envelope)
+        return True
+
+    def cache_reply(self, msg_type, key, version, buf2send):
+        with self.cache_lock:
+            if self.cache_version is None or version > self.cache_version:
+                self.reply_cache = {} # everything cached so far is stale
+                self.cache_version = version
+            self.reply_cache[(msg_type, key)] = (version, buf2send)
+
+    # stream a registry change to the clients; seq is the registry version after it
+    def publish_delta(self, seq, change, pub):
+        try:
+            if self.notify is None:
+                return
+            delta = discovery_pb2.RegistryDelta()
+            delta.seq = seq
+            delta.change = change
+            delta.info.id = pub[0] # name
+            delta.info.addr = pub[1] # addr
+            delta.info.port = pub[2] # port
+            delta.info.shards = pub[4] # consecutive ports of a sharded broker
+            delta.info.endpoints[:] = pub[5] # over every transport it offers
+            delta.topiclist[:] = pub[3]
+            self.notify.send(delta.SerializeToString())
+            self.telemetry.count("registry_deltas")
+            self.logger.info("DiscoveryMW::publish_delta - seq {}: {} {}".format(seq, discovery_pb2.ChangeType.Name(change), pub[0]))
+        except Exception as e:
+            raise e
+
+    def send_pubinfo_for_topic(self, pub_in_topic, envelope=None, version=0, cache_key=None):
         try:
             self.logger.info("DiscoveryMW::send_pubinfo_for_topic:: Start this method")
             lookup_response = discovery_pb2.LookupPubByTopicResp() 
@@ -109,17 +408,22 @@ class DiscoveryMW(PinguMW):
                 reg_info.id = pub[0] # name
                 reg_info.addr = pub[1] # addr
                 reg_info.port = pub[2] # port
+                reg_info.shards = pub[3] # consecutive ports of a sharded broker
+                reg_info.endpoints[:] = pub[4] # over every transport it offers
                 self.logger.info("DiscoveryMW::send_pubinfo_fo_topic:: Publisher address is tcp://{}:{}".format(reg_info.addr, reg_info.port))
+            lookup_response.version = version
             discovery_response = discovery_pb2.DiscoveryResp()
             discovery_response.msg_type = discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC
             discovery_response.lookup_resp.CopyFrom(lookup_response)
             buf2send = discovery_response.SerializeToString()
-            self.rep.send(buf2send)  
+            if cache_key is not None:
+                self.cache_reply(discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC, cache_key, version, buf2send)
+            self.send_reply(buf2send, envelope)
             self.logger.info ("DiscoveryMW::send_pubinfo_for_topic:: List of publishers sent")
         except Exception as e:
             raise e
     
-    def send_all_pub_list(self, pub_list):
+    def send_all_pub_list(self, pub_list, envelope=None, version=0, cache_key=None):
         try:
             self.logger.info ("DiscoveryMW::send_all_pub_list:: Start this method")
             lookup_response = discovery_pb2.LookupAllPubsResp()
@@ -128,18 +432,262 @@ class DiscoveryMW(PinguMW):
                 reg_info.id = pub[0] # name
                 reg_info.addr = pub[1] # addr
                 reg_info.port = pub[2] # port
+                reg_info.shards = pub[3] # consecutive ports of a sharded broker
+                reg_info.endpoints[:] = pub[4] # over every transport it offers
                 self.logger.info("DiscoveryMW::send_all_pub_list:: Publisher address is tcp://{}:{}".format(reg_info.addr, reg_info.port))
+            lookup_response.version = version
             discovery_response = discovery_pb2.DiscoveryResp()
             discovery_response.msg_type = discovery_pb2.TYPE_LOOKUP_ALL_PUBS
             discovery_response.allpubs_resp.CopyFrom(lookup_response)
             buf2send = discovery_response.SerializeToString()
-            self.rep.send(buf2send)
+            if cache_key is not None:
+                self.cache_reply(discovery_pb2.TYPE_LOOKUP_ALL_PUBS, cache_key, version, buf2send)
+            self.send_reply(buf2send, envelope)
         except Exception as e: 
             raise e
     
+    # primary: stream a change to the read replicas, in registry order
+    def replicate(self, op, role, entry):
+        try:
+            if self.log is None:
+                return
+            self.log_seq += 1
+            record = discovery_pb2.JournalRecord()
+            record.op = op
+            record.seq = self.log_seq
+            record.registration.role = role
+            record.registration.info.id = entry[0] # name
+            record.registration.info.addr = entry[1] # addr
+            record.registration.info.port = entry[2] # port
+            record.registration.info.shards = entry[4] # consecutive ports of a sharded broker
+            record.registration.info.endpoints[:] = entry[5] # over every transport it offers
+            record.registration.topiclist[:] = entry[3]
+            self.log.send(record.SerializeToString())
+            self.telemetry.count("replication_records")
+        except Exception as e:
+            raise e
+
+    # primary: answer a replica with the registry, a list of (role, entry), and
+    # the position in the log it corresponds to
+    def send_replica_snapshot(self, version, registrations):
+        try:
+            self.logger.info("DiscoveryMW::send_replica_snapshot - {} registrations at log seq {}".format(len(registrations), self.log_seq))
+            discovery_response = discovery_pb2.DiscoveryResp()
+            discovery_response.msg_type = discovery_pb2.TYPE_REPLICATE
+            replicate_response = discovery_response.replicate_resp
+            replicate_response.log_port = self.log_port
+            replicate_response.seq = self.log_seq
+            replicate_response.snapshot.version = version
+            for role, entry in registrations:
+                register_req = replicate_response.snapshot.registrations.add()
+                register_req.role = role
+                register_req.info.id = entry[0] # name
+                register_req.info.addr = entry[1] # addr
+                register_req.info.port = entry[2] # port
+                register_req.info.shards = entry[4] # consecutive ports of a sharded broker
+                register_req.info.endpoints[:] = entry[5] # over every transport it offers
+                register_req.topiclist[:] = entry[3]
+            self.send_reply(discovery_response.SerializeToString())
+            return 0
+        except Exception as e:
+            raise e
+
+    # replica: tell the client to take its request to the primary
+    def send_redirect(self, msg_type):
+        try:
+            discovery_response = discovery_pb2.DiscoveryResp()
+            discovery_response.msg_type = msg_type
+            discovery_response.redirect = self.primary
+            self.send_reply(discovery_response.SerializeToString())
+            self.telemetry.count("redirects")
+        except Exception as e:
+            raise e
+
+    # replica: load the registry of the primary. Once we know where the log is
+    # we stay subscribed to it, so the records following the snapshot queue up
+    # while we load it (the first time some may be missed, which the next
+    # record reveals as a gap and which brings us back here). We cannot serve
+    # without a registry, so we keep asking until the primary answers
+    def resync(self):
+        try:
+            while self.handle_events:
+                self.logger.info("DiscoveryMW::resync - load the registry from the primary at {}".format(self.primary))
+                socket = self.socket(zmq.REQ)
+                socket.connect("tcp://" + self.primary)
+                disc_req = discovery_pb2.DiscoveryReq()
+                disc_req.msg_type = discovery_pb2.TYPE_REPLICATE
+                disc_req.replicate_req.SetInParent()
+                socket.send(disc_req.SerializeToString())
+                if not socket.poll(5000):
+                    self.logger.warning("DiscoveryMW::resync - no reply from the primary, retrying")
+                    socket.close(linger=0)
+                    continue
+                discovery_response = discovery_pb2.DiscoveryResp()
+                discovery_response.ParseFromString(socket.recv())
+                socket.close(linger=0)
+                replicate_response = discovery_response.replicate_resp
+                if self.notify_socket is None:
+                    self.notify_socket = self.socket(zmq.SUB)
+                    self.notify_socket.setsockopt(zmq.SUBSCRIBE, b"")
+                    self.notify_socket.connect("tcp://{}:{}".format(self.primary.split(":")[0], replicate_response.log_port))
+                    self.poller.register(self.notify_socket, zmq.POLLIN)
+                self.upcall_obj.replica_snapshot(replicate_response.snapshot)
+                self.log_seq = replicate_response.seq
+                self.telemetry.count("replica_resyncs")
+                self.logger.info("DiscoveryMW::resync - {} registrations loaded, at log seq {}".format(
+                    len(replicate_response.snapshot.registrations), self.log_seq))
+                return
+        except Exception as e:
+            raise e
+
+    # replica: apply the log records that follow what we have, in order
+    def handle_notification(self):
+        try:
+            for _ in range(self.recv_budget):
+                try:
+                    bytesRcvd = self.notify_socket.recv(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                record = discovery_pb2.JournalRecord()
+                record.ParseFromString(bytesRcvd)
+                if record.seq <= self.log_seq:
+                    continue # already in our snapshot
+                if record.seq > self.log_seq + 1:
+                    self.telemetry.count("registry_gaps", record.seq - self.log_seq - 1)
+                    self.logger.warning("DiscoveryMW::handle_notification - missed log records {}..{}, resync".format(self.log_seq + 1, record.seq - 1))
+                    self.resync()
+                    continue
+                self.log_seq = record.seq
+                self.upcall_obj.replica_record(record)
+            return None
+        except Exception as e:
+            raise e
+
+    # Deliver a DHT request to the node owning key. The owner makes the upcall
+    # dht_request(op, registration, topiclist) and on_reply is called back with
+    # its result and the number of hops the request travelled:
+    #   OP_ENTITY, OP_INDEX - (status, reason)
+    #   OP_LOOKUP           - list of [id, addr, port, shards, endpoints]
+    #   OP_COUNT            - (pubs, subs, brokers)
+    def route(self, op, key, on_reply, registration=None, topiclist=()):
+        try:
+            dht_req = discovery_pb2.DhtReq()
+            dht_req.op = op
+            dht_req.key = key
+            if registration is not None:
+                dht_req.registration.CopyFrom(registration)
+            dht_req.topiclist[:] = topiclist
+            def deliver(dht_resp):
+                self.telemetry.count("dht_requests")
+                self.telemetry.count("dht_hops", dht_resp.hops)
+                on_reply(self.dht_result(op, dht_resp), dht_resp.hops)
+            self.forward(dht_req, deliver)
+        except Exception as e:
+            raise e
+
+    # serve a DHT request here if we own its key, otherwise send it one hop
+    # closer; on_resp gets the DhtResp
+    def forward(self, dht_req, on_resp):
+        if self.ring.owns(dht_req.key):
+            result = self.upcall_obj.dht_request(dht_req.op, dht_req.registration, list(dht_req.topiclist))
+            on_resp(self.dht_response(dht_req, result))
+            return
+        self.dht_tag += 1
+        next_req = discovery_pb2.DhtReq()
+        next_req.CopyFrom(dht_req)
+        next_req.tag = self.dht_tag
+        next_req.hops = dht_req.hops + 1
+        self.dht_pending[self.dht_tag] = on_resp
+        disc_req = discovery_pb2.DiscoveryReq()
+        disc_req.msg_type = discovery_pb2.TYPE_DHT
+        disc_req.dht_req.CopyFrom(next_req)
+        node = self.ring.next_hop(dht_req.key)
+        self.logger.debug("DiscoveryMW::forward - {} for key {} to {}".format(
+            discovery_pb2.DhtReq.Op.Name(dht_req.op), dht_req.key, node))
+        self.peer(node).send_multipart([b"", disc_req.SerializeToString()])
+
+    # DEALER socket to another node, connected on first use. Only the nodes of
+    # our finger table are ever used
+    def peer(self, node):
+        socket = self.peer_sockets.get(node)
+        if socket is None:
+            socket = self.socket(zmq.DEALER)
+            socket.connect("tcp://" + node)
+            self.poller.register(socket, zmq.POLLIN)
+            self.peer_sockets[node] = socket
+        return socket
+
+    # a DHT request from another node: answer it once it has been served, by us
+    # or by the nodes we forward it to
+    def handle_dht(self, dht_req):
+        try:
+            envelope = self.defer_reply()
+            tag = dht_req.tag
+            def reply(dht_resp):
+                dht_resp.tag = tag
+                disc_resp = discovery_pb2.DiscoveryResp()
+                disc_resp.msg_type = discovery_pb2.TYPE_DHT
+                disc_resp.dht_resp.CopyFrom(dht_resp)
+                self.send_reply(disc_resp.SerializeToString(), envelope)
+            self.forward(dht_req, reply)
+            return 0
+        except Exception as e:
+            raise e
+
+    # DHT responses from the nodes we forwarded requests to
+    def handle_peers(self, events):
+        try:
+            for socket in self.peer_sockets.values():
+                if socket not in events:
+                    continue
+                for _ in range(self.recv_budget):
+                    try:
+                        frames = socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    disc_resp = discovery_pb2.DiscoveryResp()
+                    disc_resp.ParseFromString(frames[-1])
+                    on_resp = self.dht_pending.pop(disc_resp.dht_resp.tag, None)
+                    if on_resp is None:
+                        self.logger.warning("DiscoveryMW::handle_peers - response with unknown tag {}".format(disc_resp.dht_resp.tag))
+                        continue
+                    on_resp(disc_resp.dht_resp)
+            return 0
+        except Exception as e:
+            raise e
+
+    # DhtResp carrying the result of the dht_request upcall
+    def dht_response(self, dht_req, result):
+        dht_resp = discovery_pb2.DhtResp()
+        dht_resp.hops = dht_req.hops
+        if dht_req.op in (discovery_pb2.DhtReq.OP_ENTITY, discovery_pb2.DhtReq.OP_INDEX):
+            status, reason = result
+            dht_resp.register_resp.status = discovery_pb2.Status.STATUS_SUCCESS if status else discovery_pb2.Status.STATUS_FAILURE
+            dht_resp.register_resp.reason = reason
+        elif dht_req.op == discovery_pb2.DhtReq.OP_LOOKUP:
+            for pub in result:
+                reg_info = dht_resp.publishers.add()
+                reg_info.id = pub[0] # name
+                reg_info.addr = pub[1] # addr
+                reg_info.port = pub[2] # port
+                reg_info.shards = pub[3] # consecutive ports of a sharded broker
+                reg_info.endpoints[:] = pub[4] # over every transport it offers
+        else: # OP_COUNT
+            dht_resp.pubs, dht_resp.subs, dht_resp.brokers = result
+        return dht_resp
+
+    # and the other way round
+    def dht_result(self, op, dht_resp):
+        if op in (discovery_pb2.DhtReq.OP_ENTITY, discovery_pb2.DhtReq.OP_INDEX):
+            return dht_resp.register_resp.status == discovery_pb2.Status.STATUS_SUCCESS, dht_resp.register_resp.reason
+        if op == discovery_pb2.DhtReq.OP_LOOKUP:
+            return [[pub.id, pub.addr, pub.port, pub.shards, list(pub.endpoints)] for pub in dht_resp.publishers]
+        return dht_resp.pubs, dht_resp.subs, dht_resp.brokers
+
     # here we save a pointer (handle) to the application object
     def set_upcall_handle(self, upcall_obj):
         super().set_upcall_handle(upcall_obj)
         
     def disable_event_loop(self):
-        super().disable_event_loop()
\ No newline at end of file
+        with self.cache_lock: # the final report reads the counters the lookup workers bump
+            super().disable_event_loop()
\ No newline at end of file
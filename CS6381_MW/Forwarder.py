@@ -0,0 +1,246 @@
+# Forwarding engine used by the broker middleware. It runs on its own thread
+# with an XSUB socket connected to the publishers and an XPUB socket bound for
+# the subscribers, so the broker's control logic (discovery requests, event
+# loop) never sits in the path of a publication.
+#
+# - Publications are moved with copy=False and never rewritten: their frames
+#   (topic and PublicationBatch in the binary format, the string in the string
+#   format) are forwarded untouched and provenance is marked by appending the
+#   BROKER_FRAME.
+# - Subscriptions arriving on the XPUB socket are passed up through the XSUB
+#   socket, so publishers only send the topics some subscriber wants.
+# - The XSUB and XPUB sockets get the options of the broker's transport
+#   profile ([Transport.Broker]); the publications dropped upstream are counted
+#   from the gaps in their sequence numbers, which costs a parse of the header
+#   fields of every message.
+# - ZMQ sockets must stay on the thread that uses them, so the broker asks the
+#   engine to connect to (or disconnect from) publishers over an inproc PAIR
+#   control socket.
+#
+# With [Broker] Shards=N > 1 the broker runs N forwarders as separate worker
+# processes (see ShardPool). Shard i binds its XPUB socket on port+i and only
+# passes upstream the subscriptions for topics whose crc32 maps to i, so the
+# shards carry disjoint sets of topics and each has its own GIL.
+
+import logging # for logging in the shard processes
+import multiprocessing # for the shard processes
+import threading # for the forwarding thread
+import zlib   # for a topic hash that is stable across processes
+import json   # for the per-shard counters
+import os     # for the pid in the control socket names
+import shutil # for removing the control socket directory
+import signal # to keep termination signals on the main thread
+import tempfile # for the directory holding the control sockets
+import zmq  # ZMQ sockets
+from CS6381_MW.Common import FORMAT_BINARY, BROKER_FRAME
+from CS6381_MW.Telemetry import Telemetry, SequenceGaps
+
+# shard that owns a topic (or a subscription prefix)
+def shard_of(topic, shards):
+    return zlib.crc32(topic) % shards
+
+class Forwarder():
+    def __init__(self, logger, context, bind_strings, format, telemetry, recv_budget=100, control_addr=None, shard=0, shards=1,
+                 socket_options=None):
+        self.logger = logger # internal logger for print statements
+        self.context = context # shared with the broker so inproc works
+        self.format = format # wire format of the data plane
+        self.telemetry = telemetry # counters of the forwarding thread
+        self.gaps = SequenceGaps(telemetry) # publications dropped before reaching us
+        self.recv_budget = recv_budget # max publications moved per wakeup
+        self.shard = shard # our index among the shards
+        self.shards = shards # total number of shards; 1 means no sharding
+        self.control_addr = control_addr or "inproc://forwarder-{}".format(id(self))
+        self.xsub = context.socket(zmq.XSUB) # upstream, connects to the publishers
+        self.xpub = context.socket(zmq.XPUB) # downstream, bound for the subscribers
+        for option, value in (socket_options or {}).items():
+            self.xsub.setsockopt(option, value)
+            self.xpub.setsockopt(option, value)
+        for bind_string in bind_strings: # one per transport offered by the broker
+            self.xpub.bind(bind_string)
+        self.control = context.socket(zmq.PAIR) # forwarding thread end of the control pipe
+        self.control.bind(self.control_addr)
+        self.commands = None # broker end of the control pipe
+        self.thread = None
+        self.parent_pid = None # a shard process exits once its broker process is gone
+
+    def start(self):
+        try:
+            self.logger.info("Forwarder::start")
+            self.commands = self.context.socket(zmq.PAIR)
+            self.commands.connect(self.control_addr)
+            self.thread = threading.Thread(target=self.run, name="Forwarder", daemon=True)
+            self.thread.start()
+        except Exception as e:
+            raise e
+
+    # called from the broker thread
+    def connect(self, connect_str):
+        self.commands.send_multipart([b"connect", connect_str.encode("utf-8")])
+
+    # called from the broker thread
+    def disconnect(self, connect_str):
+        self.commands.send_multipart([b"disconnect", connect_str.encode("utf-8")])
+
+    # called from the broker thread
+    def stop(self):
+        if self.thread is None:
+            return
+        self.commands.send_multipart([b"stop"])
+        self.thread.join()
+        self.thread = None
+        self.commands.close()
+
+    # body of the forwarding thread
+    def run(self):
+        try:
+            if threading.current_thread() is not threading.main_thread():
+                # let SIGTERM/SIGINT interrupt the broker's poll rather than land here
+                signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM, signal.SIGINT})
+            poller = zmq.Poller()
+            poller.register(self.xsub, zmq.POLLIN)
+            poller.register(self.xpub, zmq.POLLIN)
+            poller.register(self.control, zmq.POLLIN)
+            timeout = self.telemetry.report_interval * 1000 if self.telemetry.report_interval else None
+            if self.parent_pid is not None:
+                timeout = min(timeout or 1000, 1000)
+            while True:
+                events = dict(poller.poll(timeout=timeout))
+                if self.parent_pid is not None and os.getppid() != self.parent_pid:
+                    self.logger.info("Forwarder::run - broker process is gone, exiting")
+                    break
+                if self.xsub in events:
+                    self.relay()
+                if self.xpub in events:
+                    # subscribe/unsubscribe from a subscriber: pass it upstream
+                    # if the topic belongs to our shard
+                    subscription = self.xpub.recv()
+                    if self.shards == 1 or shard_of(subscription[1:], self.shards) == self.shard:
+                        self.xsub.send(subscription)
+                        self.telemetry.count("subscriptions")
+                if self.control in events:
+                    command = self.control.recv_multipart()
+                    if command[0] == b"connect":
+                        self.logger.info("Forwarder::run - connect to {}".format(command[1].decode("utf-8")))
+                        self.xsub.connect(command[1].decode("utf-8"))
+                    elif command[0] == b"disconnect":
+                        self.logger.info("Forwarder::run - disconnect from {}".format(command[1].decode("utf-8")))
+                        self.xsub.disconnect(command[1].decode("utf-8"))
+                    elif command[0] == b"stats":
+                        self.control.send_multipart([b"stats", json.dumps(self.telemetry.counters).encode("utf-8")])
+                    elif command[0] == b"stop":
+                        break
+                self.telemetry.maybe_report()
+            self.telemetry.report()
+        except Exception as e:
+            self.logger.error("Forwarder::run - forwarding stopped: {}".format(e))
+            raise e
+        finally:
+            self.xsub.close(linger=0)
+            self.xpub.close(linger=0)
+            self.control.close(linger=0)
+
+    # move up to recv_budget publications from upstream to downstream
+    def relay(self):
+        for _ in range(self.recv_budget):
+            try:
+                frames = self.xsub.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                return
+            if self.format == FORMAT_BINARY:
+                self.gaps.track_frame(frames[1].bytes)
+                self.xpub.send_multipart(frames[:2] + [BROKER_FRAME], copy=False)
+            else:
+                self.gaps.track_string(frames[0].bytes.decode("utf-8"))
+                self.xpub.send_multipart(frames[:1] + [BROKER_FRAME], copy=False)
+            self.telemetry.count("messages_relayed")
+            if self.telemetry.sample():
+                self.logger.info("Forwarder::relay - relayed message on {}".format(frames[0].bytes[:32]))
+
+
+# entry point of a shard process
+def run_shard(shard, shards, bind_strings, control_addr, format, recv_budget, sample_rate, report_interval, loglevel, parent_pid,
+              socket_options=None):
+    logging.basicConfig(level=loglevel, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logger = logging.getLogger("BrokerShard{}".format(shard))
+    name = "Forwarder[{}]".format(shard)
+    telemetry = Telemetry(logger, name, sample_rate=sample_rate, report_interval=report_interval)
+    forwarder = Forwarder(logger, zmq.Context(), bind_strings, format, telemetry, recv_budget,
+                          control_addr=control_addr, shard=shard, shards=shards, socket_options=socket_options)
+    forwarder.parent_pid = parent_pid
+    logger.info("{}::run_shard - bound {}".format(name, ", ".join(bind_strings)))
+    forwarder.run()
+
+# A set of forwarders running as worker processes, one per shard, driven by
+# the broker process over ipc PAIR sockets
+class ShardPool():
+    def __init__(self, logger, context, port, shards, format, telemetry, recv_budget=100, bind_strings=None,
+                 socket_options=None):
+        self.logger = logger # internal logger for print statements
+        self.context = context # the broker's context, for the command sockets
+        self.port = port # shard i binds port+i
+        self.bind_strings = bind_strings or [["tcp://*:" + str(port + shard)] for shard in range(shards)] # per shard, one per transport
+        self.shards = shards # number of worker processes
+        self.format = format # wire format of the data plane
+        self.telemetry = telemetry # settings are passed on to the shards
+        self.recv_budget = recv_budget # max publications moved per wakeup
+        self.socket_options = socket_options # of the XSUB and XPUB sockets of the shards
+        self.ipc_dir = tempfile.mkdtemp(prefix="broker-{}-".format(os.getpid()))
+        self.processes = [] # one worker process per shard
+        self.commands = [] # one PAIR socket per shard
+
+    def start(self):
+        try:
+            self.logger.info("ShardPool::start - {} shards on ports {}-{}".format(self.shards, self.port, self.port + self.shards - 1))
+            # spawn rather than fork: the children must not inherit our ZMQ context
+            mp = multiprocessing.get_context("spawn")
+            sample_rate = 1 / self.telemetry.sample_every if self.telemetry.sample_every else 0.0
+            for shard in range(self.shards):
+                control_addr = "ipc://{}/shard{}".format(self.ipc_dir, shard)
+                process = mp.Process(target=run_shard, name="BrokerShard{}".format(shard), daemon=True,
+                                     args=(shard, self.shards, self.bind_strings[shard], control_addr,
+                                           self.format, self.recv_budget, sample_rate,
+                                           self.telemetry.report_interval, self.logger.getEffectiveLevel(), os.getpid(),
+                                           self.socket_options))
+                process.start()
+                commands = self.context.socket(zmq.PAIR)
+                commands.connect(control_addr) # queued until the shard binds
+                self.processes.append(process)
+                self.commands.append(commands)
+        except Exception as e:
+            raise e
+
+    # every shard connects to every publisher; the subscriptions decide what flows
+    def connect(self, connect_str):
+        for commands in self.commands:
+            commands.send_multipart([b"connect", connect_str.encode("utf-8")])
+
+    def disconnect(self, connect_str):
+        for commands in self.commands:
+            commands.send_multipart([b"disconnect", connect_str.encode("utf-8")])
+
+    # counters of every shard, indexed by shard; None for a shard that did not answer
+    def stats(self, timeout=1000):
+        results = []
+        for commands in self.commands:
+            commands.send_multipart([b"stats"])
+        for commands in self.commands:
+            if commands.poll(timeout):
+                results.append(json.loads(commands.recv_multipart()[1]))
+            else:
+                results.append(None)
+        return results
+
+    def stop(self):
+        for commands in self.commands:
+            try:
+                commands.send_multipart([b"stop"], zmq.NOBLOCK)
+            except zmq.Again:
+                pass # that shard is already gone
+        for process in self.processes:
+            process.join(timeout=5)
+        for commands in self.commands:
+            commands.close(linger=0)
+        self.processes = []
+        self.commands = []
+        shutil.rmtree(self.ipc_dir, ignore_errors=True)
@@ -0,0 +1,138 @@
+# Middleware of a host agent (HostAgent.py): many publisher or subscriber
+# middleware objects living in one process. They share one ZMQ context, with
+# its I/O threads, and one poller, and a single event loop serves them all.
+# Every hosted object keeps its own sockets, its own registration with the
+# discovery service and its own upcalls, so to the rest of the system it is
+# just another entity.
+#
+# - The loop maps each polled socket to the middleware object owning it and to
+#   its handler (PinguMW.handlers); the map is rebuilt whenever the objects
+#   register new sockets with the shared poller (e.g. lookups, notifications).
+# - Every object has its own invoke_operation deadline, set from the timeout
+#   its handlers and upcalls return, exactly as in PinguMW.event_loop. The
+#   deadlines sit in a heap, so a loop iteration costs O(log N) in the number
+#   of hosted objects plus the sockets that are ready.
+# - An object that disables its event loop has its sockets taken out of the
+#   poller; the loop ends once none is left.
+# - With leases, a single heartbeat thread renews the registrations of all the
+#   hosted objects, so the thread count does not grow with the entities.
+#
+# The loop is always the poller one; [Middleware] EventLoop is not used here,
+# nor is IoThreads of the transport profiles: the shared context has its own.
+
+import heapq  # for the invoke_operation deadlines of the hosted objects
+import math   # for rounding up the poll timeout
+import time   # for the clock
+import zmq  # ZMQ sockets
+
+class HostMW():
+    def __init__(self, logger):
+        self.logger = logger # internal logger for print statements
+        self.context = None # the ZMQ context shared by the hosted objects
+        self.poller = None # the poller shared by the hosted objects
+        self.hosted = [] # (middleware object, name_of_MW) we serve
+        self.owners = {} # socket -> (middleware object, its handler)
+        self.polled = 0 # sockets in the poller when owners was built
+        self.deadlines = {} # middleware object -> monotonic time invoke_operation is due; None: not scheduled
+        self.timers = [] # heap of (deadline, seq, middleware object); stale entries are skipped
+        self.seq = 0 # tie breaker for the heap
+        self.heartbeat = None # the one thread renewing the leases of all the hosted objects (PinguMW.heartbeat_loop)
+
+    # sockets: how many the hosted objects may open between them. ZMQ caps a
+    # context at 1023 sockets by default, and every socket needs a few file
+    # descriptors, so both limits are raised to fit
+    def configure(self, sockets=1024, io_threads=1):
+        try:
+            self.logger.info("HostMW::configure - {} sockets, {} I/O thread(s)".format(sockets, io_threads))
+            self.context = zmq.Context(io_threads=io_threads)
+            self.context.max_sockets = max(sockets, self.context.max_sockets)
+            try:
+                import resource # POSIX only
+                soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+                wanted = 4 * sockets + 64
+                if soft != resource.RLIM_INFINITY and soft < wanted:
+                    if hard != resource.RLIM_INFINITY:
+                        wanted = min(wanted, hard)
+                    resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+            except (ImportError, ValueError, OSError) as e:
+                self.logger.warning("HostMW::configure - could not raise the file descriptor limit: {}".format(e))
+            self.poller = zmq.Poller()
+        except Exception as e:
+            raise e
+
+    # share our context and poller with a middleware object, before it is configured
+    def adopt(self, mw):
+        mw.context = self.context
+        mw.poller = self.poller
+        mw.host = self
+        self.hosted.append((mw, type(mw).__name__))
+
+    # serve all the hosted objects until every one of them has disabled its
+    # event loop; timeout (msecs) is when their first invoke_operation is due
+    def event_loop(self, timeout=None):
+        try:
+            self.logger.info("HostMW::event_loop - run the event loop for {} entities".format(len(self.hosted)))
+            for mw, name_of_MW in self.hosted:
+                self.set_timeout(mw, timeout)
+            self.map_sockets()
+            while self.owners:
+                if len(self.poller.sockets) != self.polled:
+                    self.map_sockets()
+                events = dict(self.poller.poll(timeout=self.next_timeout()))
+                for socket in events:
+                    mw, handler = self.owners.get(socket, (None, None))
+                    if mw is not None and mw.handle_events:
+                        timeout = handler()
+                        if timeout is not None: # else the pending one is kept
+                            self.set_timeout(mw, timeout)
+                        self.retire(mw)
+                now = time.monotonic()
+                while self.timers and self.timers[0][0] <= now:
+                    deadline, seq, mw = heapq.heappop(self.timers)
+                    if self.deadlines.get(mw) != deadline or not mw.handle_events:
+                        continue # pushed back or cancelled meanwhile
+                    self.deadlines[mw] = None
+                    self.set_timeout(mw, mw.upcall_obj.invoke_operation())
+                    self.retire(mw)
+            self.logger.info("HostMW::event_loop - out of the event loop")
+        except Exception as e:
+            raise e
+
+    # map the sockets in the poller to their owners and handlers
+    def map_sockets(self):
+        self.owners = {}
+        for mw, name_of_MW in self.hosted:
+            if not mw.handle_events:
+                continue
+            for socket, handler in mw.handlers(name_of_MW, mw.req).items():
+                self.owners[socket] = (mw, handler)
+        self.polled = len(self.poller.sockets)
+
+    # take the sockets of an object that is done out of the shared poller
+    def retire(self, mw):
+        if mw.handle_events:
+            return
+        for socket, (owner, handler) in list(self.owners.items()):
+            if owner is mw:
+                self.poller.unregister(socket)
+                del self.owners[socket]
+                self.polled -= 1
+        self.deadlines.pop(mw, None)
+
+    def set_timeout(self, mw, timeout):
+        if timeout is None:
+            self.deadlines[mw] = None
+            return
+        deadline = time.monotonic() + timeout / 1000
+        self.deadlines[mw] = deadline
+        self.seq += 1
+        heapq.heappush(self.timers, (deadline, self.seq, mw))
+
+    # msecs until the earliest invoke_operation is due, for the poll (rounded up
+    # so that it does not wake up just before the deadline)
+    def next_timeout(self):
+        while self.timers and self.deadlines.get(self.timers[0][2]) != self.timers[0][0]:
+            heapq.heappop(self.timers) # stale
+        if not self.timers:
+            return None
+        return max(0, math.ceil((self.timers[0][0] - time.monotonic()) * 1000))
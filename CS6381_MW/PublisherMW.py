@@ -16,7 +16,7 @@ import logging # for logging. Use it in place of print statements.
 import zmq  # ZMQ sockets
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
-from CS6381_MW.Common import PinguMW
+from CS6381_MW.Common import PinguMW, FORMAT_BINARY, MAX_DATAGRAM
 
 class PublisherMW(PinguMW):
   # constructor
@@ -24,6 +24,9 @@ class PublisherMW(PinguMW):
     super().__init__(logger)
     self.req = None # will be a ZMQ REQ socket to talk to Discovery service
     self.pub = None # will be a ZMQ PUB socket for dissemination
+    self.topic_frames = {} # topic name -> encoded topic frame (binary format)
+    self.batches = {} # topic name -> [PublicationBatch, time its first publication was added]
+    self.seqs = {} # topic name -> seq of its last publication, for the receivers to count drops
 
   # configure/initialize
   def configure(self, args):
@@ -32,15 +35,24 @@ class PublisherMW(PinguMW):
       self.logger.info("PublisherMW::configure")
       self.port = args.port
       self.addr = args.addr
-      context = zmq.Context()  # returns a singleton object
-      self.poller = zmq.Poller()
-      self.req = context.socket(zmq.REQ)
-      self.pub = context.socket(zmq.PUB)
+      self.read_config("PublisherMW", args)
+      if self.context is None: # unless we share the context and poller of a host agent
+        self.context = zmq.Context(io_threads=self.io_threads)
+        self.poller = zmq.Poller()
+      context = self.context
+      self.req = self.socket(zmq.REQ)
+      self.pub = self.socket(zmq.PUB)
       self.poller.register(self.req, zmq.POLLIN)
-      connect_str = "tcp://" + args.discovery
+      connect_str = self.discovery_endpoint(args.discovery)
+      self.discovery = connect_str
       self.req.connect(connect_str)
-      bind_string = "tcp://*:" + str(self.port)
-      self.pub.bind (bind_string)
+      # subscribers on our host (or in our process) connect over ipc (inproc)
+      self.endpoints = self.bind_endpoints(self.pub, self.port)
+      self.logger.info("PublisherMW::configure - bound {}".format(", ".join(self.endpoints)))
+      if self.strategy == "Multicast":
+        # every publication is sent once, to the group of its topic, whatever
+        # the number of subscribers; the groups come with our registration
+        self.group_socket = self.multicast_sender()
       self.logger.info("PublisherMW::configure completed")
     except Exception as e:
       raise e
@@ -56,8 +68,13 @@ class PublisherMW(PinguMW):
       bytesRcvd = self.req.recv()
       discovery_response = discovery_pb2.DiscoveryResp()
       discovery_response.ParseFromString(bytesRcvd)
+      if discovery_response.redirect:
+        return self.redirect("PublisherMW", discovery_response.redirect)
       if (discovery_response.msg_type == discovery_pb2.TYPE_REGISTER):
-        timeout = self.upcall_obj.register_response(discovery_response.register_resp)
+        self.registered("PublisherMW", [discovery_response.register_resp])
+        timeout = self.register_result(discovery_response.register_resp)
+      elif (discovery_response.msg_type == discovery_pb2.TYPE_REGISTER_BATCH):
+        timeout = self.registered_batch("PublisherMW", discovery_response.register_batch_resp)
       elif (discovery_response.msg_type == discovery_pb2.TYPE_ISREADY):
         timeout = self.upcall_obj.isready_response(discovery_response.isready_resp)
       else:
@@ -69,17 +86,103 @@ class PublisherMW(PinguMW):
   def register(self, name, topiclist):
     super().register("PublisherMW", name, topiclist)
 
+  # registrants is a list of (PublisherMW, name, topiclist) of the same host agent
+  def register_batch(self, registrants):
+    super().register_batch("PublisherMW", registrants)
+
   def is_ready(self):
     super().is_ready("PublisherMW")
     
-  def disseminate (self, id, topic, data, current_time):
+  # tstamp_ns is the send time in integer nanoseconds since the epoch
+  def disseminate (self, id, topic, data, tstamp_ns):
     try:
-      # Now use the protobuf logic to encode the info and send it.  But for now
-      # we are simply sending the string to make sure dissemination is working.
-      send_str = topic + ":" + id + ":" + data + ":" + current_time
-      self.logger.info("PublisherMW::disseminate - {}".format (send_str))
+      self.telemetry.count("published")
+      if self.telemetry.sample():
+        self.logger.info("PublisherMW::disseminate - {}:{}:{}:{}".format (topic, id, data, tstamp_ns))
+      self.telemetry.maybe_report()
+      seq = self.seqs.get(topic, 0) + 1
+      self.seqs[topic] = seq
+      if self.format == FORMAT_BINARY:
+        self.disseminate_binary(id, topic, data, tstamp_ns, seq)
+        return
+      # String format: topic:id:data:time:seq, kept for compatibility
+      send_str = topic + ":" + id + ":" + data + ":" + str(tstamp_ns) + ":" + str(seq)
       # send the info as bytes. See how we are providing an encoding of utf-8
-      self.pub.send(bytes(send_str, "utf-8"))
+      if self.group_socket is not None:
+        self.send_datagram(topic, bytes(send_str, "utf-8"))
+      else:
+        self.pub.send(bytes(send_str, "utf-8"))
+      self.telemetry.count("messages_sent")
+    except Exception as e:
+      raise e
+
+  # send a topic frame followed by a serialized PublicationBatch frame. Every
+  # message is a batch, of a single publication when batching is off, so the
+  # receivers decode it whatever their own BatchSize
+  def disseminate_binary (self, id, topic, data, tstamp_ns, seq=0):
+    try:
+      if topic not in self.topic_frames:
+        self.topic_frames[topic] = topic.encode("utf-8")
+      self.add_to_batch(id, topic, data, tstamp_ns, seq)
+    except Exception as e:
+      raise e
+
+  # append a publication to the pending batch of its topic, sending the batch
+  # once it is full or its oldest publication has waited for the linger time
+  def add_to_batch (self, id, topic, data, tstamp_ns, seq=0):
+    try:
+      entry = self.batches.get(topic)
+      if entry is None:
+        entry = [topic_pb2.PublicationBatch(), time.monotonic()]
+        self.batches[topic] = entry
+      publication = entry[0].publications.add()
+      publication.topic = topic
+      publication.content = data
+      publication.pub_id = id
+      publication.tstamp_ns = tstamp_ns
+      publication.seq = seq
+      if len(entry[0].publications) >= self.batch_size or time.monotonic() - entry[1] >= self.batch_linger:
+        self.send_batch(topic)
+    except Exception as e:
+      raise e
+
+  def send_batch (self, topic):
+    try:
+      batch, _ = self.batches.pop(topic)
+      if self.group_socket is not None:
+        self.send_datagram(topic, batch.SerializeToString())
+      else:
+        self.pub.send_multipart([self.topic_frames[topic], batch.SerializeToString()])
+      self.telemetry.count("messages_sent")
+      self.telemetry.gauge("pending_batches", len(self.batches))
+    except Exception as e:
+      raise e
+
+  # Strategy=Multicast: a message is a single datagram to the group of its
+  # topic, which carries its topic in the payload. As with a PUB socket, what
+  # the socket buffer cannot take is dropped
+  def send_datagram (self, topic, payload):
+    try:
+      if topic not in self.groups:
+        raise ValueError("No multicast group assigned to topic {}".format(topic))
+      if len(payload) > MAX_DATAGRAM:
+        raise ValueError("A {} byte message does not fit in a datagram, lower BatchSize".format(len(payload)))
+      try:
+        self.group_socket.sendto(payload, self.groups[topic])
+      except BlockingIOError:
+        self.telemetry.count("send_drops")
+    except Exception as e:
+      raise e
+
+  # Send every pending batch whose linger time expires before the given horizon
+  # (a time.monotonic() value), or every pending batch if no horizon is given.
+  # The application calls this before it idles until its next publication so
+  # that no publication is held back for longer than the linger time.
+  def flush_batches (self, horizon=None):
+    try:
+      for topic, entry in list(self.batches.items()):
+        if horizon is None or entry[1] + self.batch_linger <= horizon:
+          self.send_batch(topic)
     except Exception as e:
       raise e
             
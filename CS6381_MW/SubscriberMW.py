@@ -20,7 +20,7 @@ import logging # for logging. Use it in place of print statements.
 import zmq  # ZMQ sockets
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
-from CS6381_MW.Common import PinguMW
+from CS6381_MW.Common import PinguMW, FORMAT_BINARY, MAX_DATAGRAM
 
 class SubscriberMW(PinguMW):
 
@@ -28,20 +28,31 @@ class SubscriberMW(PinguMW):
     super().__init__(logger)
     self.req = None # will be a ZMQ REQ socket to talk to Discovery service
     self.sub = None # will be a ZMQ SUB socket for dissemination
+    self.publishers = {} # publisher id -> the connect strings we use for it
+    self.topics_subscribed = set() # topics already set on the SUB socket
 
   def configure(self, args):
     try:
       self.logger.info("SubscriberMW::configure")
       self.port = args.port
       self.addr = args.addr
-      context = zmq.Context()  # returns a singleton object
-      self.poller = zmq.Poller()
-      self.req = context.socket(zmq.REQ)
-      self.sub = context.socket(zmq.SUB)
+      self.read_config("SubscriberMW", args)
+      if self.context is None: # unless we share the context and poller of a host agent
+        self.context = zmq.Context(io_threads=self.io_threads)
+        self.poller = zmq.Poller()
+      context = self.context
+      self.req = self.socket(zmq.REQ)
       self.poller.register(self.req, zmq.POLLIN)
-      self.poller.register(self.sub, zmq.POLLIN)
-      connect_str = "tcp://" + args.discovery
+      if self.strategy != "Multicast":
+        self.sub = self.socket(zmq.SUB)
+        self.poller.register(self.sub, zmq.POLLIN)
+        self.data_socket = self.sub
+      # else the data socket is the UDP socket of the multicast groups, once
+      # makeSubscription joins the first one
+      connect_str = self.discovery_endpoint(args.discovery)
+      self.discovery = connect_str
       self.req.connect(connect_str)
+      self.connect_replicas("SubscriberMW")
       self.logger.info("SubscriberMW::configure completed")
     except Exception as e:
       raise e
@@ -51,17 +62,24 @@ class SubscriberMW(PinguMW):
     super().event_loop("SubscriberMW", self.req, timeout)
             
   # handle an incoming reply
-  def handle_reply(self):
+  # replies on the discovery socket, or on the socket of the read replicas
+  def handle_reply(self, socket=None):
     try:
       self.logger.info("SubscriberMW::handle_reply")
-      bytesRcvd = self.req.recv()
+      bytesRcvd = (socket or self.req).recv()
       discovery_response = discovery_pb2.DiscoveryResp()
       discovery_response.ParseFromString(bytesRcvd)
+      if discovery_response.redirect:
+        return self.redirect("SubscriberMW", discovery_response.redirect)
       if (discovery_response.msg_type == discovery_pb2.TYPE_REGISTER):
-        timeout = self.upcall_obj.register_response(discovery_response.register_resp)
+        self.registered("SubscriberMW", [discovery_response.register_resp])
+        timeout = self.register_result(discovery_response.register_resp)
+      elif (discovery_response.msg_type == discovery_pb2.TYPE_REGISTER_BATCH):
+        timeout = self.registered_batch("SubscriberMW", discovery_response.register_batch_resp)
       elif (discovery_response.msg_type == discovery_pb2.TYPE_ISREADY):
         timeout = self.upcall_obj.isready_response(discovery_response.isready_resp)
       elif (discovery_response.msg_type == discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC):
+        self.registry_version = discovery_response.lookup_resp.version
         timeout = self.upcall_obj.receiveSubscribedPublishersResponse(discovery_response.lookup_resp)
       else: 
         raise ValueError ("Unrecognized response message")
@@ -72,6 +90,15 @@ class SubscriberMW(PinguMW):
   def register (self, name, topiclist):
     super().register("SubscriberMW", name, topiclist)
 
+  # registrants is a list of (SubscriberMW, name, topiclist) of the same host agent
+  def register_batch(self, registrants):
+    super().register_batch("SubscriberMW", registrants)
+
+  # follow the registry changes before the application looks anything up
+  def register_result(self, result):
+    self.connect_notifications("SubscriberMW", result.notify_port)
+    return super().register_result(result)
+
   def is_ready(self):
     super().is_ready("SubscriberMW")
 
@@ -85,27 +112,148 @@ class SubscriberMW(PinguMW):
       discovery_request.msg_type = discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC
       discovery_request.lookup_req.CopyFrom(lookup_request)
       buf2send = discovery_request.SerializeToString()
-      self.req.send(buf2send) 
+      self.send_request(buf2send, lookup=True)
       self.logger.info("SubscriberMW::receiveSubscribedPublishers - end")
     except Exception as e:
       raise e
   
+  # connect to a publisher (once) and subscribe to our topics (once). With
+  # Strategy=Multicast we join the groups of our topics instead; the
+  # publishers are only kept track of
   def makeSubscription(self, pub, topiclist):
     try:
       self.logger.info("SubscriberMW::makeSubscription - start")
-      self.connect2pubs(pub.addr, pub.port)
+      if self.strategy == "Multicast":
+        self.publishers[pub.id] = []
+        for topic in topiclist:
+          if topic not in self.topics_subscribed:
+            self.join_group("SubscriberMW", topic)
+            self.topics_subscribed.add(topic)
+        return
+      # over the cheapest transport we share; a sharded broker publishes each
+      # shard of its topics on its own port
+      connect_strs = self.endpoints_of(pub)
+      if self.publishers.get(pub.id) != connect_strs:
+        self.dropPublisher(pub.id) # it moved, if we knew it already
+        for connect_str in connect_strs:
+          self.connect2pubs(connect_str)
+        self.publishers[pub.id] = connect_strs
       for topic in topiclist:
-        self.sub.setsockopt_string(zmq.SUBSCRIBE, topic)
-        self.logger.info("SubscriberMW::makeSubscription - topic: {}".format(topic))
+        if topic not in self.topics_subscribed:
+          self.sub.setsockopt_string(zmq.SUBSCRIBE, topic)
+          self.topics_subscribed.add(topic)
+          self.logger.info("SubscriberMW::makeSubscription - topic: {}".format(topic))
+    except Exception as e:
+      raise e
+
+  # disconnect from a publisher that is gone or no longer has our topics
+  def dropPublisher(self, id):
+    try:
+      for connect_str in self.publishers.pop(id, []):
+        self.logger.info("SubscriberMW::dropPublisher - disconnect from {}".format(connect_str))
+        self.sub.disconnect(connect_str)
     except Exception as e:
       raise e
     
-  def receive(self):
+  # the data socket is readable: hand up to recv_budget messages to the
+  # application without blocking, then return to the event loop
+  def handle_data(self):
+    try:
+      timeout = None
+      for _ in range(self.recv_budget):
+        try:
+          publications, from_broker = self.receive(zmq.NOBLOCK)
+        except zmq.Again:
+          break
+        timeout = self.upcall_obj.publications_received(publications, from_broker)
+      return timeout
+    except Exception as e:
+      raise e
+
+  # receive one message and decode it. Returns the list of publications it
+  # carried (several when batching is on) and whether it was relayed by the broker
+  def receive(self, flags=0):
+    try:
+      self.telemetry.maybe_report()
+      if self.group_socket is not None:
+        return self.receive_multicast()
+      if self.format == FORMAT_BINARY:
+        return self.receive_binary(flags)
+      # the string, plus a provenance frame if relayed by the broker
+      frames = self.sub.recv_multipart(flags)
+      return self.decode_string(frames[0].decode("utf-8"), len(frames) > 1)
+    except Exception as e:
+      raise e
+
+  # a string format message, topic:id:data:time:seq
+  def decode_string(self, msg, relayed=False):
+    try:
+      self.telemetry.count("messages_received")
+      self.telemetry.count("publications_received")
+      if self.telemetry.sample():
+        self.logger.info("SubscriberMW:: received message = {}".format (msg))
+      msglist = msg.split(":")
+      publication = topic_pb2.Publication()
+      publication.topic = msglist[0]
+      publication.pub_id = msglist[1]
+      publication.content = msglist[2]
+      publication.tstamp_ns = int(msglist[3])
+      if len(msglist) > 4 and msglist[4].isdigit():
+        publication.seq = int(msglist[4])
+        self.gaps.track(publication.pub_id, publication.topic, publication.seq, relayed)
+      return [publication], relayed
+    except Exception as e:
+      raise e
+
+  # frames are [topic, PublicationBatch] plus a provenance frame
+  # if relayed by the broker
+  def receive_binary(self, flags=0):
+    try:
+      frames = self.sub.recv_multipart(flags)
+      self.telemetry.count("messages_received")
+      publications = self.decode_binary(frames[1])
+      for publication in publications:
+        # the copies relayed by the broker are a stream of their own
+        self.gaps.track(publication.pub_id, publication.topic, publication.seq, len(frames) > 2)
+      self.telemetry.count("publications_received", len(publications))
+      if self.telemetry.sample():
+        self.logger.info("SubscriberMW:: received {} publication(s) on {}, relayed = {}".format (len(publications), frames[0].decode("utf-8"), len(frames) > 2))
+      return publications, len(frames) > 2
+    except Exception as e:
+      raise e
+
+  # a serialized PublicationBatch, of one publication unless the publisher batches
+  def decode_binary(self, payload):
+    batch = topic_pb2.PublicationBatch()
+    batch.ParseFromString(payload)
+    return batch.publications
+
+  # Strategy=Multicast: one datagram from the groups we joined, in either
+  # format. A group may also carry topics we did not subscribe to; their
+  # messages (a batch holds a single topic) are counted and left out. The
+  # socket never blocks; an empty one raises zmq.Again like a ZMQ socket
+  def receive_multicast(self):
     try:
-      self.logger.info("SubscriberMW:: receive messages")
-      msg = self.sub.recv_string()
-      self.logger.info("SubscriberMW:: received message = {}".format (msg))
-      return msg 
+      try:
+        payload = self.group_socket.recv(MAX_DATAGRAM)
+      except BlockingIOError:
+        raise zmq.Again()
+      if self.format != FORMAT_BINARY:
+        if payload.split(b":", 1)[0].decode("utf-8") not in self.topics_subscribed:
+          self.telemetry.count("foreign_messages")
+          return [], False
+        return self.decode_string(payload.decode("utf-8"))
+      publications = self.decode_binary(payload)
+      if publications and publications[0].topic not in self.topics_subscribed:
+        self.telemetry.count("foreign_messages")
+        return [], False
+      self.telemetry.count("messages_received")
+      self.telemetry.count("publications_received", len(publications))
+      for publication in publications:
+        self.gaps.track(publication.pub_id, publication.topic, publication.seq)
+      if self.telemetry.sample():
+        self.logger.info("SubscriberMW:: received {} publication(s) on {} over multicast".format(len(publications), publications[0].topic if publications else None))
+      return publications, False
     except Exception as e:
       raise e
             
@@ -117,7 +265,6 @@ class SubscriberMW(PinguMW):
     super().disable_event_loop()
   
   # connect to pubs
-  def connect2pubs(self, IP, port):
-    connect_str = "tcp://" + IP + ":" + str(port)
+  def connect2pubs(self, connect_str):
     self.logger.info("SubscriberMW:: connect2pubs method. connect_str = {}".format(connect_str))
     self.sub.connect(connect_str)
\ No newline at end of file
@@ -0,0 +1,91 @@
+# Data-plane telemetry for the middleware objects. Instead of logging every
+# publication at INFO level (which formats the string eagerly even when the
+# record is dropped) the hot paths bump in-memory counters and gauges, and only
+# a sampled fraction of the messages is logged in detail. The counters are
+# logged periodically and when the event loop is disabled. Control-plane
+# logging (register, isready, lookups) is not affected.
+#
+# Configured from the [Telemetry] section of config.ini:
+#   SampleRate     - fraction of data-plane messages logged in detail (0 disables)
+#   ReportInterval - secs between two reports of the counters (0 disables)
+#
+# SequenceGaps counts the publications lost on the way to a receiver.
+
+import time   # for the report interval
+from CS6381_MW import topic_pb2
+
+class Telemetry():
+    def __init__(self, logger, name, sample_rate=0.0, report_interval=10.0):
+        self.logger = logger # internal logger for print statements
+        self.name = name # prefix of the log messages, e.g. PublisherMW
+        self.counters = {} # name -> running total
+        self.gauges = {} # name -> latest value
+        # log every Nth message; a countdown is cheaper than a random draw
+        self.sample_every = int(round(1 / sample_rate)) if sample_rate > 0 else 0
+        self.countdown = 1
+        self.report_interval = report_interval
+        self.next_report = time.monotonic() + report_interval
+
+    def count(self, key, n=1):
+        self.counters[key] = self.counters.get(key, 0) + n
+
+    def gauge(self, key, value):
+        self.gauges[key] = value
+
+    # True when the current message should be logged in detail
+    def sample(self):
+        if not self.sample_every:
+            return False
+        self.countdown -= 1
+        if self.countdown:
+            return False
+        self.countdown = self.sample_every
+        return True
+
+    # log the counters if the report interval has elapsed
+    def maybe_report(self):
+        if self.report_interval and time.monotonic() >= self.next_report:
+            self.report()
+
+    def report(self):
+        self.next_report = time.monotonic() + self.report_interval
+        stats = ", ".join("{}={}".format(k, v) for k, v in sorted(self.counters.items()))
+        if self.gauges:
+            stats += "; " + ", ".join("{}={}".format(k, v) for k, v in sorted(self.gauges.items()))
+        self.logger.info("{}::telemetry - {}".format(self.name, stats))
+
+# A PUB socket that reaches its high-water mark for a subscriber drops the
+# messages silently, and so may a broker relaying them or our own SUB socket.
+# The publishers number their publications per topic, so a receiver counts
+# what was dropped upstream from the gaps, as the hwm_drops counter
+class SequenceGaps():
+    def __init__(self, telemetry):
+        self.telemetry = telemetry # where the drops are counted
+        self.last = {} # (publisher id, topic, path) -> last seq received
+
+    # path tells apart the copies of one stream arriving over different routes
+    # (e.g. directly and through the broker)
+    def track(self, pub_id, topic, seq, path=None):
+        if not seq:
+            return # not numbered (an older publisher)
+        key = (pub_id, topic, path)
+        last = self.last.get(key)
+        self.last[key] = seq
+        # nothing is known before the first one, and a lower seq means the
+        # publisher has restarted
+        if last is not None and seq > last + 1:
+            self.telemetry.count("hwm_drops", seq - last - 1)
+
+    # a string format message, topic:id:data:time:seq
+    def track_string(self, msg, path=None):
+        fields = msg.split(":", 5)
+        if len(fields) > 4 and fields[4].isdigit():
+            self.track(fields[1], fields[0], int(fields[4]), path)
+
+    # the PublicationBatch frame of a binary format message; only the header
+    # fields are parsed, which is all a relay needs
+    def track_frame(self, payload, path=None):
+        header = topic_pb2.PublicationBatchHeader()
+        header.ParseFromString(payload)
+        for publication in header.publications:
+            self.track(publication.pub_id, publication.topic, publication.seq, path)
@@ -1,10 +1,10 @@
 # -*- coding: utf-8 -*-
 # Generated by the protocol buffer compiler.  DO NOT EDIT!
 # source: topic.proto
-
+"""Generated protocol buffer code."""
+from google.protobuf.internal import builder as _builder
 from google.protobuf import descriptor as _descriptor
-from google.protobuf import message as _message
-from google.protobuf import reflection as _reflection
+from google.protobuf import descriptor_pool as _descriptor_pool
 from google.protobuf import symbol_database as _symbol_database
 # @@protoc_insertion_point(imports)
 
@@ -13,79 +13,19 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor.FileDescriptor(
-  name='topic.proto',
-  package='',
-  syntax='proto3',
-  serialized_options=None,
-  create_key=_descriptor._internal_create_key,
-  serialized_pb=b'\n\x0btopic.proto\"M\n\x0bPublication\x12\r\n\x05topic\x18\x01 \x01(\t\x12\x0f\n\x07\x63ontent\x18\x02 \x01(\t\x12\x0e\n\x06pub_id\x18\x03 \x01(\t\x12\x0e\n\x06tstamp\x18\x04 \x01(\x02\x62\x06proto3'
-)
-
-
-
-
-_PUBLICATION = _descriptor.Descriptor(
-  name='Publication',
-  full_name='Publication',
-  filename=None,
-  file=DESCRIPTOR,
-  containing_type=None,
-  create_key=_descriptor._internal_create_key,
-  fields=[
-    _descriptor.FieldDescriptor(
-      name='topic', full_name='Publication.topic', index=0,
-      number=1, type=9, cpp_type=9, label=1,
-      has_default_value=False, default_value=b"".decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
-    _descriptor.FieldDescriptor(
-      name='content', full_name='Publication.content', index=1,
-      number=2, type=9, cpp_type=9, label=1,
-      has_default_value=False, default_value=b"".decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
-    _descriptor.FieldDescriptor(
-      name='pub_id', full_name='Publication.pub_id', index=2,
-      number=3, type=9, cpp_type=9, label=1,
-      has_default_value=False, default_value=b"".decode('utf-8'),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
-    _descriptor.FieldDescriptor(
-      name='tstamp', full_name='Publication.tstamp', index=3,
-      number=4, type=2, cpp_type=6, label=1,
-      has_default_value=False, default_value=float(0),
-      message_type=None, enum_type=None, containing_type=None,
-      is_extension=False, extension_scope=None,
-      serialized_options=None, file=DESCRIPTOR,  create_key=_descriptor._internal_create_key),
-  ],
-  extensions=[
-  ],
-  nested_types=[],
-  enum_types=[
-  ],
-  serialized_options=None,
-  is_extendable=False,
-  syntax='proto3',
-  extension_ranges=[],
-  oneofs=[
-  ],
-  serialized_start=15,
-  serialized_end=92,
-)
-
-DESCRIPTOR.message_types_by_name['Publication'] = _PUBLICATION
-_sym_db.RegisterFileDescriptor(DESCRIPTOR)
-
-Publication = _reflection.GeneratedProtocolMessageType('Publication', (_message.Message,), {
-  'DESCRIPTOR' : _PUBLICATION,
-  '__module__' : 'topic_pb2'
-  # @@protoc_insertion_point(class_scope:Publication)
-  })
-_sym_db.RegisterMessage(Publication)
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0btopic.proto\"i\n\x0bPublication\x12\r\n\x05topic\x18\x01 \x01(\t\x12\x0f\n\x07\x63ontent\x18\x02 \x01(\t\x12\x0e\n\x06pub_id\x18\x03 \x01(\t\x12\x11\n\ttstamp_ns\x18\x06 \x01(\x06\x12\x0b\n\x03seq\x18\x07 \x01(\x04J\x04\x08\x04\x10\x05J\x04\x08\x05\x10\x06\"6\n\x10PublicationBatch\x12\"\n\x0cpublications\x18\x01 \x03(\x0b\x32\x0c.Publication\"?\n\x11PublicationHeader\x12\r\n\x05topic\x18\x01 \x01(\t\x12\x0e\n\x06pub_id\x18\x03 \x01(\t\x12\x0b\n\x03seq\x18\x07 \x01(\x04\"B\n\x16PublicationBatchHeader\x12(\n\x0cpublications\x18\x01 \x03(\x0b\x32\x12.PublicationHeaderb\x06proto3')
 
+_builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, globals())
+_builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'topic_pb2', globals())
+if _descriptor._USE_C_DESCRIPTORS == False:
 
+  DESCRIPTOR._options = None
+  _PUBLICATION._serialized_start=15
+  _PUBLICATION._serialized_end=120
+  _PUBLICATIONBATCH._serialized_start=122
+  _PUBLICATIONBATCH._serialized_end=176
+  _PUBLICATIONHEADER._serialized_start=178
+  _PUBLICATIONHEADER._serialized_end=241
+  _PUBLICATIONBATCHHEADER._serialized_start=243
+  _PUBLICATIONBATCHHEADER._serialized_end=309
 # @@protoc_insertion_point(module_scope)
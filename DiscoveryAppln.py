@@ -12,7 +12,18 @@
 # what method was invoked and then hands it to the application logic to handle it
 # (4) Some data structure or in-memory database etc will need to be used to save the registrations.
 # (5) When all the publishers and subscribers in the system have registered with us,
-# then we are in a ready state and will respond with a true to is_ready method. Until then it will be false.
+# then we are in a ready state and will respond with a true to is_ready method. Until then
+# the is_ready requests are held, and all of them are answered at once when we get ready.
+#
+# With [Discovery] Strategy=DHT we are one of several discovery nodes sharing the
+# registry (see CS6381_MW/Chord.py). A registrant is recorded by the node owning its
+# id (any broker by the owner of "broker", which keeps it unique) and indexed under
+# each of its topics by the node owning the topic. The node a client talks to routes
+# the parts of its request to their owners and answers once all of them are done.
+#
+# Started with -R host:port we are a read replica of the discovery service there:
+# our registry is a copy of the primary's, kept up to date from its replication
+# log, and we only answer lookups.
 
 # import the needed packages
 import os     # for OS functions
@@ -22,10 +33,17 @@ import argparse # for argument parsing
 import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
 import random # needed in the topic selection using random numbers
+import threading # for the registry lock
 
 # Import our topic selector. Feel free to use alternate way to get your topics of interest
 from topic_selector import TopicSelector
 
+# Optional persistence of the registry
+from registry_store import RegistryStore
+
+# Expiry of the registration leases
+from timing_wheel import TimingWheel
+
 # Now import our CS6381 Middleware
 from CS6381_MW.DiscoveryMW import DiscoveryMW
 from CS6381_MW import discovery_pb2
@@ -57,9 +75,25 @@ class DiscoveryAppln():
         self.pub_list = [] # Initialise to empty list
         self.sub_list = [] # Initialise to empty list
         self.broker_list = [] # Initalise to empty list
+        self.pub_by_id = {} # publisher (or broker) id -> its entry in pub_list
+        self.sub_by_id = {} # subscriber (or broker) id -> its entry in sub_list
+        self.topic_index = {} # topic -> {publisher id -> entry}, in registration order
+        self.registry_lock = threading.Lock() # lookups may run on the middleware's worker threads
+        self.registry_version = 0 # bumped whenever the answer to a lookup may change
         self.lookup = None # one of the diff ways we do lookup
         self.dissemination = None # direct or via broker
         self.is_ready = False
+        self.ready_timeout = 30.0 # max secs an isready request is held before answering false
+        self.ready_waiters = [] # (deadline, envelope) of the held isready requests
+        self.store = None # journal and snapshots of the registry, if persistence is on
+        self.replaying = False # True while the registry is rebuilt from the store
+        self.lease_time = 0 # secs a registration lives without a heartbeat; 0: forever
+        self.leases = None # timing wheel of the leases, keyed by (role, id)
+        self.dht = False # True with the DHT strategy
+        self.dht_index = {} # DHT: topic -> {publisher id -> [id, addr, port, shards, endpoints]}, for the topics we own
+        self.counting = False # DHT: a count of the registrations is in flight
+        self.next_count = 0 # DHT: when the held isready requests may trigger the next count, and the deadline of one in flight
+        self.count_round = 0 # DHT: numbers the counts, so that late answers to one given up are ignored
     
     def configure(self, args):
         ''' Initialize the object '''
@@ -77,8 +111,22 @@ class DiscoveryAppln():
             config.read(args.config)
             self.lookup = config["Discovery"]["Strategy"]
             self.dissemination = config["Dissemination"]["Strategy"]
+            self.ready_timeout = config["Discovery"].getfloat("ReadyTimeout", 30.0)
+            self.lease_time = config["Discovery"].getfloat("LeaseTime", 0)
+            self.dht = self.lookup == "DHT"
+            if self.dht or args.replica_of:
+                self.lease_time = 0 # each node only sees part of the registry; the primary expires them
+            if self.lease_time > 0:
+                # ticks of 1/20th of a lease, and a wheel spanning more than one lease
+                self.leases = TimingWheel(resolution=self.lease_time / 20, slots=32)
             self.mw_obj = DiscoveryMW(self.logger)
             self.mw_obj.configure(args) # pass remainder of the args to the m/w object
+            persistence = config["Persistence"] if config.has_section("Persistence") else {}
+            if persistence.get("Directory") and not self.dht and not args.replica_of:
+                self.store = RegistryStore(self.logger, persistence.get("Directory"),
+                                           snapshot_every=int(persistence.get("SnapshotEvery", 10000)),
+                                           fsync=str(persistence.get("Fsync", "False")).lower() == "true")
+                self.recover()
             self.logger.info("DiscoveryAppln::configure - configuration complete")
         except Exception as e:
             raise e
@@ -99,65 +147,359 @@ class DiscoveryAppln():
     def register_request(self, reg_request):
         try:
             self.logger.info("DiscoveryAppln::register_request")
-            status = False # success = True, failure = False
-            reason = ""
-            if reg_request.role == discovery_pb2.ROLE_PUBLISHER:
-                self.logger.info("DiscoveryAppln::register_request - ROLE_PUBLISHER")
-                if len(self.pub_list) != 0:
-                    for pub in self.pub_list:
-                        if pub[0] == reg_request.info.id:
-                            reason = "The publisher name is not unique."
-                if reason == "":
-                    self.pub_list.append([reg_request.info.id, reg_request.info.addr, reg_request.info.port, reg_request.topiclist])
-                    status = True
-                    reason = "The publisher name is unique."
-            elif reg_request.role == discovery_pb2.ROLE_SUBSCRIBER:
-                self.logger.info("DiscoveryAppln::register_request - ROLE_SUBSCRIBER")
-                if len(self.sub_list) != 0:
-                    for sub in self.sub_list:
-                        if sub[0] == reg_request.info.id:
-                            reason = "The subscriber name is not unique."
-                if reason == "":
-                    self.sub_list.append([reg_request.info.id, reg_request.info.addr, reg_request.info.port, reg_request.topiclist])
-                    status = True
-                    reason = "The subscriber name is unique."
-            elif reg_request.role == discovery_pb2.ROLE_BOTH:
-                self.logger.info("DiscoveryAppln::register_request - ROLE_BOTH")
-                if len(self.broker_list) != 0:
-                    reason = "There should be only one broker."
-                if reason == "":
-                    self.broker_list.append([reg_request.info.id, reg_request.info.addr, reg_request.info.port, reg_request.topiclist])
-                    # Broker as as both publisher and subscriber
-                    self.pub_list.append([reg_request.info.id, reg_request.info.addr, reg_request.info.port, reg_request.topiclist])
-                    self.sub_list.append([reg_request.info.id, reg_request.info.addr, reg_request.info.port, reg_request.topiclist])
-                    status = True
-                    reason = "The broker name is unique and there is only one broker."
-            else:
-                raise Exception("Role unknown: Should be either publisher, subscriber, or broker.")
-            if len(self.pub_list) >= self.no_pubs and len(self.sub_list) >= self.no_subs:
-                self.is_ready = True
-            self.mw_obj.handle_register(status, reason)
+            if self.dht:
+                envelope = self.mw_obj.defer_reply()
+                self.dht_register([reg_request], lambda results: self.mw_obj.handle_register(*results[0], envelope, reg_request.topiclist))
+                return 0
+            entry = self.entry_of(reg_request)
+            with self.registry_lock:
+                status, reason = self.apply_registration(reg_request.role, entry)
+            self.mw_obj.handle_register(status, reason, topics=reg_request.topiclist)
+            if self.is_ready and self.ready_waiters:
+                self.release_waiters(True)
+            return 0
+        except Exception as e:
+            raise e
+
+    # the entries are applied in order, each succeeding or failing on its own,
+    # and answered together
+    def register_batch_request(self, batch_request):
+        try:
+            self.logger.info("DiscoveryAppln::register_batch_request - {} entries".format(len(batch_request.entries)))
+            if self.dht:
+                envelope = self.mw_obj.defer_reply()
+                self.dht_register(batch_request.entries, lambda results: self.mw_obj.handle_register_batch(
+                    results, envelope, [reg_request.topiclist for reg_request in batch_request.entries]))
+                return 0
+            results = []
+            with self.registry_lock:
+                for reg_request in batch_request.entries:
+                    entry = self.entry_of(reg_request)
+                    if reg_request.role not in (discovery_pb2.ROLE_PUBLISHER, discovery_pb2.ROLE_SUBSCRIBER, discovery_pb2.ROLE_BOTH):
+                        results.append((False, "Role unknown: Should be either publisher, subscriber, or broker."))
+                        continue
+                    results.append(self.apply_registration(reg_request.role, entry))
+            self.mw_obj.handle_register_batch(results, topiclists=[reg_request.topiclist for reg_request in batch_request.entries])
+            if self.is_ready and self.ready_waiters:
+                self.release_waiters(True)
+            return 0
+        except Exception as e:
+            raise e
+
+    # our registry entry for a registration: [id, addr, port, topics, shards, endpoints]
+    def entry_of(self, reg_request):
+        return [reg_request.info.id, reg_request.info.addr, reg_request.info.port, list(reg_request.topiclist), reg_request.info.shards,
+                list(reg_request.info.endpoints)]
+
+    # validate and record a registration; called with the registry lock held
+    def apply_registration(self, role, entry):
+        status = False # success = True, failure = False
+        reason = ""
+        if role == discovery_pb2.ROLE_PUBLISHER:
+            self.logger.info("DiscoveryAppln::register_request - ROLE_PUBLISHER")
+            known = self.pub_by_id.get(entry[0])
+            if known is not None and known[1:3] == entry[1:3]:
+                # the same publisher registering again (e.g. restarted): take its new topics
+                self.update_publisher_topics(known, entry[3])
+                self.journal(discovery_pb2.JournalRecord.OP_UPDATE_TOPICS, role, known)
+                self.grant_lease(role, entry[0])
+                return True, "The publisher topics have been updated."
+            if known is not None:
+                reason = "The publisher name is not unique."
+            if reason == "":
+                self.add_publisher(entry)
+                status = True
+                reason = "The publisher name is unique."
+        elif role == discovery_pb2.ROLE_SUBSCRIBER:
+            self.logger.info("DiscoveryAppln::register_request - ROLE_SUBSCRIBER")
+            if entry[0] in self.sub_by_id:
+                reason = "The subscriber name is not unique."
+            if reason == "":
+                self.add_subscriber(entry)
+                status = True
+                reason = "The subscriber name is unique."
+        elif role == discovery_pb2.ROLE_BOTH:
+            self.logger.info("DiscoveryAppln::register_request - ROLE_BOTH")
+            if len(self.broker_list) != 0:
+                reason = "There should be only one broker."
+            if reason == "":
+                self.broker_list.append(entry)
+                # Broker as as both publisher and subscriber
+                self.add_publisher(entry)
+                self.add_subscriber(entry)
+                status = True
+                reason = "The broker name is unique and there is only one broker."
+        else:
+            raise Exception("Role unknown: Should be either publisher, subscriber, or broker.")
+        if status:
+            self.journal(discovery_pb2.JournalRecord.OP_REGISTER, role, entry)
+            self.grant_lease(role, entry[0])
+        if not self.dht: # a DHT node only holds part of the registry
+            self.is_ready = self.check_ready()
+        return status, reason
+
+    # persist a change to the registry, if persistence is on; called with the
+    # registry lock held
+    # (and stream it to the read replicas, if any)
+    def journal(self, op, role, entry):
+        if self.replaying:
+            return
+        self.mw_obj.replicate(op, role, entry)
+        if self.store is None:
+            return
+        self.store.append(op, role, entry)
+        if self.store.snapshot_due():
+            self.store.snapshot(self.registry_version, self.registrations())
+
+    # the whole registry as a list of (role, entry), brokers first
+    def registrations(self):
+        brokers = set(broker[0] for broker in self.broker_list)
+        registrations = [(discovery_pb2.ROLE_BOTH, broker) for broker in self.broker_list]
+        registrations += [(discovery_pb2.ROLE_PUBLISHER, pub) for pub in self.pub_list if pub[0] not in brokers]
+        registrations += [(discovery_pb2.ROLE_SUBSCRIBER, sub) for sub in self.sub_list if sub[0] not in brokers]
+        return registrations
+
+    # rebuild the registry from the latest snapshot and the journal after it
+    def recover(self):
+        try:
+            start = time.perf_counter()
+            snapshot, records = self.store.recover()
+            self.replaying = True
+            with self.registry_lock:
+                for reg_request in snapshot.registrations:
+                    self.apply_registration(reg_request.role, self.entry_of(reg_request))
+                self.registry_version = snapshot.version
+                for record in records:
+                    self.apply_record(record)
+            self.replaying = False
+            self.logger.info("DiscoveryAppln::recover - {} snapshot registrations and {} journal records recovered in {:.1f} ms, registry version {}".format(
+                len(snapshot.registrations), len(records), (time.perf_counter() - start) * 1000, self.registry_version))
+        except Exception as e:
+            raise e
+
+    # redo a change recorded in the journal or the replication log; called with
+    # the registry lock held
+    def apply_record(self, record):
+        if record.op == discovery_pb2.JournalRecord.OP_REMOVE:
+            self.remove_registration(record.registration.role, record.registration.info.id)
+        else: # a topic update is a registration again from the same endpoint
+            self.apply_registration(record.registration.role, self.entry_of(record.registration))
+
+    # upcall made by the middleware of the primary for a replica that (re)loads the registry
+    def replicate_request(self):
+        try:
+            with self.registry_lock:
+                return self.mw_obj.send_replica_snapshot(self.registry_version, self.registrations())
+        except Exception as e:
+            raise e
+
+    # upcall made by the middleware of a replica with the primary's registry,
+    # which replaces ours. The registry versions follow the primary's, so the
+    # lookup replies of a replica can be followed up by the primary's deltas
+    def replica_snapshot(self, snapshot):
+        try:
+            with self.registry_lock:
+                self.pub_list, self.sub_list, self.broker_list = [], [], []
+                self.pub_by_id, self.sub_by_id, self.topic_index = {}, {}, {}
+                self.replaying = True
+                for reg_request in snapshot.registrations:
+                    self.apply_registration(reg_request.role, self.entry_of(reg_request))
+                self.registry_version = snapshot.version
+                self.replaying = False
+        except Exception as e:
+            raise e
+
+    # upcall made by the middleware of a replica for each record of the log
+    def replica_record(self, record):
+        try:
+            with self.registry_lock:
+                self.replaying = True
+                self.apply_record(record)
+                self.replaying = False
+        except Exception as e:
+            raise e
+
+    # have the expected numbers of publishers, subscribers (and broker, when
+    # disseminating through one) registered? The broker is listed among both the
+    # publishers and the subscribers, so it is not counted there
+    def check_ready(self):
+        return self.ready_for(len(self.pub_list), len(self.sub_list), len(self.broker_list))
+
+    def ready_for(self, pubs, subs, brokers):
+        if pubs - brokers < self.no_pubs or subs - brokers < self.no_subs:
+            return False
+        return self.dissemination != "Broker" or brokers >= self.no_broker
+
+    # record a publisher in the list, the id map and the topic index
+    def add_publisher(self, entry):
+        self.pub_list.append(entry)
+        self.pub_by_id[entry[0]] = entry
+        for topic in entry[3]:
+            self.topic_index.setdefault(topic, {})[entry[0]] = entry
+        self.registry_changed(discovery_pb2.CHANGE_PUB_ADDED, entry)
+
+    def update_publisher_topics(self, entry, topiclist):
+        for topic in entry[3]:
+            self.topic_index[topic].pop(entry[0], None)
+        entry[3] = list(topiclist)
+        for topic in entry[3]:
+            self.topic_index.setdefault(topic, {})[entry[0]] = entry
+        self.registry_changed(discovery_pb2.CHANGE_TOPICS_CHANGED, entry)
+
+    def remove_publisher(self, id):
+        entry = self.pub_by_id.pop(id)
+        self.pub_list.remove(entry)
+        for topic in entry[3]:
+            self.topic_index[topic].pop(id, None)
+        self.registry_changed(discovery_pb2.CHANGE_PUB_REMOVED, entry)
+
+    def remove_subscriber(self, id):
+        entry = self.sub_by_id.pop(id)
+        self.sub_list.remove(entry)
+
+    # drop a registration (e.g. its lease expired); called with the registry lock held
+    def remove_registration(self, role, id):
+        if role == discovery_pb2.ROLE_PUBLISHER and id in self.pub_by_id:
+            entry = self.pub_by_id[id]
+            self.remove_publisher(id)
+        elif role == discovery_pb2.ROLE_SUBSCRIBER and id in self.sub_by_id:
+            entry = self.sub_by_id[id]
+            self.remove_subscriber(id)
+        elif role == discovery_pb2.ROLE_BOTH and self.broker_list and self.broker_list[0][0] == id:
+            entry = self.broker_list.pop()
+            self.remove_publisher(id)
+            self.remove_subscriber(id)
+        else:
+            return
+        self.journal(discovery_pb2.JournalRecord.OP_REMOVE, role, entry)
+        if self.leases is not None:
+            self.leases.remove((role, id))
+        self.is_ready = self.check_ready()
+
+    # start or renew the lease of a registration, if registrations are leased
+    def grant_lease(self, role, id):
+        if self.leases is not None:
+            self.leases.add((role, id), self.lease_time)
+
+    # drop the registrations whose lease has expired. Their publishers vanish
+    # from the lookups: the registry version moves on, which also invalidates
+    # the cached replies, and the change is streamed to the clients
+    def expire_leases(self):
+        if self.leases is None:
+            return
+        expired = self.leases.advance()
+        if not expired:
+            return
+        with self.registry_lock:
+            for role, id in expired:
+                self.logger.info("DiscoveryAppln::expire_leases - lease of {} {} expired".format(discovery_pb2.Role.Name(role), id))
+                self.remove_registration(role, id)
+
+    # a heartbeat renews the leases of the listed entities; those that are
+    # unknown (e.g. already expired) are reported so they register again
+    def heartbeat_request(self, heartbeat_req):
+        try:
+            self.expire_leases()
+            expired = []
+            for id in heartbeat_req.ids:
+                if self.leases is None:
+                    continue
+                if (heartbeat_req.role, id) in self.leases:
+                    self.leases.add((heartbeat_req.role, id), self.lease_time)
+                else:
+                    expired.append(id)
+            self.mw_obj.send_heartbeat_response(expired)
             return 0
         except Exception as e:
             raise e
 
+    # every change to the publishers bumps the registry version and is streamed
+    # to the clients; called with the registry lock held so the deltas go out in
+    # version order
+    def registry_changed(self, change, entry):
+        self.registry_version += 1
+        if not self.replaying: # nobody can be following us while we recover
+            self.mw_obj.publish_delta(self.registry_version, change, entry)
+
+    def add_subscriber(self, entry):
+        self.sub_list.append(entry)
+        self.sub_by_id[entry[0]] = entry
+
+    # Readiness barrier: until everyone expected has registered, an isready
+    # request is held (its reply deferred) rather than answered with false. All
+    # held requests are released together by the registration that completes
+    # the system, or answered false once they have waited ready_timeout secs.
+    # A REP discovery server cannot hold requests and answers right away.
     def isready_request(self):
         try:
             self.logger.info("DiscoveryAppln:: isready_request")
-            self.mw_obj.update_is_ready_status(True)
+            if self.dht and not self.is_ready:
+                self.ready_waiters.append((time.monotonic() + self.ready_timeout, self.mw_obj.defer_reply()))
+                self.dht_count()
+            elif self.is_ready or not self.mw_obj.can_defer():
+                self.mw_obj.update_is_ready_status(self.is_ready)
+            else:
+                self.ready_waiters.append((time.monotonic() + self.ready_timeout, self.mw_obj.defer_reply()))
+                self.logger.info("DiscoveryAppln::isready_request - not ready, {} request(s) held".format(len(self.ready_waiters)))
             return 0
         except Exception as e:
             raise e
+
+    def release_waiters(self, is_ready):
+        self.logger.info("DiscoveryAppln::release_waiters - {} held isready request(s) answered {}".format(len(self.ready_waiters), is_ready))
+        for deadline, envelope in self.ready_waiters:
+            self.mw_obj.update_is_ready_status(is_ready, envelope)
+        self.ready_waiters = []
+
+    # upcall made by the middleware when the event loop times out: expire the
+    # leases that are due, answer the held isready requests whose time is up,
+    # and wake up for the next of either
+    def invoke_operation(self):
+        try:
+            self.expire_leases()
+            if self.dht and self.ready_waiters and time.monotonic() >= self.next_count:
+                self.dht_count()
+            lease_timeout = None if self.leases is None else self.leases.next_timeout()
+            if self.dht and self.ready_waiters:
+                # come back to count the registrations again
+                count_timeout = max(0.0, self.next_count - time.monotonic())
+                lease_timeout = count_timeout if lease_timeout is None else min(lease_timeout, count_timeout)
+            if lease_timeout is not None:
+                lease_timeout = int(lease_timeout * 1000) + 1
+            if not self.ready_waiters:
+                return lease_timeout
+            now = time.monotonic()
+            expired = [waiter for waiter in self.ready_waiters if waiter[0] <= now]
+            if expired:
+                self.ready_waiters = [waiter for waiter in self.ready_waiters if waiter[0] > now]
+                for deadline, envelope in expired:
+                    self.mw_obj.update_is_ready_status(False, envelope)
+                self.logger.info("DiscoveryAppln::invoke_operation - {} isready request(s) timed out".format(len(expired)))
+            if not self.ready_waiters:
+                return lease_timeout
+            timeout = max(0, int((min(waiter[0] for waiter in self.ready_waiters) - now) * 1000) + 1)
+            return timeout if lease_timeout is None else min(timeout, lease_timeout)
+        except Exception as e:
+            raise e
     
     def handle_topic_request(self, topic_req):
         try:
             self.logger.info("DiscoveryAppln::handle_topic_request - start")
-            pubTopicList = []
-            for pub in self.pub_list:
-                if any(topic in pub[3] for topic in topic_req.topiclist):
-                    self.logger.info("DiscoveryAppln::handle_topic_request - add pub")
-                    pubTopicList.append([pub[0], pub[1], pub[2]])     
-            self.mw_obj.send_pubinfo_for_topic(pubTopicList)
+            key = frozenset(topic_req.topiclist) # the order and repeats of the topics do not matter
+            if self.dht:
+                self.dht_lookup(key, self.mw_obj.send_pubinfo_for_topic)
+                return 0
+            if self.mw_obj.send_cached_reply(discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC, key, self.registry_version):
+                return 0
+            # union of the publishers of each requested topic, each publisher once
+            matched = {}
+            with self.registry_lock:
+                version = self.registry_version
+                for topic in topic_req.topiclist:
+                    matched.update(self.topic_index.get(topic, {}))
+                pubTopicList = [[pub[0], pub[1], pub[2], pub[4], pub[5]] for pub in matched.values()]
+            self.logger.info("DiscoveryAppln::handle_topic_request - {} pubs matched".format(len(pubTopicList)))
+            self.mw_obj.send_pubinfo_for_topic(pubTopicList, version=version, cache_key=key)
             return 0
         except Exception as e:
             raise e
@@ -165,17 +507,149 @@ class DiscoveryAppln():
     def handle_all_publist(self):
         try:
             self.logger.info ("DiscoveryAppln:: handle_all_publist")
+            if self.dht:
+                self.dht_lookup(None, self.mw_obj.send_all_pub_list)
+                return 0
+            if self.mw_obj.send_cached_reply(discovery_pb2.TYPE_LOOKUP_ALL_PUBS, "all", self.registry_version):
+                return 0
             pubWithoutTopicList = []
-            if len(self.pub_list) != 0:
+            with self.registry_lock:
+                version = self.registry_version
                 for pub in self.pub_list:
-                    pubWithoutTopicList.append([pub[0], pub[1], pub[2]])
-            else:
-                pubWithoutTopicList = []
-            self.mw_obj.send_all_pub_list(pubWithoutTopicList)
+                    pubWithoutTopicList.append([pub[0], pub[1], pub[2], pub[4], pub[5]])
+            self.mw_obj.send_all_pub_list(pubWithoutTopicList, version=version, cache_key="all")
             return 0
         except Exception as e:
             raise e
     
+    # DHT: register entities at the owners of their ids, then index the
+    # publishers under their topics at the owners of the topics; on_done gets one
+    # (status, reason) per registration once everything has been acknowledged
+    def dht_register(self, reg_requests, on_done):
+        results = [None] * len(reg_requests)
+        if not results:
+            on_done(results)
+            return
+        ring = self.mw_obj.ring
+        def finish(index, status, reason):
+            results[index] = (status, reason)
+            if None not in results:
+                on_done(results)
+                if self.ready_waiters: # this may have completed the system
+                    self.dht_count()
+        def entity_done(index, reg_request, status, reason):
+            if not status or reg_request.role == discovery_pb2.ROLE_SUBSCRIBER or not reg_request.topiclist:
+                finish(index, status, reason)
+                return
+            groups = self.dht_groups(reg_request.topiclist)
+            acks = []
+            def index_done(result, hops):
+                acks.append(result)
+                if len(acks) == len(groups):
+                    failed = [r for s, r in acks if not s]
+                    finish(index, not failed, failed[0] if failed else reason)
+            for key, topics in groups.items():
+                index_req = discovery_pb2.RegisterReq()
+                index_req.CopyFrom(reg_request)
+                index_req.topiclist[:] = topics
+                self.mw_obj.route(discovery_pb2.DhtReq.OP_INDEX, key, index_done, registration=index_req)
+        for index, reg_request in enumerate(reg_requests):
+            if reg_request.role not in (discovery_pb2.ROLE_PUBLISHER, discovery_pb2.ROLE_SUBSCRIBER, discovery_pb2.ROLE_BOTH):
+                finish(index, False, "Role unknown: Should be either publisher, subscriber, or broker.")
+                continue
+            # all brokers meet at the same node, which lets only one of them in
+            name = "broker" if reg_request.role == discovery_pb2.ROLE_BOTH else reg_request.info.id
+            self.mw_obj.route(discovery_pb2.DhtReq.OP_ENTITY, ring.key(name),
+                              lambda result, hops, index=index, reg_request=reg_request: entity_done(index, reg_request, *result),
+                              registration=reg_request)
+
+    # DHT: the publishers of some topics (all publishers if topics is None),
+    # gathered from the nodes owning them and passed to send_reply
+    def dht_lookup(self, topics, send_reply):
+        envelope = self.mw_obj.defer_reply()
+        if topics is None: # every node holds some of the publishers
+            groups = {key: [] for key in self.mw_obj.ring.node_keys()}
+        else:
+            groups = self.dht_groups(topics)
+        if not groups:
+            send_reply([], envelope)
+            return
+        matched = {}
+        answers = []
+        def lookup_done(pubs, hops):
+            answers.append(hops)
+            for pub in pubs:
+                matched[pub[0]] = pub
+            if len(answers) == len(groups):
+                self.logger.info("DiscoveryAppln::dht_lookup - {} pubs matched from {} node(s), max {} hop(s)".format(
+                    len(matched), len(groups), max(answers)))
+                send_reply(list(matched.values()), envelope)
+        for key, group in groups.items():
+            self.mw_obj.route(discovery_pb2.DhtReq.OP_LOOKUP, key, lookup_done, topiclist=group)
+
+    # DHT: topics grouped by the node owning them, keyed by a key each node owns,
+    # so every node involved gets a single request
+    def dht_groups(self, topics):
+        ring = self.mw_obj.ring
+        groups = {}
+        for topic in set(topics):
+            groups.setdefault(ring.successor_of(ring.key(topic))[0], []).append(topic)
+        return groups
+
+    # DHT: add up the registrations held by every node; once the system is
+    # complete the held isready requests are released. While it is not, they
+    # trigger another count every second until they time out
+    def dht_count(self):
+        if self.counting:
+            if time.monotonic() < self.next_count:
+                return
+            # some node has not answered in time (it may have left the ring):
+            # give up on this count and start another one
+            self.logger.warning("DiscoveryAppln::dht_count - count {} not answered in time, counting again".format(self.count_round))
+        self.counting = True
+        self.count_round += 1
+        count_round = self.count_round
+        self.next_count = time.monotonic() + 1.0 # no need to wake up before
+        keys = self.mw_obj.ring.node_keys()
+        counts = []
+        def count_done(result, hops):
+            if count_round != self.count_round:
+                return # a count we gave up on
+            counts.append(result)
+            if len(counts) < len(keys):
+                return
+            self.counting = False
+            self.next_count = time.monotonic() + 1.0
+            pubs, subs, brokers = (sum(column) for column in zip(*counts))
+            self.logger.info("DiscoveryAppln::dht_count - {} pubs, {} subs, {} brokers registered".format(pubs, subs, brokers))
+            self.is_ready = self.ready_for(pubs, subs, brokers)
+            if self.is_ready and self.ready_waiters:
+                self.release_waiters(True)
+        for key in keys:
+            self.mw_obj.route(discovery_pb2.DhtReq.OP_COUNT, key, count_done)
+
+    # upcall made by the middleware for a DHT request whose key we own
+    def dht_request(self, op, registration, topiclist):
+        try:
+            if op == discovery_pb2.DhtReq.OP_ENTITY:
+                with self.registry_lock:
+                    return self.apply_registration(registration.role, self.entry_of(registration))
+            if op == discovery_pb2.DhtReq.OP_INDEX:
+                entry = self.entry_of(registration)
+                for topic in entry[3]:
+                    self.dht_index.setdefault(topic, {})[entry[0]] = [entry[0], entry[1], entry[2], entry[4], entry[5]]
+                return True, "The publisher has been indexed."
+            if op == discovery_pb2.DhtReq.OP_LOOKUP:
+                if not topiclist: # the publishers registered with us
+                    return [[pub[0], pub[1], pub[2], pub[4], pub[5]] for pub in self.pub_list]
+                matched = {}
+                for topic in topiclist:
+                    matched.update(self.dht_index.get(topic, {}))
+                return list(matched.values())
+            return len(self.pub_list), len(self.sub_list), len(self.broker_list) # OP_COUNT
+        except Exception as e:
+            raise e
+
     def dump(self):
         try:
             self.logger.info ("**********************************")
@@ -202,6 +676,7 @@ def parseCmdLineArgs ():
     parser.add_argument("-B", "--no_broker", type=int, default=1, help="Number of brokers")
     parser.add_argument("-T", "--num_topics", type=int, choices=range(1,10), default=1, help="Number of topics to publish, currently restricted to max of 9")
     parser.add_argument("-c", "--config", default="config.ini", help="configuration file (default: config.ini)")
+    parser.add_argument("-R", "--replica_of", default=None, help="run as a read replica of the discovery service at this IP Addr:Port")
     parser.add_argument("-f", "--frequency", type=int,default=1, help="Rate at which topics disseminated: default once a second - use integers")
     parser.add_argument("-i", "--iters", type=int, default=1000, help="number of publication iterations (default: 1000)")
     parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
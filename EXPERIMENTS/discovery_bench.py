@@ -0,0 +1,230 @@
+###############################################
+# Purpose:
+# Load generator and latency benchmark for the discovery service. Worker
+# processes each drive a number of synthetic clients that speak discovery.proto
+# over DEALER sockets (one outstanding request per client, like a REQ client).
+# Every client issues a weighted mix of register, isready and lookup requests
+# at its share of the target rate; the latency of a request is measured from
+# when it was due, so a discovery service that falls behind is charged for the
+# requests it delays and not just for the ones it serves.
+#
+# The report gives, per message type, the throughput and the p50/p99/p999
+# latency. With --spawn a DiscoveryAppln is started locally for the run (with
+# -P 0 -S 0 so isready is answered right away; see the readiness barrier).
+#
+# Run it from the top directory of the repository, e.g.
+#   python3 EXPERIMENTS/discovery_bench.py --spawn -C 64 -r 5000 -D 10 --preload 2000
+###############################################
+
+import os     # for OS functions
+import sys    # for syspath and system exception
+import time   # for the clock
+import argparse # for argument parsing
+import logging # for logging. Use it in place of print statements.
+import multiprocessing # for the worker processes
+import random # for the request mix and the topics
+import subprocess # to spawn the discovery service
+import zmq  # ZMQ sockets
+
+# the repository, for our middleware and the topic selector
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from topic_selector import TopicSelector
+from CS6381_MW import discovery_pb2
+
+MSG_TYPES = ["register", "isready", "lookup", "allpubs"] # what --mix may weigh
+
+# serialized DiscoveryReq of a given kind
+def build_request(kind, name, port, topics):
+    disc_req = discovery_pb2.DiscoveryReq()
+    if kind == "register":
+        disc_req.msg_type = discovery_pb2.TYPE_REGISTER
+        disc_req.register_req.role = discovery_pb2.ROLE_PUBLISHER
+        disc_req.register_req.info.id = name
+        disc_req.register_req.info.addr = "localhost"
+        disc_req.register_req.info.port = port
+        disc_req.register_req.topiclist[:] = topics
+    elif kind == "isready":
+        disc_req.msg_type = discovery_pb2.TYPE_ISREADY
+        disc_req.isready_req.SetInParent()
+    elif kind == "lookup":
+        disc_req.msg_type = discovery_pb2.TYPE_LOOKUP_PUB_BY_TOPIC
+        disc_req.lookup_req.topiclist[:] = topics
+    else: # allpubs
+        disc_req.msg_type = discovery_pb2.TYPE_LOOKUP_ALL_PUBS
+        disc_req.allpubs_req.SetInParent()
+    return disc_req.SerializeToString()
+
+# register count publishers in batches, so lookups have a registry to search
+def preload(discovery, count, num_topics, batch=500):
+    context = zmq.Context.instance()
+    socket = context.socket(zmq.DEALER)
+    socket.connect("tcp://" + discovery)
+    selector = TopicSelector()
+    for first in range(0, count, batch):
+        disc_req = discovery_pb2.DiscoveryReq()
+        disc_req.msg_type = discovery_pb2.TYPE_REGISTER_BATCH
+        for index in range(first, min(first + batch, count)):
+            reg_req = disc_req.register_batch_req.entries.add()
+            reg_req.role = discovery_pb2.ROLE_PUBLISHER
+            reg_req.info.id = "preload{}".format(index)
+            reg_req.info.addr = "localhost"
+            reg_req.info.port = 20000 + index % 40000
+            reg_req.topiclist[:] = selector.interest(num_topics)
+        socket.send_multipart([b"", disc_req.SerializeToString()])
+        if not socket.poll(10000):
+            raise RuntimeError("No reply to the preload batch starting at {}".format(first))
+        socket.recv_multipart()
+    socket.close(linger=0)
+
+# body of a worker process: drive its clients until the deadline and put the
+# latencies (ns, per message type) and the request counts on the results queue
+def run_worker(worker, clients, discovery, rate, weights, duration, num_topics, results):
+    context = zmq.Context()
+    poller = zmq.Poller()
+    selector = TopicSelector()
+    interval = clients / rate if rate > 0 else 0.0 # secs between two requests of a client
+    kinds = [kind for kind in MSG_TYPES if weights.get(kind)]
+    kind_weights = [weights[kind] for kind in kinds]
+    latencies = {kind: [] for kind in kinds}
+    sent = {kind: 0 for kind in kinds}
+    sockets = []
+    due = [] # when each client's next request is due
+    outstanding = {} # socket -> (kind, when it was due)
+    registered = 0
+    now = time.monotonic()
+    for index in range(clients):
+        socket = context.socket(zmq.DEALER)
+        socket.connect("tcp://" + discovery)
+        poller.register(socket, zmq.POLLIN)
+        sockets.append(socket)
+        # spread the clients over the first interval rather than firing together
+        due.append(now + random.random() * interval)
+    end = now + duration
+    while True:
+        now = time.monotonic()
+        if now < end:
+            for index, socket in enumerate(sockets):
+                if socket in outstanding or due[index] > now:
+                    continue
+                kind = random.choices(kinds, kind_weights)[0]
+                name = "bench{}-{}-{}".format(worker, index, registered)
+                if kind == "register":
+                    registered += 1
+                socket.send_multipart([b"", build_request(kind, name, 10000 + registered % 50000, selector.interest(num_topics))])
+                outstanding[socket] = (kind, due[index])
+                sent[kind] += 1
+                # keep the schedule even when late, so delays show in the latency
+                due[index] = due[index] + interval if interval else now
+        elif not outstanding:
+            break
+        next_due = min((due[index] for index, socket in enumerate(sockets) if socket not in outstanding), default=end)
+        timeout = max(0, min(next_due, end) - time.monotonic()) if now < end else max(0, end + 5 - now)
+        events = dict(poller.poll(timeout=timeout * 1000))
+        if not events and now >= end + 5:
+            break # give up on the requests still held, e.g. isready before readiness
+        received = time.monotonic()
+        for socket in events:
+            socket.recv_multipart()
+            kind, when = outstanding.pop(socket)
+            latencies[kind].append(int((received - when) * 1e9))
+    for socket in sockets:
+        socket.close(linger=0)
+    results.put((sent, latencies))
+
+# value at quantile q of a sorted list (nearest rank)
+def percentile(values, q):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(","):
+        kind, weight = item.split("=")
+        if kind.strip() not in MSG_TYPES:
+            raise ValueError("Unknown message type in the mix: {}".format(kind))
+        weights[kind.strip()] = float(weight)
+    return weights
+
+def report(sent, latencies, duration):
+    print("{:<10} {:>9} {:>9} {:>10} {:>10} {:>10} {:>10} {:>10}".format(
+        "type", "sent", "answered", "req/s", "p50 ms", "p99 ms", "p999 ms", "max ms"))
+    total_sent = 0
+    total = []
+    for kind in MSG_TYPES:
+        if kind not in sent:
+            continue
+        values = sorted(latencies[kind])
+        total_sent += sent[kind]
+        total.extend(values)
+        print("{:<10} {:>9} {:>9} {:>10.1f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+            kind, sent[kind], len(values), len(values) / duration, percentile(values, 0.5) / 1e6,
+            percentile(values, 0.99) / 1e6, percentile(values, 0.999) / 1e6, (values[-1] if values else 0) / 1e6))
+    total.sort()
+    print("{:<10} {:>9} {:>9} {:>10.1f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+        "all", total_sent, len(total), len(total) / duration, percentile(total, 0.5) / 1e6,
+        percentile(total, 0.99) / 1e6, percentile(total, 0.999) / 1e6, (total[-1] if total else 0) / 1e6))
+
+def parseCmdLineArgs():
+    parser = argparse.ArgumentParser(description="Discovery service load generator")
+    parser.add_argument("-d", "--discovery", default="localhost:5555", help="IP Addr:Port combo for the discovery service, default localhost:5555")
+    parser.add_argument("--spawn", action="store_true", help="start a DiscoveryAppln on the port of --discovery for the run")
+    parser.add_argument("-c", "--config", default="config.ini", help="configuration file of the spawned discovery service (default: config.ini)")
+    parser.add_argument("-C", "--clients", type=int, default=16, help="number of synthetic clients (default: 16)")
+    parser.add_argument("-W", "--workers", type=int, default=max(1, min(8, os.cpu_count() or 1) // 2), help="worker processes driving the clients")
+    parser.add_argument("-r", "--rate", type=float, default=1000, help="target requests per sec over all clients; 0 sends as fast as replies come back (default: 1000)")
+    parser.add_argument("-D", "--duration", type=float, default=10, help="secs of load (default: 10)")
+    parser.add_argument("-m", "--mix", default="register=1,isready=1,lookup=8", help="weights of the message types: register, isready, lookup, allpubs (default: register=1,isready=1,lookup=8)")
+    parser.add_argument("-T", "--num_topics", type=int, choices=range(1,10), default=3, help="topics per registration and per lookup (default: 3)")
+    parser.add_argument("--preload", type=int, default=0, help="publishers registered before the run, to size the registry (default: 0)")
+    parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
+    return parser.parse_args()
+
+def main():
+    logger = logging.getLogger("DiscoveryBench")
+    args = parseCmdLineArgs()
+    logger.setLevel(args.loglevel)
+    weights = parse_mix(args.mix)
+    discovery = None
+    try:
+        if args.spawn:
+            top = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+            port = args.discovery.split(":")[1]
+            logger.info("DiscoveryBench::main - starting a discovery service on port {}".format(port))
+            discovery = subprocess.Popen([sys.executable, "DiscoveryAppln.py", "-t", port, "-P", "0", "-S", "0", "-c", args.config, "-l", "40"],
+                                         cwd=top, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+            time.sleep(1.0)
+        if args.preload:
+            start = time.monotonic()
+            preload(args.discovery, args.preload, args.num_topics)
+            logger.info("DiscoveryBench::main - {} publishers preloaded in {:.2f} secs".format(args.preload, time.monotonic() - start))
+        workers = max(1, min(args.workers, args.clients))
+        logger.info("DiscoveryBench::main - {} clients in {} workers, {} req/s for {} secs, mix {}".format(
+            args.clients, workers, args.rate or "max", args.duration, args.mix))
+        mp = multiprocessing.get_context("spawn")
+        results = mp.Queue()
+        processes = []
+        for worker in range(workers):
+            clients = args.clients // workers + (1 if worker < args.clients % workers else 0)
+            rate = args.rate * clients / args.clients
+            process = mp.Process(target=run_worker, args=(worker, clients, args.discovery, rate, weights, args.duration, args.num_topics, results))
+            process.start()
+            processes.append(process)
+        sent = {}
+        latencies = {}
+        for _ in processes:
+            worker_sent, worker_latencies = results.get()
+            for kind, count in worker_sent.items():
+                sent[kind] = sent.get(kind, 0) + count
+                latencies.setdefault(kind, []).extend(worker_latencies[kind])
+        for process in processes:
+            process.join()
+        report(sent, latencies, args.duration)
+    finally:
+        if discovery is not None:
+            discovery.terminate()
+            discovery.wait()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    main()
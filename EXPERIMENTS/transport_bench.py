@@ -0,0 +1,140 @@
+###############################################
+# Purpose:
+# Compares the ZMQ transports the entities can negotiate ([Transport] in
+# config.ini) on the PUB/SUB path of the data plane:
+#   throughput - a publisher sends --count messages of --size bytes as fast as
+#                it can and the subscriber times their arrival
+#   latency    - a message is echoed back over a second PUB/SUB pair, --pings
+#                times in a row; half the round trip is reported
+# Both ends run as threads of this process, which inproc requires. They share
+# the GIL, so the absolute numbers are lower than between two processes, but
+# every transport pays the same for it.
+#
+# Run it from the top directory of the repository, e.g.
+#   python3 EXPERIMENTS/transport_bench.py --size 256 --count 200000
+###############################################
+
+import os     # for OS functions
+import sys    # for syspath and system exception
+import time   # for the clock
+import argparse # for argument parsing
+import shutil # for removing the directory of the ipc sockets
+import struct # for the timestamps of the pings
+import tempfile # for the directory of the ipc sockets
+import threading # for the publishing and echoing ends
+import zmq  # ZMQ sockets
+
+TRANSPORTS = ["inproc", "ipc", "tcp"] # what --transports may list
+TOPIC = b"bench"
+
+# a fresh endpoint of a transport; tcp picks a free port when binding
+def endpoint(transport, name, ipc_dir):
+    if transport == "inproc":
+        return "inproc://{}".format(name)
+    if transport == "ipc":
+        return "ipc://{}/{}".format(ipc_dir, name)
+    return "tcp://127.0.0.1"
+
+# bind a socket and return the endpoint to connect to
+def bind(socket, address):
+    if address.startswith("tcp://"):
+        port = socket.bind_to_random_port(address)
+        return "{}:{}".format(address, port)
+    socket.bind(address)
+    return address
+
+# Publish until the subscriber has joined, so no message of the run is lost
+# to the subscription still being on its way
+def join(pub, sub):
+    while True:
+        pub.send_multipart([b"sync", b""])
+        if sub.poll(10):
+            while sub.poll(0):
+                sub.recv_multipart()
+            return
+
+def throughput(context, transport, size, count, ipc_dir):
+    pub = context.socket(zmq.PUB)
+    sub = context.socket(zmq.SUB)
+    for socket in (pub, sub):
+        socket.setsockopt(zmq.SNDHWM, 0) # no drops: we count every message
+        socket.setsockopt(zmq.RCVHWM, 0)
+    address = bind(pub, endpoint(transport, "throughput", ipc_dir))
+    sub.setsockopt(zmq.SUBSCRIBE, b"")
+    sub.connect(address)
+    join(pub, sub)
+    payload = b"x" * size
+    def publish():
+        for _ in range(count):
+            pub.send_multipart([TOPIC, payload])
+    thread = threading.Thread(target=publish)
+    start = time.perf_counter()
+    thread.start()
+    for _ in range(count):
+        sub.recv_multipart()
+    elapsed = time.perf_counter() - start
+    thread.join()
+    pub.close(linger=0)
+    sub.close(linger=0)
+    return count / elapsed, count * size / elapsed / 1e6
+
+def latency(context, transport, size, pings, ipc_dir):
+    ping_pub = context.socket(zmq.PUB)
+    ping_sub = context.socket(zmq.SUB)
+    echo_pub = context.socket(zmq.PUB)
+    echo_sub = context.socket(zmq.SUB)
+    ping_address = bind(ping_pub, endpoint(transport, "ping", ipc_dir))
+    echo_address = bind(echo_pub, endpoint(transport, "echo", ipc_dir))
+    echo_sub.setsockopt(zmq.SUBSCRIBE, b"")
+    echo_sub.connect(ping_address)
+    ping_sub.setsockopt(zmq.SUBSCRIBE, b"")
+    ping_sub.connect(echo_address)
+    join(ping_pub, echo_sub)
+    join(echo_pub, ping_sub)
+    def echo():
+        for _ in range(pings):
+            echo_pub.send_multipart(echo_sub.recv_multipart())
+    thread = threading.Thread(target=echo)
+    thread.start()
+    padding = b"x" * max(0, size - 8)
+    samples = []
+    for _ in range(pings):
+        ping_pub.send_multipart([TOPIC, struct.pack("<q", time.perf_counter_ns()) + padding])
+        frames = ping_sub.recv_multipart()
+        samples.append((time.perf_counter_ns() - struct.unpack_from("<q", frames[1])[0]) / 2)
+    thread.join()
+    for socket in (ping_pub, ping_sub, echo_pub, echo_sub):
+        socket.close(linger=0)
+    samples.sort()
+    return [samples[min(len(samples) - 1, int(q * len(samples)))] / 1e3 for q in (0.5, 0.99, 0.999)]
+
+def parseCmdLineArgs():
+    parser = argparse.ArgumentParser(description="Transport benchmark of the PUB/SUB data plane")
+    parser.add_argument("-t", "--transports", default=",".join(TRANSPORTS), help="transports to compare (default: inproc,ipc,tcp)")
+    parser.add_argument("-s", "--size", type=int, default=128, help="message size in bytes (default: 128)")
+    parser.add_argument("-n", "--count", type=int, default=100000, help="messages of the throughput run (default: 100000)")
+    parser.add_argument("-p", "--pings", type=int, default=10000, help="round trips of the latency run (default: 10000)")
+    parser.add_argument("-I", "--io_threads", type=int, default=1, help="I/O threads of the ZMQ context (default: 1)")
+    return parser.parse_args()
+
+def main():
+    args = parseCmdLineArgs()
+    transports = [transport.strip() for transport in args.transports.split(",") if transport.strip()]
+    for transport in transports:
+        if transport not in TRANSPORTS:
+            raise ValueError("Unknown transport: {}".format(transport))
+    context = zmq.Context(io_threads=args.io_threads)
+    ipc_dir = tempfile.mkdtemp(prefix="transport-bench-")
+    try:
+        print("{} byte messages, {} for throughput, {} round trips for latency".format(args.size, args.count, args.pings))
+        print("{:<8} {:>12} {:>10} {:>12} {:>12} {:>12}".format("", "msgs/s", "MB/s", "p50 us", "p99 us", "p999 us"))
+        for transport in transports:
+            rate, bandwidth = throughput(context, transport, args.size, args.count, ipc_dir)
+            p50, p99, p999 = latency(context, transport, args.size, args.pings, ipc_dir)
+            print("{:<8} {:>12.0f} {:>10.1f} {:>12.1f} {:>12.1f} {:>12.1f}".format(transport, rate, bandwidth, p50, p99, p999))
+    finally:
+        context.term()
+        shutil.rmtree(ipc_dir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+# The host agent runs many publishers and/or subscribers in one process, to
+# emulate a large number of endpoints on a single machine without paying for an
+# interpreter (and a ZMQ context with its I/O thread) per entity.
+#
+# (1) parse the command line; it takes the arguments of the publisher and
+# subscriber applications plus the number of entities of each kind to host.
+#
+# (2) configure one PublisherAppln or SubscriberAppln object per entity, named
+# <name>1 .. <name>N (<sub_name>1 .. <sub_name>M) and using consecutive ports
+# from <port>. Their middleware objects share the ZMQ context and poller of our
+# HostMW object, so subscribers reach the publishers hosted with them over
+# inproc (see [Transport] in config.ini).
+#
+# (3) the agent registers all its publishers with the discovery service in one
+# batch, and all its subscribers in another; each entity is still registered as
+# one of its own and gets its own result. From there every entity goes through
+# its usual life cycle (isready, disseminate or receive) on the single event
+# loop of the HostMW object. Hosted subscribers write their measurements
+# through one shared result sink.
+#
+# (4) the agent exits once all its entities are done; when it hosts subscribers
+# this is when it is terminated, as for the subscriber application.
+
+# import the needed packages
+import os     # for OS functions
+import sys    # for syspath and system exception
+import argparse # for argument parsing
+import logging # for logging. Use it in place of print statements.
+import signal # for a clean shutdown on SIGTERM
+from rate_scheduler import RateScheduler
+from PublisherAppln import PublisherAppln
+from SubscriberAppln import SubscriberAppln
+from CS6381_MW.HostMW import HostMW
+
+class HostAgent():
+  def __init__ (self, logger):
+    self.publishers = None # number of publishers we host
+    self.subscribers = None # number of subscribers we host
+    self.apps = [] # the appln objects of the hosted entities
+    self.mw_obj = None # the host middleware object, sharing the context and poller
+    self.sink = None # result sink shared by the hosted subscribers
+    self.logger = logger  # internal logger for print statements
+
+  def configure (self, args):
+    try:
+      self.logger.info("HostAgent::configure")
+      self.publishers = args.publishers
+      self.subscribers = args.subscribers
+      if self.publishers + self.subscribers == 0:
+        raise ValueError("Nothing to host: give a number of publishers and/or subscribers")
+      self.mw_obj = HostMW(self.logger)
+      # a REQ and a PUB or SUB socket per entity, plus the sockets for the
+      # notifications and the read replicas they may add and the heartbeat socket
+      self.mw_obj.configure(sockets=4 * (self.publishers + self.subscribers) + 16, io_threads=args.io_threads)
+      for index in range(self.publishers + self.subscribers):
+        entity_args = argparse.Namespace(**vars(args))
+        entity_args.port = args.port + index
+        if index < self.publishers:
+          entity_args.name = "{}{}".format(args.name, index + 1)
+          app = PublisherAppln(self.logger)
+        else:
+          entity_args.name = "{}{}".format(args.sub_name, index - self.publishers + 1)
+          app = SubscriberAppln(self.logger)
+        app.configure(entity_args, host=self.mw_obj)
+        self.apps.append(app)
+      if self.subscribers:
+        # one writer thread and one file handle for all the subscribers
+        self.sink = self.apps[self.publishers].sink
+        for app in self.apps[self.publishers:]:
+          app.sink = self.sink
+      self.logger.info("HostAgent::configure - {} publishers and {} subscribers configured".format(self.publishers, self.subscribers))
+    except Exception as e:
+      raise e
+
+  def driver (self):
+    try:
+      self.logger.info("HostAgent::driver")
+      for app in self.apps:
+        app.dump()
+        app.mw_obj.set_upcall_handle(app)
+        app.state = app.State.REGISTER
+      if self.sink is not None:
+        self.sink.start()
+      self.register()
+      # each entity's invoke_operation is scheduled by the result of its registration
+      self.mw_obj.event_loop(timeout=None)
+      self.logger.info("HostAgent::driver completed")
+    except Exception as e:
+      raise e
+    finally:
+      if self.sink is not None:
+        self.sink.close() # flush the buffered records however we leave the loop
+
+  # one register batch request per kind of entity, sent by the middleware of
+  # the first one of them; the results come back as their register_response upcalls
+  def register (self):
+    try:
+      for apps in (self.apps[:self.publishers], self.apps[self.publishers:]):
+        if not apps:
+          continue
+        self.logger.info("HostAgent::register - {} entities in one batch".format(len(apps)))
+        apps[0].mw_obj.register_batch([(app.mw_obj, app.name, app.topiclist) for app in apps])
+    except Exception as e:
+      raise e
+
+def parseCmdLineArgs():
+  parser = argparse.ArgumentParser(description="Host agent running many publishers and/or subscribers in one process")
+  parser.add_argument("-P", "--publishers", type=int, default=0, help="Number of publishers to host (default: 0)")
+  parser.add_argument("-S", "--subscribers", type=int, default=0, help="Number of subscribers to host (default: 0)")
+  parser.add_argument("-n", "--name", default="pub", help="Name prefix of the publishers, which are named <name>1 .. <name>N. Keep it unique per host agent")
+  parser.add_argument("-s", "--sub_name", default="sub", help="Name prefix of the subscribers, which are named <sub_name>1 .. <sub_name>M. Keep it unique per host agent")
+  parser.add_argument("-a", "--addr", default="localhost", help="IP addr of this host to advertise (default: localhost)")
+  parser.add_argument("-p", "--port", type=int, default=5570, help="First of the consecutive ports used by the entities, publishers first, default=5570")
+  parser.add_argument("-d", "--discovery", default="localhost:5555", help="IP Addr:Port combo for the discovery service, default localhost:5555")
+  parser.add_argument("-T", "--num_topics", type=int, choices=range(1,10), default=7, help="Number of topics per entity, currently restricted to max of 9")
+  parser.add_argument("-c", "--config", default="config.ini", help="configuration file (default: config.ini)")
+  parser.add_argument("-f", "--frequency", type=float,default=1, help="Rate at which each publisher disseminates: default once a second - fractional rates allowed")
+  parser.add_argument("-A", "--arrival", default="constant", choices=RateScheduler.modes, help="Arrival process of the publication iterations (default: constant)")
+  parser.add_argument("-b", "--burst", type=int, default=10, help="Iterations sent back-to-back per burst in the burst arrival mode (default: 10)")
+  parser.add_argument("-i", "--iters", type=int, default=1000, help="number of publication iterations (default: 1000)")
+  parser.add_argument("-I", "--io_threads", type=int, default=1, help="I/O threads of the shared ZMQ context (default: 1)")
+  parser.add_argument("-l", "--loglevel", type=int, default=logging.WARNING, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 30=logging.WARNING")
+  return parser.parse_args()
+
+def main ():
+  try:
+    logging.info("Main - acquire a child logger and then log messages in the child")
+    logger = logging.getLogger("HostAgent")
+    logger.debug("Main: parse command line arguments")
+    args = parseCmdLineArgs()
+    logger.debug("Main: resetting log level to {}".format (args.loglevel))
+    logger.setLevel (args.loglevel)
+    logger.debug("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
+    # turn SIGTERM into SystemExit so the result sink is flushed on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    logger.debug("Main: obtain the host agent object")
+    agent = HostAgent(logger)
+    logger.debug("Main: configure the host agent object")
+    agent.configure(args)
+    logger.debug("Main: invoke the host agent driver")
+    agent.driver()
+  except Exception as e:
+    logger.error("Exception caught in main - {}".format (e))
+    return
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+  main()
@@ -38,13 +38,13 @@ import argparse # for argument parsing
 import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
 from topic_selector import TopicSelector
+from rate_scheduler import RateScheduler
 from CS6381_MW.PublisherMW import PublisherMW
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
 
 # import any other packages you need.
 from enum import Enum  # for an enumeration we are using to describe what state we are in
-from datetime import datetime
 
 class PublisherAppln():
   # These are the states through which our publisher appln object goes thru. We maintain the state 
@@ -63,20 +63,27 @@ class PublisherAppln():
     self.topiclist = None # the different topics that we publish on
     self.iters = None   # number of iterations of publication
     self.frequency = None # rate at which dissemination takes place
+    self.arrival = None # arrival process of the iterations: constant, poisson or burst
+    self.burst = None # iterations per burst in the burst arrival mode
     self.num_topics = None # total num of topics we publish
     self.mw_obj = None # handle to the underlying Middleware object
     self.logger = logger  # internal logger for print statements
     self.state = self.State.INITIALIZE # state that are we in
     self.lookup = None # one of the diff ways we do lookup
     self.dissemination = None # direct or via broker
+    self.ts = TopicSelector() # generates the publications
+    self.scheduler = None # paces the dissemination once it has started
 
-  def configure (self, args):
+  # host: the HostMW of a host agent, whose ZMQ context and poller we share (see HostAgent.py)
+  def configure (self, args, host=None):
     try:
       self.logger.info("PublisherAppln::configure")
       self.state = self.State.CONFIGURE
       self.name = args.name # our name
       self.iters = args.iters  # num of iterations
       self.frequency = args.frequency # frequency with which topics are disseminated
+      self.arrival = args.arrival
+      self.burst = args.burst
       self.num_topics = args.num_topics  # total num of topics we publish
       config = configparser.ConfigParser()
       config.read(args.config)
@@ -86,6 +93,8 @@ class PublisherAppln():
       self.selectTopics()
       self.logger.info("PublisherAppln::configure - initialize the middleware object")
       self.mw_obj = PublisherMW(self.logger)
+      if host is not None:
+        host.adopt(self.mw_obj)
       self.mw_obj.configure(args) # pass remainder of the args to the m/w object
       self.logger.info("PublisherAppln::configure - configuration complete")
     except Exception as e:
@@ -121,17 +130,27 @@ class PublisherAppln():
         self.mw_obj.is_ready()  # send the is_ready? request
         return None
       elif (self.state == self.State.DISSEMINATE):
-        self.logger.info("PublisherAppln::invoke_operation - start Disseminating")
-        # Now disseminate topics at the rate at which we have configured ourselves.
-        ts = TopicSelector()
-        for i in range(self.iters):
+        # Disseminate topics at the rate at which we have configured ourselves. Each
+        # upcall sends the iterations that are due and returns the time until the
+        # next one, so the event loop stays free for other work meanwhile (e.g. the
+        # other entities of a host agent, see HostAgent.py)
+        if self.scheduler is None:
+          self.logger.info("PublisherAppln::invoke_operation - start Disseminating")
+          self.scheduler = RateScheduler(self.frequency, self.arrival, self.burst)
+          self.scheduler.start()
+        while self.scheduler.count < self.iters and self.scheduler.due():
           for topic in self.topiclist:
-            dissemination_data = ts.gen_publication(topic)
-            current_time = datetime.now().strftime('%H-%M-%S-%f')[:-3]
-            current_time = str(current_time)
-            self.mw_obj.disseminate(self.name, topic, dissemination_data, current_time) # Current time is sent as well
-          time.sleep(1/float (self.frequency))  # ensure we get a floating point num
+            dissemination_data = self.ts.gen_publication(topic)
+            self.mw_obj.disseminate(self.name, topic, dissemination_data, time.time_ns()) # Current time is sent as well
+        if self.scheduler.count < self.iters:
+          # send the batches that would otherwise outlive their linger time while we wait
+          self.mw_obj.flush_batches(self.scheduler.next_deadline())
+          return self.scheduler.timeout_ms()
+        self.mw_obj.flush_batches()
+        stats = self.scheduler.stats()
         self.logger.info("PublisherAppln::invoke_operation - Dissemination completed")
+        self.logger.info("PublisherAppln::invoke_operation - target rate {} Hz ({}), achieved {:.3f} Hz, mean lag {:.3f} ms, max lag {:.3f} ms".format(
+          self.frequency, self.arrival, stats["achieved_rate"], stats["mean_lag"] * 1000, stats["max_lag"] * 1000))
         self.state = self.State.COMPLETED
         return 0
       elif (self.state == self.State.COMPLETED):
@@ -163,7 +182,10 @@ class PublisherAppln():
       self.logger.info ("PublisherAppln::isready_response")
       if not isready_resp.status: # discovery service is not ready yet
         self.logger.debug ("PublisherAppln::driver - Not ready yet; check again")
-        time.sleep (10)  # sleep between calls so that we don't make excessive calls
+        # the discovery service holds our request until everyone has registered
+        # (Server=ROUTER), so this only happens when its ready timeout expires or
+        # it cannot hold requests. Ask again shortly, without blocking the event loop
+        return self.mw_obj.ready_retry()
       else:
         # we got the go ahead + set the state to disseminate
         self.state = self.State.DISSEMINATE
@@ -182,6 +204,9 @@ class PublisherAppln():
       self.logger.info("     TopicList: {}".format (self.topiclist))
       self.logger.info("     Iterations: {}".format (self.iters))
       self.logger.info("     Frequency: {}".format (self.frequency))
+      self.logger.info("     Arrival: {} (burst {})".format (self.arrival, self.burst))
+      self.logger.info("     Format: {}".format (self.mw_obj.format))
+      self.logger.info("     Batch size: {}, linger: {} ms".format (self.mw_obj.batch_size, self.mw_obj.batch_linger * 1000))
       self.logger.info("**********************************")
     except Exception as e:
       raise e
@@ -198,7 +223,9 @@ def parseCmdLineArgs():
   parser.add_argument("-d", "--discovery", default="localhost:5555", help="IP Addr:Port combo for the discovery service, default localhost:5555")
   parser.add_argument("-T", "--num_topics", type=int, choices=range(1,10), default=7, help="Number of topics to publish, currently restricted to max of 9")
   parser.add_argument("-c", "--config", default="config.ini", help="configuration file (default: config.ini)")
-  parser.add_argument("-f", "--frequency", type=int,default=1, help="Rate at which topics disseminated: default once a second - use integers")
+  parser.add_argument("-f", "--frequency", type=float,default=1, help="Rate at which topics disseminated: default once a second - fractional rates allowed")
+  parser.add_argument("-A", "--arrival", default="constant", choices=RateScheduler.modes, help="Arrival process of the publication iterations (default: constant)")
+  parser.add_argument("-b", "--burst", type=int, default=10, help="Iterations sent back-to-back per burst in the burst arrival mode (default: 10)")
   parser.add_argument("-i", "--iters", type=int, default=1000, help="number of publication iterations (default: 1000)")
   parser.add_argument("-l", "--loglevel", type=int, default=logging.INFO, choices=[logging.DEBUG,logging.INFO,logging.WARNING,logging.ERROR,logging.CRITICAL], help="logging level, choices 10,20,30,40,50: default 20=logging.INFO")
   return parser.parse_args()
@@ -17,14 +17,15 @@ import time   # for sleep
 import argparse # for argument parsing
 import configparser # for configuration parsing
 import logging # for logging. Use it in place of print statements.
+import signal # for a clean shutdown on SIGTERM
 from topic_selector import TopicSelector
+from result_sink import ResultSink
 from CS6381_MW.SubscriberMW import SubscriberMW
 from CS6381_MW import discovery_pb2
 from CS6381_MW import topic_pb2
 
 # import any other packages you need.
 from enum import Enum  # for an enumeration we are using to describe what state we are in
-import csv
 from datetime import datetime
 
 class SubscriberAppln():
@@ -51,8 +52,10 @@ class SubscriberAppln():
     self.lookup = None # one of the diff ways we do lookup
     self.dissemination = None # direct or via broker
     self.msg_list = []
+    self.sink = None # buffered writer for the measurement records
 
-  def configure (self, args):
+  # host: the HostMW of a host agent, whose ZMQ context and poller we share (see HostAgent.py)
+  def configure (self, args, host=None):
     ''' Initialize the object '''
     try:
       self.logger.info ("SubscriberAppln::configure")
@@ -65,10 +68,13 @@ class SubscriberAppln():
       config.read(args.config)
       self.lookup = config["Discovery"]["Strategy"]
       self.dissemination = config["Dissemination"]["Strategy"]
+      self.configureSink(config)
       self.logger.info("SubscriberAppln::configure - selecting our topic list")
       self.subscribeTopics()
       self.logger.info("SubscriberAppln::configure - initialize the middleware object")
       self.mw_obj = SubscriberMW(self.logger)
+      if host is not None:
+        host.adopt(self.mw_obj)
       self.mw_obj.configure(args) # pass remainder of the args to the m/w object
       self.logger.info("SubscriberAppln::configure - configuration complete")
     except Exception as e:
@@ -81,10 +87,13 @@ class SubscriberAppln():
       self.logger.info("SubscriberAppln::driver - upcall handle")
       self.mw_obj.set_upcall_handle(self)
       self.state = self.State.REGISTER
+      self.sink.start()
       self.mw_obj.event_loop(timeout=0)  # start the event loop
       self.logger.info("SubscriberAppln::driver completed")
     except Exception as e:
       raise e
+    finally:
+      self.sink.close() # flush the buffered records however we leave the loop
 
   def invoke_operation (self):
     ''' Invoke operating depending on state  '''
@@ -103,13 +112,8 @@ class SubscriberAppln():
         self.mw_obj.receiveSubscribedPublishers(self.topiclist)
         return None
       elif (self.state == self.State.RECEIVE):
-        while True:
-          msg = self.mw_obj.receive()
-          self.logger.info(msg)
-          current_time = datetime.now().strftime('%H-%M-%S-%f')[:-3]
-          self.saveCSV(msg, current_time)
-          self.logger.info("SubscriberAppln::invoke_operation - RECEIVING Messages as shown below: {}".format (msg))
-          self.logger.info("SubscriberAppln::invoke_operation - Current time: {}".format (current_time))
+        # publications are delivered by the event loop through publications_received,
+        # so just wait for the next event
         return None
       elif (self.state == self.State.COMPLETED):
         self.mw_obj.disable_event_loop()
@@ -141,7 +145,10 @@ class SubscriberAppln():
       self.logger.info("SubscriberAppln::isready_response")
       if not isready_resp.status:
         self.logger.info("SubscriberAppln::driver - Not ready yet; check again")
-        time.sleep (10)  # sleep between calls so that we don't make excessive calls
+        # the discovery service holds our request until everyone has registered
+        # (Server=ROUTER), so this only happens when its ready timeout expires or
+        # it cannot hold requests. Ask again shortly, without blocking the event loop
+        return self.mw_obj.ready_retry()
       else:
         self.state = self.State.CHECKMSG
       return 0
@@ -163,46 +170,61 @@ class SubscriberAppln():
     except Exception as e:
       raise e
   
-  def saveCSV(self, msg, current_time):
+  # upcall made by the middleware for every message drained from the data socket
+  def publications_received(self, publications, from_broker):
     try:
-      msglist = msg.split(":")
-      id = msglist[1]
-      topic = msglist[0]
-      disseminationdata = msglist[2]
-      sent_time = msglist[3]
-      receivedFromBroker = False
-      if "(from broker)" in msg:
-        receivedFromBroker = True
-      t1 = datetime.strptime(sent_time, "%H-%M-%S-%f")
-      t2 = datetime.strptime(current_time, "%H-%M-%S-%f")
-      delta = t2 - t1
-      sec = delta.total_seconds()
-      latency = sec * 1000
-      msgDict = {
-        "pub_id" : id,
-        "topic" : topic,
-        "disseminationdata" : disseminationdata,
-        "sent_time" : sent_time,
-        "sub_id" : self.name,
-        "received_time" : current_time,
-        "Num_topics_subscribed": self.num_topics,
-        "latency" : latency, # in milliseconds
-        "receivedFromBroker" : receivedFromBroker
-      }
-      with open("sample.csv", "a+") as outfile:
-        writer = csv.DictWriter(outfile, fieldnames = ["pub_id", "topic", "disseminationdata", 
-                                                       "sent_time", "sub_id", "received_time", 
-                                                       "Num_topics_subscribed", "latency", 
-                                                       "receivedFromBroker"])
-        if outfile.tell() == 0: # if file is empty, write the header
-          writer.writeheader()
-        writer.writerow(msgDict)
+      current_time = time.time_ns()
+      # per-message detail is logged by the middleware telemetry for sampled messages only
+      for publication in publications:
+        self.saveCSV(publication, from_broker, current_time)
+      return None
     except Exception as e:
       raise e
+
+  # sent and received times are integer nanoseconds since the epoch
+  def saveCSV(self, publication, receivedFromBroker, current_time):
+    try:
+      id = publication.pub_id
+      topic = publication.topic
+      disseminationdata = publication.content
+      sent_time = publication.tstamp_ns
+      latency = (current_time - sent_time) / 1e6
+      # only enqueued here; the sink writes the rows in blocks on its own thread
+      self.sink.put((id, topic, disseminationdata, sent_time, self.name, current_time,
+                     self.num_topics, latency, receivedFromBroker)) # latency in milliseconds
+    except Exception as e:
+      raise e
+
+  # the records are buffered in memory and written in blocks by a background thread
+  def configureSink(self, config):
+    results = config["Results"] if config.has_section("Results") else {}
+    fieldnames = ["pub_id", "topic", "disseminationdata",
+                  "sent_time", "sub_id", "received_time",
+                  "Num_topics_subscribed", "latency",
+                  "receivedFromBroker"]
+    formatter = None
+    if str(results.get("ReadableTime", "False")).lower() == "true":
+      # formatted on the writer thread, never on the receive path
+      fieldnames += ["sent_time_str", "received_time_str"]
+      formatter = self.addReadableTime
+    self.sink = ResultSink(self.logger, results.get("File", "sample.csv"), fieldnames,
+                           capacity=int(results.get("Capacity", 100000)),
+                           flush_records=int(results.get("FlushRecords", 1000)),
+                           flush_interval=float(results.get("FlushInterval", 1.0)),
+                           formatter=formatter)
+
+  # append human-readable versions of the sent and received timestamps to a row
+  def addReadableTime(self, row):
+    return tuple(row) + tuple(datetime.fromtimestamp(ns / 1e9).isoformat(timespec="microseconds") for ns in (row[3], row[5]))
     
   def receiveSubscribedPublishersResponse(self, lookup_resp):
     try:
       self.logger.info("SubscriberAppln::receiveSubscribedPublishersResponse - start")
+      # this may be a resync, so drop the publishers that are no longer listed
+      matched = set(pub.id for pub in lookup_resp.publisher_info)
+      for id in list(self.mw_obj.publishers):
+        if id not in matched:
+          self.mw_obj.dropPublisher(id)
       for pub in lookup_resp.publisher_info:
         self.logger.info("tcp://{}:{}".format(pub.addr, pub.port))
         self.mw_obj.makeSubscription(pub, self.topiclist)
@@ -211,6 +233,26 @@ class SubscriberAppln():
     except Exception as e:
       raise e
 
+  # upcall made by the middleware for each registry change, in sequence order
+  def registry_changed(self, delta):
+    try:
+      if delta.change != discovery_pb2.CHANGE_PUB_REMOVED and set(delta.topiclist) & set(self.topiclist):
+        self.mw_obj.makeSubscription(delta.info, self.topiclist)
+      else: # gone, or no longer publishing anything we want
+        self.mw_obj.dropPublisher(delta.info.id)
+      return None
+    except Exception as e:
+      raise e
+
+  # upcall made by the middleware when it missed registry changes: look up a
+  # fresh list of publishers (the request socket is idle once we receive)
+  def registry_resync(self):
+    try:
+      self.mw_obj.receiveSubscribedPublishers(self.topiclist)
+      return None
+    except Exception as e:
+      raise e
+
   def subscribeTopics(self):
     topicSelector = TopicSelector()
     self.topiclist = topicSelector.interest(self.num_topics)  # let topic selector give us the desired num of topics
@@ -238,6 +280,8 @@ def main ():
     logger.setLevel (args.loglevel)
     logger.debug("Main: effective log level is {}".format (logger.getEffectiveLevel ()))
     logger.debug("Main: obtain the Subscriber appln object")
+    # turn SIGTERM into SystemExit so the result sink is flushed on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
     sub_app = SubscriberAppln(logger)
     logger.debug("Main: configure the Subscriber appln object")
     sub_app.configure(args)
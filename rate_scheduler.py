@@ -0,0 +1,100 @@
+###############################################
+# Purpose:
+# Paces the publisher's dissemination loop against absolute deadlines so that
+# the time spent generating and sending publications does not slow down the
+# offered rate. Supports fractional rates and three arrival processes:
+#   constant - one iteration every 1/rate secs
+#   poisson  - exponentially distributed gaps with mean 1/rate secs
+#   burst    - groups of `burst` back-to-back iterations, spaced so that the
+#              mean rate is still `rate`
+# To be used by the publisher application logic only. See its code
+###############################################
+
+import math   # for rounding up timeouts
+import random # for the poisson arrivals
+import time   # for the clock and sleep
+
+class RateScheduler ():
+  modes = ["constant", "poisson", "burst"]
+
+  def __init__ (self, rate, mode="constant", burst=1):
+    if rate <= 0:
+      raise ValueError("Rate must be positive, got {}".format(rate))
+    if mode not in self.modes:
+      raise ValueError("Unknown arrival mode: {}".format(mode))
+    self.rate = float(rate) # target iterations per second
+    self.mode = mode # arrival process
+    self.burst = max(1, burst) # iterations per burst (burst mode only)
+    self.start_time = None # when the schedule started
+    self.deadline = None # when the next iteration is due
+    self.last_release = None # when the latest iteration was released
+    self.count = 0 # iterations released so far
+    self.total_lag = 0.0 # sum of how late each iteration was released
+    self.max_lag = 0.0 # worst lateness seen
+
+  def start (self):
+    self.start_time = time.monotonic()
+    self.deadline = self.start_time
+    self.last_release = None
+    self.count = 0
+    self.total_lag = 0.0
+    self.max_lag = 0.0
+
+  # block until the next iteration is due. If we are running behind the
+  # schedule we return immediately and the lost time is recorded as lag; the
+  # deadlines stay absolute so the loop catches up instead of drifting
+  def wait (self):
+    if self.start_time is None:
+      self.start()
+    now = time.monotonic()
+    if self.deadline > now:
+      time.sleep(self.deadline - now)
+    self.release()
+
+  # non-blocking counterpart of wait, for a loop that has other work to do:
+  # is the next iteration due yet? If so, release it
+  def due (self):
+    if self.start_time is None:
+      self.start()
+    if self.deadline > time.monotonic():
+      return False
+    self.release()
+    return True
+
+  # msecs until the next iteration is due, rounded up so that a poll with
+  # this timeout does not wake up just before the deadline
+  def timeout_ms (self):
+    return max(0, math.ceil((self.deadline - time.monotonic()) * 1000))
+
+  # account for the iteration due now and schedule the next one
+  def release (self):
+    now = time.monotonic()
+    self.last_release = now
+    lag = now - self.deadline
+    self.total_lag += lag
+    if lag > self.max_lag:
+      self.max_lag = lag
+    self.count += 1
+    self.deadline += self.next_interval()
+
+  # time.monotonic() value at which the next iteration is due
+  def next_deadline (self):
+    return self.deadline
+
+  def next_interval (self):
+    if self.mode == "poisson":
+      return random.expovariate(self.rate)
+    if self.mode == "burst":
+      return self.burst / self.rate if self.count % self.burst == 0 else 0.0
+    return 1.0 / self.rate
+
+  # achieved rate (between the first and latest release) plus mean and max
+  # schedule lag in secs
+  def stats (self):
+    elapsed = self.last_release - self.start_time if self.count > 1 else 0.0
+    return {
+      "iterations": self.count,
+      "achieved_rate": (self.count - 1) / elapsed if elapsed > 0 else 0.0,
+      "mean_lag": self.total_lag / self.count if self.count else 0.0,
+      "max_lag": self.max_lag
+    }
@@ -0,0 +1,116 @@
+###############################################
+# Purpose:
+# Optional persistence of the discovery registry, so that a restarted discovery
+# service serves lookups right away instead of waiting for every client to
+# register again.
+# Every change is appended to a binary journal as a 4-byte length followed by a
+# serialized JournalRecord. Once snapshot_every records have been appended the
+# whole registry is written as a RegistrySnapshot (to a temporary file renamed
+# over the previous one) and the journal is emptied, so recovery never reads
+# more than one snapshot plus snapshot_every records.
+# A crash in the middle of an append leaves a torn record at the end of the
+# journal; recovery stops there and cuts it off.
+# To be used by the discovery application logic only. See DiscoveryAppln.py
+###############################################
+
+import os     # for fsync, rename and file sizes
+import struct # for the record length prefix
+from CS6381_MW import discovery_pb2
+
+class RegistryStore():
+    _LENGTH = struct.Struct("<I") # length prefix of a journal record
+
+    def __init__(self, logger, directory, snapshot_every=10000, fsync=False):
+        self.logger = logger # internal logger for print statements
+        self.directory = directory # where the snapshot and the journal live
+        self.snapshot_every = snapshot_every # journal records between two snapshots
+        self.fsync = fsync # fsync every record (survives an OS crash, not just ours)
+        self.snapshot_file = os.path.join(directory, "registry.snapshot")
+        self.journal_file = os.path.join(directory, "registry.journal")
+        self.journal = None # journal opened for appending
+        self.records = 0 # records appended since the last snapshot
+
+    # Read the snapshot and the journal. Returns the snapshot (empty if there is
+    # none) and the list of journal records that follow it
+    def recover(self):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            snapshot = discovery_pb2.RegistrySnapshot()
+            if os.path.exists(self.snapshot_file):
+                with open(self.snapshot_file, "rb") as infile:
+                    snapshot.ParseFromString(infile.read())
+            records = []
+            valid = 0 # offset just past the last complete record
+            if os.path.exists(self.journal_file):
+                with open(self.journal_file, "rb") as infile:
+                    data = infile.read()
+                while valid + self._LENGTH.size <= len(data):
+                    (length,) = self._LENGTH.unpack_from(data, valid)
+                    end = valid + self._LENGTH.size + length
+                    if end > len(data):
+                        break
+                    record = discovery_pb2.JournalRecord()
+                    record.ParseFromString(data[valid + self._LENGTH.size:end])
+                    records.append(record)
+                    valid = end
+                if valid < len(data):
+                    self.logger.warning("RegistryStore::recover - dropping a torn record at the end of the journal")
+            self.journal = open(self.journal_file, "ab")
+            self.journal.truncate(valid)
+            self.records = len(records)
+            return snapshot, records
+        except Exception as e:
+            raise e
+
+    # append one change; role and entry are as in the discovery registry
+    def append(self, op, role, entry):
+        try:
+            record = discovery_pb2.JournalRecord()
+            record.op = op
+            self.fill(record.registration, role, entry)
+            buf = record.SerializeToString()
+            self.journal.write(self._LENGTH.pack(len(buf)) + buf)
+            self.journal.flush()
+            if self.fsync:
+                os.fsync(self.journal.fileno())
+            self.records += 1
+        except Exception as e:
+            raise e
+
+    # has the journal grown enough to be compacted into a snapshot?
+    def snapshot_due(self):
+        return self.records >= self.snapshot_every
+
+    # write the whole registry, a list of (role, entry), and empty the journal
+    def snapshot(self, version, registrations):
+        try:
+            snapshot = discovery_pb2.RegistrySnapshot()
+            snapshot.version = version
+            for role, entry in registrations:
+                self.fill(snapshot.registrations.add(), role, entry)
+            tmp_file = self.snapshot_file + ".tmp"
+            with open(tmp_file, "wb") as outfile:
+                outfile.write(snapshot.SerializeToString())
+                outfile.flush()
+                os.fsync(outfile.fileno())
+            os.replace(tmp_file, self.snapshot_file)
+            # only now is it safe to drop the records the snapshot includes
+            self.journal.truncate(0)
+            self.records = 0
+            self.logger.info("RegistryStore::snapshot - {} registrations at version {}".format(len(registrations), version))
+        except Exception as e:
+            raise e
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    def fill(self, register_req, role, entry):
+        register_req.role = role
+        register_req.info.id = entry[0] # name
+        register_req.info.addr = entry[1] # addr
+        register_req.info.port = entry[2] # port
+        register_req.info.shards = entry[4] # consecutive ports of a sharded broker
+        register_req.info.endpoints[:] = entry[5] # over every transport it offers
+        register_req.topiclist[:] = entry[3]
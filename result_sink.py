@@ -0,0 +1,111 @@
+###############################################
+# Purpose:
+# Buffered, asynchronous sink for the measurement records collected by the
+# subscribers. The receive path only enqueues a row into a bounded in-memory
+# buffer; a background writer thread appends the rows to the CSV file in large
+# blocks whenever enough rows are pending or the flush interval has passed.
+# To be used by the application logic only. See SubscriberAppln.py
+###############################################
+
+import csv    # for formatting the rows
+import io     # for building a block of rows in memory
+import queue  # bounded buffer between the receive path and the writer
+import signal # to keep termination signals on the main thread
+import threading # for the background writer
+import time   # for the flush interval
+
+class ResultSink ():
+  _STOP = object() # sentinel telling the writer thread to flush and exit
+  _WAIT = 0.5 # secs a blocked put waits before checking the writer is still alive
+
+  def __init__ (self, logger, filename, fieldnames, capacity=100000, flush_records=1000, flush_interval=1.0, formatter=None):
+    self.logger = logger # internal logger for print statements
+    self.filename = filename # CSV file the rows are appended to
+    self.fieldnames = fieldnames # column names, also the order of the values in a row
+    self.flush_records = flush_records # write once this many rows are pending
+    self.flush_interval = flush_interval # or once the oldest pending row is this many secs old
+    self.formatter = formatter # optional row -> row callable, run on the writer thread
+    self.buffer = queue.Queue(maxsize=capacity) # bounded; put blocks when the writer falls behind
+    self.writer = None # the background writer thread
+    self.rows_written = 0 # total rows written so far
+    self.error = None # exception that stopped the writer thread, if any
+
+  # start the background writer
+  def start (self):
+    self.writer = threading.Thread(target=self.run, name="ResultSink", daemon=True)
+    self.writer.start()
+
+  # hot path: enqueue one row, a sequence of values ordered as fieldnames. It
+  # blocks while the buffer is full, but raises once the writer has stopped
+  # rather than wait for it forever
+  def put (self, row):
+    if self.error is not None:
+      raise RuntimeError("ResultSink::put - the writer has stopped: {}".format(self.error))
+    while True:
+      try:
+        self.buffer.put(row, timeout=self._WAIT)
+        return
+      except queue.Full:
+        if not self.writer.is_alive():
+          raise RuntimeError("ResultSink::put - the writer has stopped with {} rows buffered".format(self.buffer.qsize()))
+
+  # flush everything still buffered and stop the writer
+  def close (self):
+    if self.writer is None:
+      return
+    while self.writer.is_alive():
+      try:
+        self.buffer.put(self._STOP, timeout=self._WAIT)
+        break
+      except queue.Full:
+        pass # the writer is draining it, unless it stops meanwhile
+    self.writer.join()
+    self.writer = None
+    self.logger.info("ResultSink::close - {} rows written to {}".format(self.rows_written, self.filename))
+
+  # body of the writer thread
+  def run (self):
+    try:
+      # let SIGTERM/SIGINT interrupt the main thread's poll rather than land here
+      signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM, signal.SIGINT})
+      with open(self.filename, "a+", newline="") as outfile:
+        if outfile.tell() == 0: # if file is empty, write the header
+          outfile.write(self.format_rows([self.fieldnames]))
+          outfile.flush()
+        pending = []
+        deadline = None
+        while True:
+          timeout = None if deadline is None else max(0, deadline - time.monotonic())
+          try:
+            row = self.buffer.get(timeout=timeout)
+          except queue.Empty:
+            row = None
+          if row is self._STOP:
+            self.write_block(outfile, pending)
+            return
+          if row is not None:
+            pending.append(row)
+            if deadline is None:
+              deadline = time.monotonic() + self.flush_interval
+          if len(pending) >= self.flush_records or (deadline is not None and time.monotonic() >= deadline):
+            self.write_block(outfile, pending)
+            pending = []
+            deadline = None
+    except Exception as e:
+      self.error = e
+      self.logger.error("ResultSink::run - writer stopped: {}".format(e))
+      raise e
+
+  def write_block (self, outfile, rows):
+    if not rows:
+      return
+    if self.formatter is not None:
+      rows = [self.formatter(row) for row in rows]
+    outfile.write(self.format_rows(rows))
+    outfile.flush()
+    self.rows_written += len(rows)
+
+  def format_rows (self, rows):
+    block = io.StringIO()
+    csv.writer(block).writerows(rows)
+    return block.getvalue()
@@ -0,0 +1,64 @@
+###############################################
+# Purpose:
+# Hashed timing wheel for the registration leases of the discovery service.
+# Time is cut into ticks of `resolution` secs and a lease expiring at tick t
+# lives in slot t % slots. Advancing the wheel only visits the slots of the
+# ticks that have passed, and as long as the wheel spans the longest lease
+# (slots * resolution > lease) every key found there is due: the cost is
+# O(expired), however many leases are held. Renewing a lease moves its key to
+# another slot in O(1).
+# To be used by the discovery application logic only. See DiscoveryAppln.py
+###############################################
+
+import time   # for the clock
+
+class TimingWheel():
+    def __init__(self, resolution=0.1, slots=1024):
+        self.resolution = resolution # secs per tick
+        self.slots = [{} for _ in range(slots)] # slot -> {key: tick it expires at}
+        self.where = {} # key -> (slot, tick), to renew or cancel in O(1)
+        self.start = time.monotonic()
+        self.current = 0 # last tick processed
+
+    def __len__(self):
+        return len(self.where)
+
+    def __contains__(self, key):
+        return key in self.where
+
+    def tick_of(self, when):
+        return int((when - self.start) / self.resolution)
+
+    # start or renew the lease of key, expiring timeout secs from now
+    def add(self, key, timeout):
+        self.remove(key)
+        tick = max(self.tick_of(time.monotonic() + timeout), self.current + 1)
+        slot = tick % len(self.slots)
+        self.slots[slot][key] = tick
+        self.where[key] = (slot, tick)
+
+    def remove(self, key):
+        position = self.where.pop(key, None)
+        if position is not None:
+            del self.slots[position[0]][key]
+
+    # process the ticks up to now and return the keys whose lease has expired
+    def advance(self):
+        target = self.tick_of(time.monotonic())
+        expired = []
+        # after a long pause every slot is visited once, not once per tick
+        for tick in range(self.current + 1, min(target, self.current + len(self.slots)) + 1):
+            slot = self.slots[tick % len(self.slots)]
+            due = [key for key, when in slot.items() if when <= target]
+            for key in due:
+                del slot[key]
+                del self.where[key]
+            expired.extend(due)
+        self.current = max(self.current, target)
+        return expired
+
+    # secs until the next tick, or None when there is no lease to watch
+    def next_timeout(self):
+        if not self.where:
+            return None
+        return max(0.0, self.start + (self.current + 1) * self.resolution - time.monotonic())